@@ -0,0 +1,208 @@
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from lib.fifo_defs import *
+from lib.shm_ring import SHM_RING_WORDS, SLOT_FREE, SLOT_STATE, ShmRing, ShmRingReader
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+def _readout_main(ring_name, link_kwargs, reg_name_base, fifo_name, chunk_words, policy, idle_sleep,
+                  max_words):
+    """Readout process: drain the data FIFO into the ring and nothing else."""
+    # uhal is only needed here, consumers never import it
+    from lib.ipbus_link import IPbusLink
+
+    ring = ShmRing.attach(ring_name)
+    try:
+        ipbus_link = IPbusLink(**link_kwargs)
+        scratch = np.empty(chunk_words, dtype=np.uint32)
+        words = 0
+        while not ring.stop_requested() and (max_words is None or words < max_words):
+            want = chunk_words if max_words is None else min(chunk_words, max_words - words)
+            out = ring.reserve(want)
+            if not len(out):
+                if policy == "block":
+                    # Leave the data in the board FIFO until a consumer catches up
+                    ring.wait_for_room()
+                    continue
+                chunk = ipbus_link.read_ipb_data_fifo_pipelined(reg_name_base, fifo_name, want, out=scratch)
+                ring.drop(len(chunk))
+            else:
+                chunk = ipbus_link.read_ipb_data_fifo_pipelined(reg_name_base, fifo_name, len(out), out=out)
+                ring.commit(len(chunk))
+            words += len(chunk)
+            if not len(chunk) and not ipbus_link.fifo_words_known(reg_name_base, fifo_name):
+                time.sleep(idle_sleep)
+    finally:
+        ring.close_writer()
+        ring.close()
+
+
+def _consumer_main(ring_name, slot, lossy, func, args, kwargs):
+    ring = ShmRing.attach(ring_name)
+    reader = ring.reader(slot, lossy)
+    try:
+        func(reader, *args, **kwargs)
+    finally:
+        reader.close()
+        ring.close()
+
+
+class Acquisition:
+    """
+    Multi-process data taking.
+
+    One process does nothing but read RFIFO_DATA straight into a shared memory ring
+    (:class:`ShmRing`); every consumer runs in its own process on a :class:`ShmRingReader`
+    of that ring, so analysis never competes with the readout for the GIL.
+
+    Consumers are functions taking the reader as first argument, defined at module level
+    so they can be started in a new process. Blocking consumers (a disk writer) see every
+    word and hold the readout back when a whole ring behind; lossy ones (a histogrammer)
+    skip what they miss and count it.
+
+    Example::
+
+        def write_file(reader, path):
+            with RunFileWriter(path) as writer:
+                for chunk in reader:
+                    writer.write(chunk)
+
+        acq = Acquisition({"device_uri": "ipbusudp-2.0://127.0.0.1:50001", "address_table": "etc/sim_address.xml"})
+        acq.add_consumer(write_file, "run0001.ceerun")
+        acq.add_consumer(fill_hitmap, "data/hitmap.npz", lossy=True)
+        with acq:
+            time.sleep(60)
+        print(acq.stats())
+    """
+
+    def __init__(self, link_kwargs=None, reg_name_base=DATA_FIFO_BASE, fifo_name=DATA_FIFO_NAME,
+                 ring_words=SHM_RING_WORDS, chunk_words=FIFO_CHUNK_WORDS, policy="block", idle_sleep=1e-3,
+                 max_words=None):
+        """
+        :param link_kwargs: IPbusLink arguments for the readout process, e.g. {"device_uri": ...}.
+        :param reg_name_base: Register name base of the FIFO.
+        :param fifo_name: FIFO node name.
+        :param ring_words: Ring size, a power of two, unit: word.
+        :param chunk_words: Largest FIFO read, at most the FIFO depth.
+        :param policy: Ring full behind a blocking consumer. "block": stop reading the FIFO,
+                       "drop": keep reading it and discard the words, counted as dropped.
+        :param idle_sleep: Pause after an empty FIFO read, unit: s.
+        :param max_words: Stop after this many words. None: run until stop().
+        """
+        if policy not in ("block", "drop"):
+            raise ValueError('Unexpected ring policy: {}, should be "block" or "drop"'.format(policy))
+        if chunk_words not in range(1, FIFO_DEPTH + 1):
+            raise ValueError('Unexpected chunk size: {0}, should be 1-{1}'.format(chunk_words, FIFO_DEPTH))
+        self.link_kwargs = dict(link_kwargs or {})
+        self.reg_name_base = reg_name_base
+        self.fifo_name = fifo_name
+        self.chunk_words = chunk_words
+        self.policy = policy
+        self.idle_sleep = idle_sleep
+        self.max_words = max_words
+        # uhal and numpy threads do not survive fork
+        self._mp = multiprocessing.get_context("spawn")
+        self.ring = ShmRing.create(ring_words)
+        self._consumers = []
+        self._readout = None
+        self._t_start = None
+        self._t_stop = None
+
+    def add_consumer(self, func, *args, lossy=False, **kwargs):
+        """
+        :param func: Module level function, called as func(reader, *args, **kwargs) in a new process.
+        :param lossy: Do not hold the readout back for this consumer.
+        :return: Slot number of the consumer.
+        """
+        slot = len(self._consumers)
+        if slot >= self.ring.n_slots:
+            raise ValueError('Unexpected consumer count: at most {}'.format(self.ring.n_slots))
+        process = self._mp.Process(target=_consumer_main, args=(self.ring.name, slot, lossy, func, args, kwargs),
+                                   name="acq-consumer-{}".format(slot), daemon=True)
+        self._consumers.append((process, lossy))
+        return slot
+
+    def start(self):
+        """Start the consumers, wait until they are attached, then start the readout."""
+        for process, _ in self._consumers:
+            process.start()
+        t_stop = time.monotonic() + 30.0
+        while (self.ring.slots[:len(self._consumers), SLOT_STATE] == SLOT_FREE).any():
+            if time.monotonic() > t_stop or not all(process.is_alive() for process, _ in self._consumers):
+                self.stop()
+                raise RuntimeError('Consumer processes failed to attach to the ring')
+            time.sleep(1e-3)
+        self._t_start = time.perf_counter()
+        self._readout = self._mp.Process(target=_readout_main, name="acq-readout", daemon=True,
+                                         args=(self.ring.name, self.link_kwargs, self.reg_name_base, self.fifo_name,
+                                               self.chunk_words, self.policy, self.idle_sleep, self.max_words))
+        self._readout.start()
+        log.info("Acquisition started: readout pid {}, {} consumers, ring of {} words".format(
+            self._readout.pid, len(self._consumers), self.ring.capacity))
+
+    def stop(self):
+        """Ask the readout to finish; consumers finish once they have read everything."""
+        self.ring.request_stop()
+        if self._readout is None:
+            self.ring.close_writer()
+
+    def join(self, timeout=None):
+        """
+        :param timeout: Unit: s, per process.
+        :return: stats()
+        """
+        if self._readout is not None:
+            self._readout.join(timeout)
+            if self._readout.exitcode not in (0, None):
+                log.error("Readout process exited with code {}".format(self._readout.exitcode))
+        for process, _ in self._consumers:
+            if process.pid is not None:
+                process.join(timeout)
+        if self._t_stop is None:
+            self._t_stop = time.perf_counter()
+        stats = self.stats()
+        log.info("Acquisition: {produced} words, {dropped} dropped, {stalls} stalls ({stall_seconds:.3f} s), "
+                 "{rate_mbps:.2f} MB/s".format(**stats))
+        for consumer in stats["consumers"]:
+            if consumer["dropped"]:
+                log.warning("Consumer {slot} lost {dropped} words".format(**consumer))
+        return stats
+
+    def close(self):
+        self.stop()
+        self.join()
+        self.ring.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def elapsed(self):
+        if self._t_start is None:
+            return 0.0
+        t_stop = self._t_stop if self._t_stop is not None else time.perf_counter()
+        return t_stop - self._t_start
+
+    def stats(self):
+        """
+        :return: ShmRing.stats() plus elapsed time and the readout rate in MB/s.
+        """
+        stats = self.ring.stats()
+        elapsed = self.elapsed()
+        stats["elapsed"] = elapsed
+        stats["rate_mbps"] = stats["produced"] * FIFO_WORD_BYTES / elapsed / 1e6 if elapsed > 0 else 0.0
+        return stats
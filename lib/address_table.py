@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+CACHE_DIR_NAME = ".cache"
+CACHE_VERSION = 2
+
+_PERMISSIONS = {"r": "r", "read": "r", "w": "w", "write": "w", "rw": "rw", "readwrite": "rw"}
+
+
+class RegisterNode:
+    """
+    One leaf register of the address table, fully resolved.
+
+    `handle` is the matching uhal node. IPbusLink binds its own copy of the register,
+    see :meth:`bind`, the first time the register is used, so links sharing a table do not
+    share handles.
+    """
+    __slots__ = ("name", "address", "mask", "shift", "size", "mode", "permission", "tags", "volatile", "handle")
+
+    def __init__(self, name, address, mask=0xffffffff, size=1, mode="single", permission="rw", tags=""):
+        self.name = name
+        self.address = address
+        self.mask = mask
+        self.shift = (mask & -mask).bit_length() - 1
+        self.size = size
+        self.mode = mode
+        self.permission = permission
+        self.tags = tags
+        self.volatile = "volatile" in tags.split(",")
+        self.handle = None
+
+    def bind(self, handle):
+        """
+        :param handle: uhal node of one device.
+        :return: Copy of this register carrying `handle`.
+        """
+        node = RegisterNode.__new__(RegisterNode)
+        for slot in self.__slots__:
+            setattr(node, slot, getattr(self, slot))
+        node.handle = handle
+        return node
+
+    def to_dict(self):
+        return {"name": self.name, "address": self.address, "mask": self.mask, "size": self.size,
+                "mode": self.mode, "permission": self.permission, "tags": self.tags}
+
+    def __repr__(self):
+        return "RegisterNode({}, {:#010x}, mask={:#010x})".format(self.name, self.address, self.mask)
+
+
+class AddressTable:
+    """
+    Compiled uhal address table.
+
+    Parses the top level address file and every module it references, resolves each leaf
+    node to its absolute address, mask, size, mode and permission, and caches the result
+    next to the address file, keyed by the hashes of all files involved. A flattened copy
+    of the XML (modules inlined) is written alongside so uhal only has to parse one file.
+    """
+
+    def __init__(self, path, nodes, files, flat_path=None):
+        self.path = path
+        self.nodes = nodes
+        self.files = files
+        self.flat_path = flat_path
+
+    def __getitem__(self, name):
+        return self.nodes[name]
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def below(self, prefix):
+        """
+        All registers whose full name starts with `prefix`.
+
+        :param prefix: e.g. "dac8568_dev0."
+        :return: dict, name relative to prefix -> RegisterNode
+        """
+        n = len(prefix)
+        return {name[n:]: node for name, node in self.nodes.items() if name.startswith(prefix)}
+
+    @property
+    def flat_uri(self):
+        return "file://" + (self.flat_path if self.flat_path else self.path)
+
+    @classmethod
+    def load(cls, path, cache_dir=None, use_cache=True):
+        """
+        Load the compiled table for `path`, compiling it if the cache is missing or stale.
+
+        :param path: Top level address table, e.g. "etc/address.xml".
+        :param cache_dir: Where to keep compiled tables. Default: ".cache" next to `path`.
+        :param use_cache: False: always compile and do not touch the disk cache.
+        :return: AddressTable
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR_NAME)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        cache_path = os.path.join(cache_dir, stem + ".json")
+        flat_path = os.path.join(cache_dir, stem + ".flat.xml")
+
+        if use_cache:
+            table = cls._load_cache(path, cache_path, flat_path)
+            if table is not None:
+                log.debug("Address table loaded from cache {}".format(cache_path))
+                return table
+
+        table, flat_root = cls.compile(path)
+        if use_cache:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                ET.ElementTree(flat_root).write(flat_path, encoding="ISO-8859-1", xml_declaration=True)
+                with open(cache_path, "w") as f:
+                    json.dump({"version": CACHE_VERSION,
+                               "files": table.files,
+                               "nodes": [node.to_dict() for node in table]}, f)
+                table.flat_path = flat_path
+                log.info("Address table {} compiled to {}".format(path, cache_path))
+            except OSError as e:
+                log.warning("Can not write address table cache: {}".format(e))
+        return table
+
+    @classmethod
+    def _load_cache(cls, path, cache_path, flat_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("version") != CACHE_VERSION or not os.path.exists(flat_path):
+            return None
+        files = cached["files"]
+        if os.path.abspath(path) not in files:
+            return None
+        for file_path, digest in files.items():
+            try:
+                if _file_hash(file_path) != digest:
+                    return None
+            except OSError:
+                return None
+        nodes = {}
+        for entry in cached["nodes"]:
+            node = RegisterNode(**entry)
+            nodes[node.name] = node
+        return cls(path, nodes, files, flat_path)
+
+    @classmethod
+    def compile(cls, path):
+        """
+        Parse the address table without any caching.
+
+        :param path: Top level address table.
+        :return: (AddressTable, root element of the flattened XML)
+        """
+        files = {}
+        nodes = {}
+        modules = set()
+        root = cls._inline(path, files, modules)
+        for child in root:
+            cls._resolve(child, "", 0, nodes, modules)
+        return cls(path, nodes, files), root
+
+    @classmethod
+    def _inline(cls, path, files, modules):
+        """
+        Parse `path` and replace every module reference by the module content.
+
+        :param modules: Set the inlined module elements are added to.
+        """
+        path = os.path.abspath(path)
+        files[path] = _file_hash(path)
+        root = ET.parse(path).getroot()
+        base_dir = os.path.dirname(path)
+        for elem in list(root.iter("node")):
+            module = elem.get("module")
+            if module is None:
+                continue
+            module_path = module[len("file://"):] if module.startswith("file://") else module
+            module_root = cls._inline(os.path.join(base_dir, module_path), files, modules)
+            del elem.attrib["module"]
+            modules.add(elem)
+            for key, val in module_root.attrib.items():
+                if key not in ("id", "address"):
+                    elem.attrib.setdefault(key, val)
+            elem.extend(list(module_root))
+        return root
+
+    @classmethod
+    def _resolve(cls, elem, prefix, base_addr, nodes, modules):
+        name = prefix + elem.get("id")
+        address = base_addr + int(elem.get("address", "0"), 0)
+        children = elem.findall("node")
+        if children:
+            for child in children:
+                cls._resolve(child, name + ".", address, nodes, modules)
+            return
+        if elem in modules:
+            # Empty module, e.g. cee_dev: no registers, not a register itself
+            return
+        permission = elem.get("permission", "rw").lower()
+        if permission not in _PERMISSIONS:
+            raise ValueError('Unexpected permission "{}" for node {}'.format(permission, name))
+        nodes[name] = RegisterNode(name, address,
+                                   mask=int(elem.get("mask", "0xffffffff"), 0),
+                                   size=int(elem.get("size", "1"), 0),
+                                   mode=elem.get("mode", "single"),
+                                   permission=_PERMISSIONS[permission],
+                                   tags=elem.get("tags", ""))
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
@@ -0,0 +1,148 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.cee_spi_config import CeeSpiConfig
+from lib.dac8568_device import Dac8568Device
+from lib.ipbus_link import IPbusLink
+from lib.spi_device import SpiDevice
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class AsyncIPbusLink:
+    """
+    asyncio front-end of an IPbusLink.
+
+    Every call runs on a single I/O thread owned by this board, so calls to one board keep
+    their order and never block the event loop, and calls to different boards overlap.
+    The link takes its lock per access, so a call may wait for other threads using the link.
+
+    Example::
+
+        alink = AsyncIPbusLink(device_uri="ipbusudp-2.0://127.0.0.1:50001", address_table="etc/sim_address.xml")
+        dac = AsyncDac8568Device(alink, dev_nr=0)
+        await dac.set_volts([1.0] * 8)
+        words = await alink.read_ipb_data_fifo_chunk(DATA_FIFO_BASE, DATA_FIFO_NAME, 4096)
+    """
+
+    def __init__(self, ipbus_link=None, **kwargs):
+        """
+        :param ipbus_link: IPbusLink to wrap. Default: a new one built from `kwargs`.
+        :param kwargs: IPbusLink arguments.
+        """
+        self.link = ipbus_link if ipbus_link is not None else IPbusLink(**kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ipbus-" + self.link.device_id)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the I/O thread of this board.
+
+        :param func: Any callable using the link.
+        :return: Its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def w_reg(self, reg_name_base, reg_name, reg_val, is_pulse=False, go_dispatch=True):
+        return await self.call(self.link.w_reg, reg_name_base, reg_name, reg_val, is_pulse, go_dispatch)
+
+    async def r_reg(self, reg_name_base, reg_name):
+        return await self.call(self.link.r_reg, reg_name_base, reg_name)
+
+    async def dispatch(self):
+        """Flush everything queued with go_dispatch=False."""
+        return await self.call(self.link.dispatch)
+
+    async def batch(self, func, *args, **kwargs):
+        """
+        Run `func(*args, **kwargs)` inside IPbusLink.batch, as one dispatch.
+
+        :return: Result of `func`.
+        """
+        def batched():
+            with self.link.batch():
+                return func(*args, **kwargs)
+        return await self.call(batched)
+
+    async def read_ipb_data_fifo(self, reg_name_base, fifo_name, num, safe_mode, out=None):
+        return await self.call(self.link.read_ipb_data_fifo, reg_name_base, fifo_name, num, safe_mode, out)
+
+    async def read_ipb_data_fifo_chunk(self, reg_name_base, fifo_name, max_len, out=None):
+        return await self.call(self.link.read_ipb_data_fifo_chunk, reg_name_base, fifo_name, max_len, out)
+
+    async def read_ipb_data_fifo_pipelined(self, reg_name_base, fifo_name, max_len, out=None):
+        return await self.call(self.link.read_ipb_data_fifo_pipelined, reg_name_base, fifo_name, max_len, out)
+
+    async def write_ipb_slow_ctrl_fifo(self, reg_name_base, fifo_name, data_list):
+        return await self.call(self.link.write_ipb_slow_ctrl_fifo, reg_name_base, fifo_name, data_list)
+
+    async def upload_slow_ctrl_stream(self, reg_name_base, fifo_name, words, wait_drained=True, timeout=10.0):
+        return await self.call(self.link.upload_slow_ctrl_stream, reg_name_base, fifo_name, words, wait_drained,
+                               timeout)
+
+
+class AsyncDevice:
+    """
+    Awaitable view of a device class: every public method of the wrapped device becomes a
+    coroutine run on the board's I/O thread. Plain attributes are returned as they are.
+    """
+
+    def __init__(self, async_link, device):
+        self._async_link = async_link
+        self.device = device
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._async_link.call(attr, *args, **kwargs)
+        return method
+
+
+class AsyncDac8568Device(AsyncDevice):
+    def __init__(self, async_link, dev_nr):
+        AsyncDevice.__init__(self, async_link, Dac8568Device(async_link.link, dev_nr))
+
+
+class AsyncSpiDevice(AsyncDevice):
+    def __init__(self, async_link):
+        AsyncDevice.__init__(self, async_link, SpiDevice(async_link.link))
+
+
+class AsyncCeeSpiConfig(AsyncDevice):
+    """
+    CeeSpiConfig sets up the SPI master when it is built, so it is built on the I/O thread::
+
+        cee = await AsyncCeeSpiConfig.create(alink)
+    """
+
+    def __init__(self, async_link, cee_spi_config):
+        AsyncDevice.__init__(self, async_link, cee_spi_config)
+
+    @classmethod
+    async def create(cls, async_link):
+        """
+        :param async_link: AsyncIPbusLink.
+        :return: AsyncCeeSpiConfig on a CeeSpiConfig built by the board's I/O thread.
+        """
+        return cls(async_link, await async_link.call(CeeSpiConfig, async_link.link))
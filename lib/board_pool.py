@@ -0,0 +1,172 @@
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.address_table import AddressTable
+from lib.cee_spi_config import CeeSpiConfig
+from lib.dac8568_bank import Dac8568Bank
+from lib.global_device import GlobalDevice
+from lib.ipbus_link import IPbusLink
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+def load_connections(path):
+    """
+    Connections of a uhal connections file.
+
+    :param path: e.g. "etc/connections.xml".
+    :return: list of (connection id, uri, address table path); the address table path is
+             resolved against the directory of the connections file, as uhal does.
+    """
+    connections = []
+    base_dir = os.path.dirname(path)
+    for conn in ET.parse(path).getroot().iter("connection"):
+        conn_id = conn.get("id")
+        uri = conn.get("uri")
+        table = conn.get("address_table")
+        if not conn_id or not uri or not table:
+            raise ValueError('Unexpected connection in {}: {}'.format(path, conn.attrib))
+        if table.startswith("file://"):
+            table = table[len("file://"):]
+        connections.append((conn_id, uri, os.path.join(base_dir, table)))
+    return connections
+
+
+class Board:
+    """One board of the pool: its IPbusLink and device set."""
+
+    def __init__(self, conn_id, uri, address_table, shadow=True):
+        """
+        :param conn_id: Connection id, also the uhal device id.
+        :param uri: uhal URI.
+        :param address_table: AddressTable or file.
+        :param shadow: See IPbusLink.
+        """
+        self.id = conn_id
+        self.uri = uri
+        self.link = IPbusLink(device_uri=uri, shadow=shadow, device_id=conn_id, address_table=address_table)
+        self.global_dev = GlobalDevice(self.link)
+        self.cee = CeeSpiConfig(self.link)
+        self.dacs = Dac8568Bank(self.link, global_dev=self.global_dev)
+
+    def __repr__(self):
+        return "Board({}, {})".format(self.id, self.uri)
+
+
+class BoardPool:
+    """
+    Every board of a connections file, driven concurrently.
+
+    Work is run on all boards at once with one thread per board. uhal releases the GIL
+    while waiting for the network, so the total time follows the slowest board instead of
+    the sum of all boards.
+
+    Example::
+
+        with BoardPool("etc/connections.xml") as pool:
+            pool.run(lambda board: board.cee.apply_matrix(trim))
+            thresholds = pool.run(lambda board: make_scan(board).measure())
+    """
+
+    def __init__(self, connections="etc/connections.xml", ids=None, max_workers=None, shadow=True):
+        """
+        :param connections: uhal connections file.
+        :param ids: Connection ids to use. Default: all of them.
+        :param max_workers: Concurrent boards. Default: one thread per board.
+        :param shadow: See IPbusLink.
+        """
+        conns = load_connections(connections)
+        if ids is not None:
+            known = {conn[0] for conn in conns}
+            missing = [conn_id for conn_id in ids if conn_id not in known]
+            if missing:
+                raise ValueError('Unexpected connection ids: {}, not in {}'.format(missing, connections))
+            conns = [conn for conn in conns if conn[0] in ids]
+        # Boards sharing an address table share the compiled copy, loaded once here
+        tables = {}
+        for _, _, table in conns:
+            if table not in tables:
+                tables[table] = AddressTable.load(table)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or max(len(conns), 1),
+                                            thread_name_prefix="board")
+        self.timings = {}
+        self.boards = {}
+        boards = self._map(lambda conn: Board(conn[0], conn[1], tables[conn[2]], shadow),
+                           {conn[0]: conn for conn in conns})
+        for conn_id, _, _ in conns:
+            self.boards[conn_id] = boards[conn_id]
+        log.info("Board pool: {} boards from {}".format(len(self.boards), connections))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __len__(self):
+        return len(self.boards)
+
+    def __iter__(self):
+        return iter(self.boards.values())
+
+    def __getitem__(self, conn_id):
+        return self.boards[conn_id]
+
+    def _map(self, func, items, return_exceptions=False):
+        def timed(key, item):
+            t_start = time.perf_counter()
+            try:
+                return func(item)
+            finally:
+                self.timings[key] = time.perf_counter() - t_start
+
+        futures = {key: self._executor.submit(timed, key, item) for key, item in items.items()}
+        results = {}
+        errors = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    errors[key] = e
+                results[key] = e
+        if errors:
+            for key, e in errors.items():
+                log.error("Board {}: {!r}".format(key, e))
+            raise RuntimeError('Failed on boards {}'.format(sorted(errors))) from next(iter(errors.values()))
+        return results
+
+    def run(self, func, *args, return_exceptions=False, **kwargs):
+        """
+        Run `func(board, *args, **kwargs)` on every board concurrently.
+
+        The link lock is only taken per access by IPbusLink, so `func` may hand the link to
+        other threads, e.g. a FifoStreamReader, and wait for them.
+
+        :param func: Work for one board.
+        :param return_exceptions: Put exceptions into the results instead of raising once all boards are done.
+        :return: dict, connection id -> result, in connection file order.
+        """
+        def work(board):
+            return func(board, *args, **kwargs)
+
+        t_start = time.perf_counter()
+        results = self._map(work, self.boards, return_exceptions)
+        elapsed = time.perf_counter() - t_start
+        if self.timings:
+            log.debug("Board pool run: {:.3f} s, slowest board {:.3f} s, sum {:.3f} s".format(
+                elapsed, max(self.timings.values()), sum(self.timings.values())))
+        return results
@@ -0,0 +1,52 @@
+import logging
+
+import numpy as np
+
+from lib.cee_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+def hit_pixels(words):
+    """
+    Pixel addresses of the hit words in a block of data FIFO words, vectorized.
+
+    :param words: numpy.uint32 array.
+    :return: numpy.intp array of pixel addresses, other word types dropped.
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    hits = words[(words >> CEE_WORD_TYPE_SHIFT) == CEE_WORD_TYPE_HIT]
+    return (hits & CEE_HIT_PIXEL_MASK).astype(np.intp)
+
+
+def decode_hits(words):
+    """
+    Split the hit words of a block of data FIFO words into pixel address and payload, vectorized.
+
+    :param words: numpy.uint32 array.
+    :return: (numpy.intp array of pixel addresses, numpy.uint32 array of payloads), other word types dropped.
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    hits = words[(words >> CEE_WORD_TYPE_SHIFT) == CEE_WORD_TYPE_HIT]
+    return (hits & CEE_HIT_PIXEL_MASK).astype(np.intp), (hits >> CEE_HIT_PAYLOAD_SHIFT) & CEE_HIT_PAYLOAD_MASK
+
+
+def hit_counts(words, out=None):
+    """
+    Hits per pixel in a block of data FIFO words.
+
+    :param words: numpy.uint32 array.
+    :param out: Per-pixel counts to add to, CEE_PIXEL_NUM long. None: start from zero.
+    :return: numpy array of CEE_PIXEL_NUM counts, `out` if given.
+    """
+    counts = np.bincount(hit_pixels(words), minlength=CEE_PIXEL_NUM)
+    if out is None:
+        return counts
+    out += counts.astype(out.dtype, copy=False)
+    return out
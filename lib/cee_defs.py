@@ -0,0 +1,34 @@
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+## Defines for TopMetal-CEE slow control
+
+# One SPI frame: rw(1) addr(7) data(8)
+CEE_FRAME_BITS = 16
+CEE_FRAME_RW_SHIFT = 15
+CEE_FRAME_ADDR_SHIFT = 8
+
+# Pixel configuration registers
+CEE_REG_PIXEL_ADDR = 0x20
+CEE_REG_PIXEL_DAC_L8 = 0x21
+CEE_REG_PIXEL_CONF = 0x22  # we(7) pulse_en(6) mask(5:4) dac_h4(3:0)
+
+CEE_PIXEL_NUM = 256  # pixel_addr is one data byte
+CEE_TRIM_BITS = 12  # dac_h4:dac_l8
+CEE_MASK_BITS = 2
+
+# Frames sent back to back in one SPI transfer while ss stays asserted. Default one frame per
+# ss assertion; packing up to CEE_SPI_FRAMES_PER_TRANS_MAX (d0..d3 hold 128 bits) is opt-in,
+# once readback shows the chip latches every frame, see SpiDividerTuning.
+CEE_SPI_FRAMES_PER_TRANS = 1
+CEE_SPI_FRAMES_PER_TRANS_MAX = 8
+
+# Data FIFO words: type(31:28), for hits payload(27:8) pixel_addr(7:0)
+CEE_WORD_TYPE_SHIFT = 28
+CEE_WORD_TYPE_HIT = 0x1
+CEE_HIT_PIXEL_MASK = 0xff
+CEE_HIT_PAYLOAD_SHIFT = 8
+CEE_HIT_PAYLOAD_MASK = 0xfffff
+
+# Pixel mask value taking a pixel out of the readout
+CEE_MASK_OFF = 0x3
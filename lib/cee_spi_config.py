@@ -1,6 +1,11 @@
 import logging
 import time
 
+import numpy as np
+
+from lib.cee_defs import *
+from lib.instrumentation import instrumented
+from lib.spi_defs import *
 from lib.spi_device import SpiDevice
 
 logging.basicConfig(level=logging.INFO,
@@ -20,6 +25,16 @@ class CeeSpiConfig:
         self.spi_data = []
         self.spi_dev = SpiDevice(self._ipbus_link)
 
+        # Pixel configuration last sent to the chip, see apply_matrix
+        self.pixel_words = np.zeros(CEE_PIXEL_NUM, dtype=np.uint16)
+        self.pixel_known = np.zeros(CEE_PIXEL_NUM, dtype=bool)
+
+        # Frames per SPI transfer, see CEE_SPI_FRAMES_PER_TRANS
+        self.frames_per_trans = CEE_SPI_FRAMES_PER_TRANS
+
+        # Margin on the expected transfer time for the in-band busy wait, doubled on every miss
+        self.wait_margin = 1.25
+
         # self.reset_spi()
         self.spi_data = [0, 0, 0, 0, 0, 0, 0, 0]
         self.set_spi()
@@ -54,12 +69,7 @@ class CeeSpiConfig:
 
         :return:
         """
-        reg_name = "BUSY"
-        spi_busy = self.r_reg(reg_name)
-        if spi_busy == 1:
-            return True
-        else:
-            return False
+        return self.spi_dev.is_busy()
 
     def reset_spi(self, go_dispatch=True):
         """
@@ -96,10 +106,11 @@ class CeeSpiConfig:
         self.spi_dev.set_lsb(lsb)
         self.spi_dev.set_rx_neg(rx_neg)
         self.spi_dev.set_tx_neg(tx_neg)
-        self.spi_dev.w_div(div)
+        with self._ipbus_link.batch():
+            self.spi_dev.w_div(div)
+            self.spi_dev.w_ctrl()
+            self.spi_dev.w_ss(ss)
         self.spi_dev.r_div()
-        self.spi_dev.w_ctrl()
-        self.spi_dev.w_ss(ss)
 
     def start_spi_config(self):
         """
@@ -107,25 +118,481 @@ class CeeSpiConfig:
 
         :return:
         """
-        # if self.is_busy_spi():
-        #     log.error("SPI is busy now! Stop!")
-        # else:
-            # spi_data = self.set_spi_data()
-        self.spi_dev.w_data_regs(self.spi_data)
-        self.spi_dev.w_ctrl()
-        self.spi_dev.start()
+        # Writes to the data registers are ignored while the previous transfer runs
+        self.spi_dev.wait_ready()
+        with self._ipbus_link.batch():
+            self.spi_dev.w_data_regs(self.spi_data)
+            self.spi_dev.w_ctrl()
+            self.spi_dev.start()
+        # The transfer started before the dispatch returned
+        self.spi_dev.mark_started()
 
     def set_spi_data(self, trans_data):
         self.spi_data[0] = trans_data
 
+    @instrumented("cee_spi_trans")
     def cee_spi_trans(self, rw, addr, data):
         trans_data = (rw << 15) + (addr << 8) + data
         self.set_spi_data(trans_data)
         self.start_spi_config()
 
+    @instrumented("conf_pixel")
     def conf_pixel(self, pixel_addr, dac_h4, dac_l8, we, pulse_en, mask):
-        self.cee_spi_trans(rw=0, addr=0x20, data=pixel_addr)
-        self.cee_spi_trans(rw=0, addr=0x21, data=dac_l8)
-        self.cee_spi_trans(rw=0, addr=0x22, data=((we<<7))+(pulse_en<<6)+(mask<<4)+dac_h4)
+        self.cee_spi_trans(rw=0, addr=CEE_REG_PIXEL_ADDR, data=pixel_addr)
+        self.cee_spi_trans(rw=0, addr=CEE_REG_PIXEL_DAC_L8, data=dac_l8)
+        self.cee_spi_trans(rw=0, addr=CEE_REG_PIXEL_CONF, data=((we<<7))+(pulse_en<<6)+(mask<<4)+dac_h4)
+        self.pixel_words[pixel_addr] = (((we << 7) + (pulse_en << 6) + (mask << 4) + dac_h4) << 8) + dac_l8
+        self.pixel_known[pixel_addr] = True
+
+    @staticmethod
+    def encode_pixel_conf(trim, we=1, pulse_en=0, mask=0):
+        """
+        Pixel configuration of the whole matrix, vectorized.
+
+        Every argument is a scalar or an array of CEE_PIXEL_NUM values.
+
+        :param trim: 12-bit trim DAC, (dac_h4 << 8) | dac_l8.
+        :param we: Write enable, 0 or 1.
+        :param pulse_en: Test pulse enable, 0 or 1.
+        :param mask: Mask, 2 bits.
+        :return: numpy.uint16 array of CEE_PIXEL_NUM words, (CEE_REG_PIXEL_CONF data << 8) | dac_l8.
+        """
+        fields = {"trim": (trim, CEE_TRIM_BITS), "we": (we, 1), "pulse_en": (pulse_en, 1), "mask": (mask, CEE_MASK_BITS)}
+        values = {}
+        for name, (val, bits) in fields.items():
+            val = np.broadcast_to(np.asarray(val, dtype=np.int64), (CEE_PIXEL_NUM,))
+            if val.min() < 0 or val.max() >= (1 << bits):
+                raise ValueError('Unexpected {} value, should be 0-{}'.format(name, (1 << bits) - 1))
+            values[name] = val.astype(np.uint16)
+        conf = (values["we"] << 7) | (values["pulse_en"] << 6) | (values["mask"] << 4) | (values["trim"] >> 8)
+        return (conf << 8) | (values["trim"] & 0xff)
+
+    @staticmethod
+    def decode_pixel_conf(words):
+        """
+        Fields of pixel configuration words, the inverse of encode_pixel_conf.
+
+        :param words: Words from encode_pixel_conf, e.g. pixel_words.
+        :return: dict of numpy arrays: trim, we, pulse_en, mask.
+        """
+        words = np.asarray(words, dtype=np.uint16)
+        conf = words >> 8
+        return {"trim": ((conf & 0xf) << 8) | (words & 0xff), "we": (conf >> 7) & 0x1,
+                "pulse_en": (conf >> 6) & 0x1, "mask": (conf >> 4) & ((1 << CEE_MASK_BITS) - 1)}
+
+    @staticmethod
+    def pixel_frames(pixel_addrs, pixel_words):
+        """
+        SPI frames configuring a list of pixels, three per pixel as in conf_pixel.
+
+        :param pixel_addrs: Pixel addresses.
+        :param pixel_words: Words from encode_pixel_conf for those pixels.
+        :return: numpy.uint32 array of 16-bit frames.
+        """
+        pixel_addrs = np.asarray(pixel_addrs, dtype=np.uint32)
+        pixel_words = np.asarray(pixel_words, dtype=np.uint32)
+        frames = np.empty((len(pixel_addrs), 3), dtype=np.uint32)
+        frames[:, 0] = (CEE_REG_PIXEL_ADDR << CEE_FRAME_ADDR_SHIFT) | pixel_addrs
+        frames[:, 1] = (CEE_REG_PIXEL_DAC_L8 << CEE_FRAME_ADDR_SHIFT) | (pixel_words & 0xff)
+        frames[:, 2] = (CEE_REG_PIXEL_CONF << CEE_FRAME_ADDR_SHIFT) | (pixel_words >> 8)
+        return frames.ravel()
+
+    @staticmethod
+    def pack_frames(frames, frames_per_trans):
+        """
+        Pack 16-bit frames into d0..d3 words, `frames_per_trans` frames per transfer.
+
+        The core sends the top char_len bits MSB first, so the first frame of a transfer
+        sits in the highest bits.
+
+        :param frames: 16-bit frames, a multiple of frames_per_trans.
+        :param frames_per_trans: 1-8.
+        :return: numpy.uint32 array of shape (transfers, 4).
+        """
+        if frames_per_trans not in range(1, SPI_MAX_CHAR_LEN // CEE_FRAME_BITS + 1):
+            raise ValueError('Unexpected frames per transfer: {}'.format(frames_per_trans))
+        frames = np.asarray(frames, dtype=np.uint32).reshape(-1, frames_per_trans)
+        data = np.zeros((len(frames), 4), dtype=np.uint32)
+        for j in range(frames_per_trans):
+            shift = CEE_FRAME_BITS * (frames_per_trans - 1 - j)
+            data[:, shift // 32] |= frames[:, j] << np.uint32(shift % 32)
+        return data
+
+    @staticmethod
+    def unpack_frames(data, frames_per_trans):
+        """
+        Inverse of pack_frames: the frames held in d0..d3 after each transfer.
+
+        :param data: numpy.uint32 array of shape (transfers, 4).
+        :param frames_per_trans: 1-8.
+        :return: numpy.uint32 array of 16-bit frames in send order.
+        """
+        frames = np.empty((len(data), frames_per_trans), dtype=np.uint32)
+        for j in range(frames_per_trans):
+            shift = CEE_FRAME_BITS * (frames_per_trans - 1 - j)
+            frames[:, j] = (data[:, shift // 32] >> np.uint32(shift % 32)) & 0xffff
+        return frames.ravel()
+
+    def write_frames(self, frames, frames_per_trans=None, trans_per_dispatch=64):
+        """
+        Send a stream of CEE frames, packed into as few SPI transfers and dispatches as possible.
+
+        Between transfers an in-band wait (see SpiDevice.queue_busy_wait) sized from the
+        divider and transfer length keeps the next transfer from starting too early. The
+        last ctrl value of every wait is checked after the dispatch; if a transfer was
+        still busy the wait is doubled and the stream resumes at the last pixel address
+        written before the ignored transfer, see _restart_frame. Pixels overwritten by the
+        transfers that ran behind the ignored one are found by reading the matrix back and
+        sent again, see _repair_pixels. When that wait would exceed SPI_WAIT_READS_MAX, e.g. at
+        a slow divider, every transfer gets its own dispatch and the host waits for go_bsy.
+
+        :param frames: 16-bit frames in send order.
+        :param frames_per_trans: Frames per transfer. Default: the frames_per_trans attribute.
+        :param trans_per_dispatch: Transfers queued per dispatch.
+        :return: Number of SPI transfers.
+        """
+        return self._stream_frames(frames, frames_per_trans, trans_per_dispatch, readback=False)[0]
+
+    def transfer_frames(self, frames, frames_per_trans=None, trans_per_dispatch=64):
+        """
+        As write_frames, and also read d0..d3 after every transfer in the same dispatch.
+
+        :return: numpy.uint32 array with the frame received for every frame sent.
+        """
+        return self._stream_frames(frames, frames_per_trans, trans_per_dispatch, readback=True)[1]
+
+    def _stream_frames(self, frames, frames_per_trans, trans_per_dispatch, readback):
+        if frames_per_trans is None:
+            frames_per_trans = self.frames_per_trans
+        frames = np.asarray(frames, dtype=np.uint32)
+        # Pixel address writes: every CEE_REG_PIXEL_DAC_L8 / CEE_REG_PIXEL_CONF frame acts on the last one
+        addr_frames = np.flatnonzero((frames >> CEE_FRAME_ADDR_SHIFT) == CEE_REG_PIXEL_ADDR)
+        rx_frames = np.zeros(len(frames), dtype=np.uint32)
+
+        data_len = self.spi_dev.data_len
+        n_trans = 0
+        misses = 0
+        pos = 0
+        try:
+            while pos < len(frames):
+                n_frames = min(frames_per_trans, len(frames) - pos)
+                n_send = (len(frames) - pos) // n_frames * n_frames
+                data = self.pack_frames(frames[pos:pos + n_send], n_frames)
+                self.spi_dev.set_data_len(n_frames * CEE_FRAME_BITS)
+                rx = np.zeros_like(data) if readback else None
+                n_done = self._run_transfers(data, trans_per_dispatch, rx)
+                if readback:
+                    rx_frames[pos:pos + n_done * n_frames] = self.unpack_frames(rx[:n_done], n_frames)
+                n_trans += n_done
+                if n_done == len(data):
+                    pos += n_send
+                    continue
+                misses += 1
+                if misses > 8:
+                    raise RuntimeError('SPI transfer still busy after {} misses'.format(misses - 1))
+                self.wait_margin *= 2
+                pos = self._restart_frame(addr_frames, pos + n_done * n_frames)
+                log.warning("SPI busy longer than expected, wait margin raised to {}, resuming at frame {}".format(
+                    self.wait_margin, pos))
+        finally:
+            self.spi_dev.set_data_len(data_len)
+        if misses and not readback:
+            n_trans += self._repair_pixels(frames, frames_per_trans, trans_per_dispatch)
+        return n_trans, rx_frames
+
+    @staticmethod
+    def _restart_frame(addr_frames, first_missed):
+        """
+        Frame to resend from after the transfer holding frame `first_missed` was ignored.
+
+        The transfers queued behind an ignored one still ran, with the pixel address left
+        by the frames before it, so the stream restarts at the write of that address and
+        configures the pixel again.
+
+        :param addr_frames: Indices of the pixel address frames in the stream.
+        :param first_missed: Index of the first frame not sent.
+        :return: Frame index.
+        """
+        before = addr_frames[addr_frames < first_missed]
+        return int(before[-1]) if len(before) else first_missed
+
+    def _repair_pixels(self, frames, frames_per_trans, trans_per_dispatch):
+        """
+        Read back the pixels after a stream with a missed transfer and send the wrong ones again.
+
+        A transfer started while its data registers were half written sends whatever they
+        held, which may select any pixel, so every pixel with a known state is checked.
+
+        :param frames: Frames of the stream.
+        :return: SPI transfers spent on the repair.
+        """
+        if not np.any((frames >> CEE_FRAME_ADDR_SHIFT) == CEE_REG_PIXEL_CONF):
+            # Nothing in the stream latches a pixel
+            return 0
+        words, known = self._latched_words(frames)
+        pixels = np.flatnonzero(known)
+        if not len(pixels):
+            return 0
+        got = self.read_matrix(pixels, frames_per_trans)
+        bad = pixels[got != words[pixels]]
+        n_trans = len(pixels) * 3 // frames_per_trans
+        if len(bad):
+            log.warning("{} pixels overwritten by stray SPI transfers, sending them again".format(len(bad)))
+            n_trans += self.write_frames(self.pixel_frames(bad, words[bad]), frames_per_trans, trans_per_dispatch)
+        return n_trans
+
+    def _latched_words(self, frames):
+        """
+        Pixel configuration expected on the chip once a stream of frames went through.
+
+        :param frames: Frames in send order.
+        :return: (words as from encode_pixel_conf, mask of the pixels whose word is known)
+        """
+        words = self.pixel_words.copy()
+        known = self.pixel_known & ((words & 0x8000) != 0)
+        pixel = dac_l8 = None
+        for frame in frames.tolist():
+            if frame >> CEE_FRAME_RW_SHIFT:
+                continue
+            addr = (frame >> CEE_FRAME_ADDR_SHIFT) & 0x7f
+            data = frame & 0xff
+            if addr == CEE_REG_PIXEL_ADDR:
+                pixel = data
+            elif addr == CEE_REG_PIXEL_DAC_L8:
+                dac_l8 = data
+            elif addr == CEE_REG_PIXEL_CONF and data & 0x80 and pixel is not None and dac_l8 is not None:
+                words[pixel] = (data << 8) | dac_l8
+                known[pixel] = True
+        return words, known
 
+    def _run_transfers(self, data, trans_per_dispatch, rx=None):
+        """
+        Send packed transfers, see write_frames.
+
+        :param data: From pack_frames.
+        :param rx: Filled with d0..d3 after every transfer if given.
+        :return: Transfers done. Fewer than len(data) if one was still busy when the next was
+                 queued: that one and everything queued after it are then to be sent again.
+        """
+        n_regs = (self.spi_dev.char_len() + 31) // 32
+        wait_reads = int(self.spi_dev.transfer_cycles() * self.wait_margin) + 1
+        if wait_reads > SPI_WAIT_READS_MAX:
+            # Cheaper to wait on the host than to pad the dispatch with reads
+            return self._run_transfers_polled(data, n_regs, rx)
+        self.spi_dev.wait_ready()
+        self.spi_dev.set_go_busy()
+        i = 0
+        while i < len(data):
+            group = data[i:i + trans_per_dispatch]
+            waits = []
+            reads = []
+            with self._ipbus_link.batch():
+                for words in group:
+                    self.spi_dev.w_data_regs(words.tolist(), n_regs=n_regs)
+                    self.spi_dev.w_ctrl()
+                    waits.append(self.spi_dev.queue_busy_wait(wait_reads))
+                    if rx is not None:
+                        reads.append([self.spi_dev.r_reg("d" + str(k)) for k in range(n_regs)])
+            busy = [j for j, wait in enumerate(waits) if wait[wait_reads - 1] & SPI_CTRL_GO_BSY]
+            n_done = busy[0] if busy else len(group)
+            for j in range(n_done if rx is not None else 0):
+                rx[i + j, :n_regs] = [int(val) for val in reads[j]]
+            if not busy:
+                i += n_done
+                # go_bsy was clear in the last in-band read
+                self.spi_dev.mark_idle()
+                continue
+            # Transfers up to the first busy one were started, the one after it was ignored.
+            # The busy one is repeated when its received data is needed.
+            return i + (n_done if rx is not None else n_done + 1)
+        return len(data)
+
+    def _run_transfers_polled(self, data, n_regs, rx=None):
+        """
+        Send packed transfers one dispatch each, with SpiDevice.wait_ready before the next one.
+
+        :return: len(data), no transfer can be ignored.
+        """
+        self.spi_dev.set_go_busy()
+        for i, words in enumerate(data):
+            self.spi_dev.wait_ready()
+            with self._ipbus_link.batch():
+                self.spi_dev.w_data_regs(words.tolist(), n_regs=n_regs)
+                self.spi_dev.w_ctrl()
+            self.spi_dev.mark_started()
+            if rx is not None:
+                self.spi_dev.wait_ready()
+                with self._ipbus_link.batch():
+                    reads = [self.spi_dev.r_reg("d" + str(k)) for k in range(n_regs)]
+                rx[i, :n_regs] = [int(val) for val in reads]
+        return len(data)
+
+    @instrumented("conf_matrix")
+    def conf_matrix(self, trim, we=1, pulse_en=0, mask=0, pixels=None, frames_per_trans=None):
+        """
+        Configure many pixels at once, see encode_pixel_conf for the arguments.
+
+        :param pixels: Pixel addresses to send. Default: the whole matrix.
+        :param frames_per_trans: Frames per SPI transfer. Default: the frames_per_trans attribute.
+        :return: dict with pixels, transfers, seconds and pixels_per_s.
+        """
+        words = self.encode_pixel_conf(trim, we, pulse_en, mask)
+        pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels, dtype=np.intp)
+        return self._send_pixels(words, pixels, frames_per_trans)
+
+    def _send_pixels(self, words, pixels, frames_per_trans):
+        t_start = time.perf_counter()
+        n_trans = self.write_frames(self.pixel_frames(pixels, words[pixels]), frames_per_trans)
+        self.pixel_words[pixels] = words[pixels]
+        self.pixel_known[pixels] = True
+        elapsed = time.perf_counter() - t_start
+        stats = {"pixels": len(pixels), "transfers": n_trans, "seconds": elapsed,
+                 "pixels_per_s": len(pixels) / elapsed if elapsed > 0 else float("inf")}
+        log.info("Configured {} pixels with {} SPI transfers in {:.3f} s, {:.0f} pixels/s".format(
+            stats["pixels"], n_trans, elapsed, stats["pixels_per_s"]))
+        return stats
+
+    @instrumented("apply_matrix")
+    def apply_matrix(self, trim, we=1, pulse_en=0, mask=0, force=False, frames_per_trans=None):
+        """
+        Bring the matrix to a configuration, sending only the pixels that differ from what was sent before.
+
+        Arguments as in encode_pixel_conf.
+
+        :param force: Send every pixel regardless of the stored state.
+        :param frames_per_trans: Frames per SPI transfer. Default: the frames_per_trans attribute.
+        :return: dict as conf_matrix, plus the number of pixels skipped.
+        """
+        words = self.encode_pixel_conf(trim, we, pulse_en, mask)
+        changed = self.changed_pixels(words) if not force else np.arange(CEE_PIXEL_NUM)
+        if len(changed):
+            stats = self._send_pixels(words, changed, frames_per_trans)
+        else:
+            stats = {"pixels": 0, "transfers": 0, "seconds": 0.0, "pixels_per_s": 0.0}
+        stats["skipped"] = CEE_PIXEL_NUM - len(changed)
+        log.info("Pixel config applied: {} sent, {} unchanged".format(len(changed), stats["skipped"]))
+        return stats
+
+    def changed_pixels(self, words):
+        """
+        Pixels whose configuration word differs from the stored state, or was never sent.
+
+        :param words: Words from encode_pixel_conf.
+        :return: numpy array of pixel addresses.
+        """
+        return np.flatnonzero(~self.pixel_known | (self.pixel_words != words))
+
+    def forget_pixel_state(self):
+        """
+        Drop the stored pixel state, e.g. after the chip was power cycled, so the next apply sends everything.
+
+        :return: None
+        """
+        self.pixel_known[:] = False
+
+    def save_pixel_state(self, path):
+        """
+        Save the stored pixel state.
+
+        :param path: .npz file.
+        :return: None
+        """
+        np.savez(path, pixel_words=self.pixel_words, pixel_known=self.pixel_known)
+
+    def load_pixel_state(self, path, verify=False):
+        """
+        Restore a pixel state saved with save_pixel_state, e.g. after a warm restart of the software.
+
+        :param path: .npz file.
+        :param verify: Read the matrix back and forget the pixels that do not match, so the next apply resends them.
+        :return: None, or the verify_matrix report when verify is set.
+        """
+        with np.load(path) as state:
+            pixel_words = state["pixel_words"]
+            pixel_known = state["pixel_known"]
+        if pixel_words.shape != (CEE_PIXEL_NUM,) or pixel_known.shape != (CEE_PIXEL_NUM,):
+            raise ValueError('Unexpected pixel state in {}: {} pixels'.format(path, pixel_words.shape))
+        self.pixel_words[:] = pixel_words
+        self.pixel_known[:] = pixel_known
+        if verify:
+            report = self.verify_matrix()
+            self.pixel_known[report["pixels"]] = False
+            return report
+
+    @instrumented("cee_read_registers")
+    def read_registers(self, addrs, frames_per_trans=None):
+        """
+        Read CEE registers in bulk.
+
+        :param addrs: Register addresses.
+        :return: numpy.uint8 array of values.
+        """
+        addrs = np.asarray(addrs, dtype=np.uint32)
+        frames = (1 << CEE_FRAME_RW_SHIFT) | (addrs << CEE_FRAME_ADDR_SHIFT)
+        return (self.transfer_frames(frames, frames_per_trans) & 0xff).astype(np.uint8)
+
+    def verify_registers(self, expected, frames_per_trans=None):
+        """
+        Read back CEE registers and compare them with their expected values.
+
+        :param expected: dict, register address -> value.
+        :return: dict with "checked" and the mismatching "addrs" with their "expected" and "read" values.
+        """
+        addrs = np.array(sorted(expected), dtype=np.uint32)
+        want = np.array([expected[addr] for addr in addrs.tolist()], dtype=np.uint8)
+        got = self.read_registers(addrs, frames_per_trans)
+        bad = np.flatnonzero(got != want)
+        report = {"checked": len(addrs), "addrs": addrs[bad], "expected": want[bad], "read": got[bad]}
+        self._log_report("CEE registers", report, "addrs")
+        return report
+
+    @instrumented("cee_read_matrix")
+    def read_matrix(self, pixels=None, frames_per_trans=None):
+        """
+        Read back pixel configurations: select each pixel through CEE_REG_PIXEL_ADDR, then
+        read CEE_REG_PIXEL_DAC_L8 and CEE_REG_PIXEL_CONF.
+
+        :param pixels: Pixel addresses. Default: the whole matrix.
+        :return: numpy.uint16 array of words as from encode_pixel_conf.
+        """
+        pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels, dtype=np.intp)
+        frames = np.empty((len(pixels), 3), dtype=np.uint32)
+        frames[:, 0] = (CEE_REG_PIXEL_ADDR << CEE_FRAME_ADDR_SHIFT) | pixels.astype(np.uint32)
+        frames[:, 1] = (1 << CEE_FRAME_RW_SHIFT) | (CEE_REG_PIXEL_DAC_L8 << CEE_FRAME_ADDR_SHIFT)
+        frames[:, 2] = (1 << CEE_FRAME_RW_SHIFT) | (CEE_REG_PIXEL_CONF << CEE_FRAME_ADDR_SHIFT)
+        rx = self.transfer_frames(frames.ravel(), frames_per_trans).reshape(-1, 3) & 0xff
+        return ((rx[:, 2] << 8) | rx[:, 1]).astype(np.uint16)
+
+    def verify_matrix(self, pixels=None, expected=None, frames_per_trans=None):
+        """
+        Read back pixel configurations and compare them with the expected words.
+
+        Pixels whose expected word has `we` clear are not checked, the chip keeps its old
+        configuration for them.
+
+        :param pixels: Pixel addresses. Default: every pixel with a known state.
+        :param expected: Words from encode_pixel_conf for the whole matrix. Default: the stored state.
+        :return: dict with "checked" and the mismatching "pixels" with their "expected" and "read" words.
+        """
+        if expected is None:
+            expected = self.pixel_words
+            if pixels is None:
+                pixels = np.flatnonzero(self.pixel_known)
+        expected = np.asarray(expected, dtype=np.uint16)
+        pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels, dtype=np.intp)
+        pixels = pixels[(expected[pixels] & 0x8000) != 0]
+        got = self.read_matrix(pixels, frames_per_trans)
+        bad = np.flatnonzero(got != expected[pixels])
+        report = {"checked": len(pixels), "pixels": pixels[bad], "expected": expected[pixels][bad], "read": got[bad]}
+        self._log_report("Pixel config", report, "pixels")
+        return report
 
+    @staticmethod
+    def _log_report(what, report, key):
+        n_bad = len(report[key])
+        if n_bad == 0:
+            log.info("{} verified: {} checked, all match".format(what, report["checked"]))
+            return
+        log.warning("{} verify: {} of {} mismatch".format(what, n_bad, report["checked"]))
+        for where, want, got in list(zip(report[key], report["expected"], report["read"]))[:16]:
+            log.warning("  {:#04x}: expected {:#06x}, read {:#06x}".format(int(where), int(want), int(got)))
@@ -0,0 +1,117 @@
+import logging
+
+import numpy as np
+
+from lib.cee_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+## Slow control command words drained from the WFIFO
+# Proposed format: the current firmware does not execute it, only lib/ipbus_sim.py does
+# (IPbusSimulator(cmd_stream=True), ./sim.py --cmd-stream). IPbusLink.upload_slow_ctrl_stream
+# refuses to upload unless the link's cmd_stream attribute is set.
+#   [31:28] command
+#   CMD_CEE_FRAME:   [15:0] CEE SPI frame, rw(1) addr(7) data(8)
+#   CMD_DAC_DATA:    [27:24] DAC device, [19:16] channel, [15:0] data
+#   CMD_DAC_START:   [27:24] DAC device, [7:0] channel map
+#   CMD_WAIT:        [23:0] IPbus clock cycles
+CMD_SHIFT = 28
+CMD_CEE_FRAME = 0x1
+CMD_DAC_DATA = 0x2
+CMD_DAC_START = 0x3
+CMD_WAIT = 0x4
+
+CMD_DEV_SHIFT = 24
+CMD_CH_SHIFT = 16
+
+
+class CommandStream:
+    """
+    Slow control commands compiled into a word stream for IPbusLink.upload_slow_ctrl_stream.
+
+    Only for firmware executing the format above.
+
+    Example::
+
+        ipbus_link.cmd_stream = True
+        stream = CommandStream()
+        stream.cee_frames(cee_spi_dev.pixel_frames(pixels, words))
+        stream.dac_data(dev_nr=0, ch=0, data=0x6666)
+        stream.dac_start(dev_nr=0, sel_ch=0x01)
+        ipbus_link.upload_slow_ctrl_stream(DATA_FIFO_BASE, CTRL_FIFO_NAME, stream.words())
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._n_words = 0
+
+    def __len__(self):
+        return self._n_words
+
+    def _append(self, words):
+        words = np.asarray(words, dtype=np.uint32).ravel()
+        self._parts.append(words)
+        self._n_words += len(words)
+
+    def cee_frames(self, frames):
+        """
+        Append CEE SPI frames.
+
+        :param frames: 16-bit frames, e.g. from CeeSpiConfig.pixel_frames.
+        :return: self
+        """
+        frames = np.asarray(frames, dtype=np.uint32)
+        if frames.size and frames.max() > 0xffff:
+            raise ValueError('Unexpected CEE frame, should be 16 bits')
+        self._append((CMD_CEE_FRAME << CMD_SHIFT) | frames)
+        return self
+
+    def cee_trans(self, rw, addr, data):
+        """Append one CEE SPI transaction, as CeeSpiConfig.cee_spi_trans."""
+        return self.cee_frames([(rw << CEE_FRAME_RW_SHIFT) | (addr << CEE_FRAME_ADDR_SHIFT) | data])
+
+    def dac_data(self, dev_nr, ch, data):
+        """
+        Append DAC8568 channel data, channel and data may be arrays.
+
+        :param dev_nr: DAC device 0 or 1.
+        :param ch: Channel 0-7.
+        :param data: 16-bit DAC code.
+        :return: self
+        """
+        ch = np.asarray(ch, dtype=np.uint32)
+        data = np.asarray(data, dtype=np.uint32)
+        if dev_nr not in range(0, 16) or (ch.size and ch.max() > 7) or (data.size and data.max() > 0xffff):
+            raise ValueError('Unexpected DAC command: dev {} ch {} data {}'.format(dev_nr, ch, data))
+        self._append((CMD_DAC_DATA << CMD_SHIFT) | (dev_nr << CMD_DEV_SHIFT) | (ch << CMD_CH_SHIFT) | data)
+        return self
+
+    def dac_start(self, dev_nr, sel_ch=0xff):
+        """Append a DAC8568 conversion start for the channels in `sel_ch`."""
+        if dev_nr not in range(0, 16) or sel_ch not in range(0, 256):
+            raise ValueError('Unexpected DAC start: dev {} sel_ch {}'.format(dev_nr, sel_ch))
+        self._append([(CMD_DAC_START << CMD_SHIFT) | (dev_nr << CMD_DEV_SHIFT) | sel_ch])
+        return self
+
+    def wait(self, cycles):
+        """Append a pause of `cycles` IPbus clock cycles in the firmware."""
+        if cycles not in range(0, 1 << 24):
+            raise ValueError('Unexpected wait: {} cycles'.format(cycles))
+        self._append([(CMD_WAIT << CMD_SHIFT) | cycles])
+        return self
+
+    def words(self):
+        """
+        :return: numpy.uint32 array of all commands in order.
+        """
+        if not self._parts:
+            return np.zeros(0, dtype=np.uint32)
+        if len(self._parts) > 1:
+            self._parts = [np.concatenate(self._parts)]
+        return self._parts[0]
@@ -0,0 +1,98 @@
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class CompletionWaiter:
+    """
+    Wait for a busy flag to clear.
+
+    The flag can not clear before the operation's expected duration, so the waiter first
+    sleeps that long (scaled by what past waits showed), then polls with an interval that
+    grows geometrically up to `max_interval` until the flag clears or `timeout` expires.
+    Poll counts and wait times are kept as metrics.
+    """
+
+    def __init__(self, name, min_interval=20e-6, max_interval=5e-3, growth=2.0, learn_rate=0.2):
+        """
+        :param name: Shown in logs and metrics.
+        :param min_interval: First poll interval after the expected time, unit: s.
+        :param max_interval: Largest poll interval, unit: s.
+        :param growth: Interval factor between polls.
+        :param learn_rate: Weight of the last wait in the running ratio of actual to expected time.
+        """
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.learn_rate = learn_rate
+        # Running ratio of the time the flag really took to the expected time
+        self.scale = 1.0
+
+        self.calls = 0
+        self.polls = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.last_polls = 0
+
+    def wait(self, is_busy, expected_time=0.0, timeout=1.0):
+        """
+        :param is_busy: Callable returning True while the operation runs, one bus read.
+        :param expected_time: Expected duration of the operation, unit: s.
+        :param timeout: Give up after this long, unit: s.
+        :return: Time waited, unit: s.
+        """
+        t_start = time.perf_counter()
+        first_sleep = expected_time * min(self.scale, 1.0) * 0.9
+        if first_sleep > 0:
+            time.sleep(first_sleep)
+        interval = max(self.min_interval, expected_time / 8)
+        polls = 0
+        while True:
+            polls += 1
+            if not is_busy():
+                break
+            if time.perf_counter() - t_start > timeout:
+                self.timeouts += 1
+                self._account(polls, time.perf_counter() - t_start, expected_time)
+                raise TimeoutError('{} still busy after {:.3f} s'.format(self.name, timeout))
+            time.sleep(interval)
+            interval = min(interval * self.growth, self.max_interval)
+        waited = time.perf_counter() - t_start
+        self._account(polls, waited, expected_time)
+        return waited
+
+    def _account(self, polls, waited, expected_time):
+        self.calls += 1
+        self.polls += polls
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.last_wait = waited
+        self.last_polls = polls
+        if expected_time > 0:
+            self.scale += self.learn_rate * (waited / expected_time - self.scale)
+
+    def metrics(self):
+        return {"calls": self.calls, "polls": self.polls, "timeouts": self.timeouts,
+                "total_wait": self.total_wait, "max_wait": self.max_wait,
+                "mean_wait": self.total_wait / self.calls if self.calls else 0.0,
+                "polls_per_call": self.polls / self.calls if self.calls else 0.0,
+                "last_wait": self.last_wait, "last_polls": self.last_polls}
+
+    def reset_metrics(self):
+        self.calls = 0
+        self.polls = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.last_polls = 0
@@ -0,0 +1,99 @@
+import logging
+
+import numpy as np
+
+from lib.dac8568_defs import *
+from lib.dac8568_device import Dac8568Device
+from lib.global_device import GlobalDevice
+from lib.instrumentation import instrumented
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class Dac8568Bank:
+    """
+    All DAC8568 devices of the board driven together.
+
+    The data words of every device are written in one dispatch together with the start of
+    the first device. Every further device is selected with dac_nr and started once busy of
+    the previous one has been polled clear, so dac_nr never changes under a running
+    conversion.
+
+    Example::
+
+        bank = Dac8568Bank(ipbus_link)
+        bank.set_volts([[1.0] * 8, [0.5] * 8])
+    """
+
+    def __init__(self, ipbus_link, global_dev=None, dev_nrs=(0, 1)):
+        """
+        :param ipbus_link: IPbusLink.
+        :param global_dev: GlobalDevice for dac_nr. Default: a new one on `ipbus_link`.
+        :param dev_nrs: DAC device numbers, in the order voltages are given.
+        """
+        self._ipbus_link = ipbus_link
+        self.global_dev = global_dev if global_dev is not None else GlobalDevice(ipbus_link)
+        self.dev_nrs = list(dev_nrs)
+        self.devices = [Dac8568Device(ipbus_link, dev_nr) for dev_nr in self.dev_nrs]
+
+    def set_volts(self, volts):
+        """
+        Set every channel of every device and start the conversions.
+
+        :param volts: Array of shape (number of devices, DAC8568_CH_NUM), unit: V.
+        :return: numpy.uint16 array of the codes written, same shape.
+        """
+        volts = np.asarray(volts, dtype=np.float64)
+        if volts.shape != (len(self.devices), DAC8568_CH_NUM):
+            raise ValueError('Unexpected voltage array shape: {0}, should be {1}'.format(
+                volts.shape, (len(self.devices), DAC8568_CH_NUM)))
+        # Check everything before the first write
+        codes = Dac8568Device.volts_2_codes(volts)
+        chs = np.arange(DAC8568_CH_NUM)
+        self.update([(dev_nr, chs, dev_codes) for dev_nr, dev_codes in zip(self.dev_nrs, codes)])
+        return codes
+
+    @instrumented("dac_bank_update")
+    def update(self, changes):
+        """
+        Write channel codes and start the conversions of several devices.
+
+        :param changes: List of (dev_nr, channels, codes), devices are started in this order.
+                        Only the listed channels are selected for the conversion.
+        :return: None
+        """
+        devices = [self.devices[self.dev_nrs.index(dev_nr)] for dev_nr, _, _ in changes]
+        for device in devices:
+            device.wait_ready()
+
+        if not changes:
+            return
+        with self._ipbus_link.batch():
+            for device, (_, chs, codes) in zip(devices, changes):
+                device.queue_data(chs, codes)
+            self._start(devices[0], changes[0][0], changes[0][1])
+        for i in range(1, len(changes)):
+            devices[i - 1].wait_idle()
+            with self._ipbus_link.batch():
+                self._start(devices[i], changes[i][0], changes[i][1])
+
+    def _start(self, device, dev_nr, chs):
+        self.global_dev.set_dac_nr(dev_nr)
+        device.select_ch(int(np.bitwise_or.reduce(1 << np.asarray(chs, dtype=np.int64))))
+        device.start_conv()
+
+    def set_volt(self, dev_nr, ch, volt):
+        """
+        Set one channel through the bank, the other channels keep their codes.
+
+        :return: DAC code written.
+        """
+        code = Dac8568Device.volts_2_codes([volt])
+        self.update([(dev_nr, [ch], code)])
+        return int(code[0])
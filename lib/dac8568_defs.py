@@ -4,3 +4,7 @@ __email__ = "s.dong@mails.ccnu.edu.cn"
 ## Defines for DAC8568
 
 DAC8568_REF_VOLT = 2.5  # unit: Volt
+DAC8568_CH_NUM = 8
+DAC8568_CODE_MAX = 0xffff
+DAC8568_BUSY_TIMEOUT = 10e-3  # unit: s
+DAC8568_SETTLE_TIME = 10e-6  # unit: s, output settling after an update
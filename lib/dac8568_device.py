@@ -1,5 +1,7 @@
 import logging
 
+import numpy as np
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
@@ -9,11 +11,19 @@ __author__ = "Sheng Dong"
 __email__ = "s.dong@mails.ccnu.edu.cn"
 
 from lib.dac8568_defs import *
+from lib.instrumentation import instrumented
 
 class Dac8568Device:
     def __init__(self, ipbus_link, dev_nr):
         self.reg_name_base = "dac8568_dev" + str(dev_nr) + "."
         self._ipbus_link = ipbus_link
+        self._nodes = ipbus_link.nodes(self.reg_name_base)
+
+        self.sel_ch = 0xff
+        self.waiter = ipbus_link.waiter("dac8568_dev" + str(dev_nr))
+        # A conversion was started and busy has not been seen clear since.
+        # Read and written under the link lock, threads may share this device.
+        self._started = False
 
     def w_reg(self, reg_name, reg_val, is_pulse, go_dispatch):
         """ 
@@ -25,8 +35,7 @@ class Dac8568Device:
         :param go_dispatch:
         :return:
         """
-        self._ipbus_link.w_reg(self.reg_name_base, reg_name,
-                               reg_val, is_pulse, go_dispatch)
+        self._ipbus_link.w_node(self._nodes[reg_name], reg_val, is_pulse, go_dispatch)
 
     def r_reg(self, reg_name):
         """ 
@@ -35,7 +44,7 @@ class Dac8568Device:
         :param reg_name:
         :return:
         """
-        self._ipbus_link.r_reg(self.reg_name_base, reg_name)
+        return self._ipbus_link.r_node(self._nodes[reg_name])
 
     def is_busy(self):
         reg_name = "busy"
@@ -45,14 +54,65 @@ class Dac8568Device:
         reg_name = "rst_n"
         self.w_reg(reg_name, 0, is_pulse=True, go_dispatch=True)
 
-    def start_conv(self):
+    def start_conv(self, wait=False):
+        """
+        Start the conversion of the selected channels.
+
+        :param wait: Return once the DAC is idle again. Not possible inside a batch.
+        :return:
+        """
         reg_name = "start"
+        if not self._ipbus_link.in_batch():
+            # Inside a batch a poll would dispatch it, the caller waits for the last conversion first
+            self.wait_ready()
         self.w_reg(reg_name, 0, is_pulse=True, go_dispatch=True)
+        self.mark_started()
+        if wait and not self._ipbus_link.in_batch():
+            self.wait_idle()
+
+    def mark_idle(self):
+        """Note that the last conversion is known to be over."""
+        with self._ipbus_link.lock:
+            self._started = False
+
+    def mark_started(self):
+        """Note that a conversion was started, for :meth:`wait_ready`."""
+        with self._ipbus_link.lock:
+            self._started = True
+
+    @instrumented("dac_wait_idle")
+    def wait_idle(self, timeout=DAC8568_BUSY_TIMEOUT):
+        """
+        Wait for the running conversion to finish by polling busy.
+
+        The firmware does not define the clock of the DAC8568 controller, so the conversion
+        time is not estimated.
+
+        :param timeout: Unit: s.
+        :return: Time waited, unit: s.
+        """
+        waited = self.waiter.wait(self.is_busy, 0.0, timeout)
+        self.mark_idle()
+        return waited
+
+    def wait_ready(self, timeout=DAC8568_BUSY_TIMEOUT):
+        """
+        Wait before the next conversion: poll busy, unless it was seen clear since the last start.
+
+        :param timeout: Unit: s.
+        :return: Time waited, unit: s.
+        """
+        with self._ipbus_link.lock:
+            started = self._started
+        if not started:
+            return 0.0
+        return self.wait_idle(timeout)
 
     def select_ch(self, ch):
         """ 8bit channel map """
         reg_name = "sel_ch"
         self.w_reg(reg_name, reg_val=ch, is_pulse=False, go_dispatch=True)
+        self.sel_ch = ch
 
     def set_data(self, ch, data):
         """
@@ -62,9 +122,67 @@ class Dac8568Device:
         reg_name = "data_ch" + str(ch)
         self.w_reg(reg_name, reg_val=data, is_pulse=False, go_dispatch=True)
     
+    @instrumented("set_volt")
     def set_volt(self, ch, volt):
         self.set_data(ch, self.anaVal_2_digVal(volt))
 
+    @instrumented("set_volts")
+    def set_volts(self, volts, chs=None, start=True):
+        """
+        Set several channels and start their conversion in one dispatch.
+
+        Both halves of a data word written in the same batch are merged by IPbusLink into
+        a single word write, and channels already holding their code are not written again.
+
+        :param volts: Voltages, one per channel in `chs`.
+        :param chs: Channels 0-7. Default: all DAC8568_CH_NUM channels.
+        :param start: Select the channels and start the conversion in the same batch.
+        :return: numpy.uint16 array of the codes written.
+        """
+        if chs is None:
+            chs = np.arange(DAC8568_CH_NUM)
+        chs = np.asarray(chs, dtype=np.int64).ravel()
+        codes = self.volts_2_codes(volts).ravel()
+        if len(codes) != len(chs):
+            raise ValueError('Unexpected number of voltages: {0}, should be {1}'.format(len(codes), len(chs)))
+        if chs.size and (chs.min() < 0 or chs.max() >= DAC8568_CH_NUM):
+            raise ValueError('Unexpected channel: {}'.format(chs))
+        if start and not self._ipbus_link.in_batch():
+            self.wait_ready()
+        with self._ipbus_link.batch():
+            self.queue_data(chs, codes)
+            if start:
+                self.select_ch(int(np.bitwise_or.reduce(1 << chs)) if chs.size else 0)
+                self.start_conv()
+        return codes
+
+    def queue_data(self, chs, codes):
+        """
+        Write channel codes without dispatching, for use inside a batch.
+
+        :param chs: Channels 0-7.
+        :param codes: 16-bit codes, e.g. from volts_2_codes.
+        :return:
+        """
+        for ch, code in zip(chs, codes):
+            self.w_reg("data_ch" + str(int(ch)), reg_val=int(code), is_pulse=False, go_dispatch=False)
+
+    @staticmethod
+    def volts_2_codes(volts):
+        """
+        Vectorized anaVal_2_digVal.
+
+        :param volts: Scalar or array of voltages, 0 to DAC8568_REF_VOLT.
+        :return: numpy.uint16 array of the same shape.
+        """
+        volts = np.asarray(volts, dtype=np.float64)
+        bad = ~((volts >= .0) & (volts <= DAC8568_REF_VOLT))
+        if bad.any():
+            raise ValueError(
+                'Unexpected analog output value: {0}, should be less than reference voltage'.format(volts[bad]))
+        codes = np.minimum(np.floor(volts * (2 ** 16) / DAC8568_REF_VOLT), DAC8568_CODE_MAX)
+        return codes.astype(np.uint16)
+
     @staticmethod
     def anaVal_2_digVal(anaVal):
         """
@@ -76,6 +194,6 @@ class Dac8568Device:
         if anaVal > DAC8568_REF_VOLT or anaVal < .0:
             raise ValueError(
                 'Unexpected analog output value: {0}, should be less than reference voltage'.format(anaVal))
-        digVal = int((2 ** 16) * anaVal / DAC8568_REF_VOLT)
+        digVal = min(int((2 ** 16) * anaVal / DAC8568_REF_VOLT), DAC8568_CODE_MAX)
         log.debug("Convert analog to digital: {:f} {:d}".format(anaVal, digVal))
         return digVal
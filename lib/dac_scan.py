@@ -0,0 +1,143 @@
+import logging
+import time
+
+import numpy as np
+
+from lib.dac8568_defs import *
+from lib.dac8568_device import Dac8568Device
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class DacScan:
+    """
+    Scan over DAC8568 voltage settings.
+
+    Every point is one (dev_nr, ch, volt) setting or a list of settings applied together.
+    Points are regrouped by device so dac_nr changes as rarely as possible, channels that
+    already hold their code are neither written nor converted again, and every point is
+    set through one :meth:`Dac8568Bank.update`.
+
+    At each point `callback(point)` runs once the outputs have settled. The optional
+    `readout(point)` of the previous point runs while the current one settles, e.g. to
+    drain the data FIFO.
+
+    Example::
+
+        points = [(0, 3, v) for v in np.linspace(0.2, 1.2, 101)]
+        scan = DacScan(Dac8568Bank(ipbus_link), points, callback=take_data, readout=read_fifo)
+        results = scan.run()
+    """
+
+    def __init__(self, bank, points, callback=None, readout=None, reorder=True, settle_time=DAC8568_SETTLE_TIME):
+        """
+        :param bank: Dac8568Bank.
+        :param points: Sequence of (dev_nr, ch, volt) or of lists of them.
+        :param callback: Called as callback(point) at each point after settling.
+        :param readout: Called as readout(point) for the previous point while the next one settles.
+        :param reorder: Group the points by device. False: keep the given order.
+        :param settle_time: Output settling after the conversion, unit: s.
+        """
+        self.bank = bank
+        self.points = [self._settings(point) for point in points]
+        self.callback = callback
+        self.readout = readout
+        self.reorder = reorder
+        self.settle_time = settle_time
+        # Codes known to be on the outputs, -1: unknown
+        self.codes = np.full((len(bank.dev_nrs), DAC8568_CH_NUM), -1, dtype=np.int64)
+        self.dac_nr = None
+
+        self.dac_nr_switches = 0
+        self.conversions = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+
+    @staticmethod
+    def _settings(point):
+        if len(point) == 3 and np.isscalar(point[0]):
+            point = [point]
+        return [(int(dev_nr), int(ch), float(volt)) for dev_nr, ch, volt in point]
+
+    def order(self):
+        """
+        Order in which the points are run: grouped by the first device they touch, starting
+        with the device selected now and keeping the given order inside a group.
+
+        :return: list of point indices.
+        """
+        order = list(range(len(self.points)))
+        if not self.reorder:
+            return order
+        first = self.dac_nr if self.dac_nr is not None else self.bank.dev_nrs[0]
+        rank = {dev_nr: i + 1 for i, dev_nr in enumerate(self.bank.dev_nrs)}
+        rank[first] = 0
+        return sorted(order, key=lambda i: rank[self.points[i][0][0]] if self.points[i] else 0)
+
+    def _changes(self, settings):
+        """Codes to write for a point, grouped per device, the selected device first."""
+        volts = np.array([volt for _, _, volt in settings])
+        codes = Dac8568Device.volts_2_codes(volts)
+        per_dev = {}
+        for (dev_nr, ch, _), code in zip(settings, codes):
+            row = self.bank.dev_nrs.index(dev_nr)
+            if self.codes[row, ch] == code:
+                self.skipped += 1
+                continue
+            per_dev.setdefault(dev_nr, {})[ch] = code
+        dev_nrs = sorted(per_dev, key=lambda dev_nr: dev_nr != self.dac_nr)
+        return [(dev_nr, list(per_dev[dev_nr]), np.array(list(per_dev[dev_nr].values()), dtype=np.uint16))
+                for dev_nr in dev_nrs]
+
+    def _apply(self, settings):
+        """
+        :return: Dac8568Device started last, None if nothing changed.
+        """
+        changes = self._changes(settings)
+        if not changes:
+            return None
+        self.bank.update(changes)
+        for dev_nr, chs, codes in changes:
+            if dev_nr != self.dac_nr:
+                self.dac_nr_switches += self.dac_nr is not None
+                self.dac_nr = dev_nr
+            row = self.bank.dev_nrs.index(dev_nr)
+            self.codes[row, chs] = codes
+            self.conversions += 1
+        return self.bank.devices[self.bank.dev_nrs.index(changes[-1][0])]
+
+    def run(self):
+        """
+        Run all points.
+
+        :return: list of (callback result, readout result), in the order points were given.
+        """
+        results = [[None, None] for _ in self.points]
+        t_start = time.perf_counter()
+        prev = None
+        for i in self.order():
+            device = self._apply(self.points[i])
+            if self.readout is not None and prev is not None:
+                results[prev][1] = self.readout(self.points[prev])
+            if device is not None:
+                device.wait_ready()
+                time.sleep(self.settle_time)
+            if self.callback is not None:
+                results[i][0] = self.callback(self.points[i])
+            prev = i
+        if self.readout is not None and prev is not None:
+            results[prev][1] = self.readout(self.points[prev])
+        self.elapsed = time.perf_counter() - t_start
+        log.info("DAC scan: {} points in {:.3f} s, {} dac_nr switches, {} conversions, {} unchanged settings".format(
+            len(self.points), self.elapsed, self.dac_nr_switches, self.conversions, self.skipped))
+        return [tuple(result) for result in results]
+
+    def stats(self):
+        return {"points": len(self.points), "elapsed": self.elapsed, "dac_nr_switches": self.dac_nr_switches,
+                "conversions": self.conversions, "skipped": self.skipped}
@@ -0,0 +1,17 @@
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+## Defines for the IPbus FIFO slaves, see etc/slave/*.xml
+
+FIFO_DEPTH = 131072  # unit: word
+FIFO_WORD_BYTES = 4
+FIFO_LEN_MASK = 0x7fffffff  # bit 31 of the length registers is a flag
+
+# Default read chunk: a quarter of the FIFO, so three more chunks can arrive while one is processed
+FIFO_CHUNK_WORDS = FIFO_DEPTH // 4
+
+# FIFO nodes of etc/sim/data_dev.xml. The firmware does not fix their base address yet,
+# so only etc/sim_address.xml maps them; pass a table mapping data_dev to IPbusLink.
+DATA_FIFO_BASE = "data_dev."
+DATA_FIFO_NAME = "data_fifo"
+CTRL_FIFO_NAME = "ctrl_fifo"
@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from lib.fifo_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+_END = object()
+
+
+class FifoStreamReader:
+    """
+    Streaming readout of an IPbus data FIFO.
+
+    A background thread keeps polling RFIFO_LEN and reading RFIFO_DATA while the consumer
+    handles the previous chunk. In pipelined mode (the default) each chunk takes one
+    dispatch, see IPbusLink.read_ipb_data_fifo_pipelined. At most `n_buffers` chunks are
+    held in memory; when the consumer falls behind the thread waits and the data stays in
+    the board FIFO.
+
+    Chunks are numpy.uint32 views into a fixed ring of preallocated buffers, so a chunk is
+    only valid until the consumer asks for the next one. Copy it to keep it longer.
+
+    Example::
+
+        with FifoStreamReader(ipbus_link) as reader:
+            for chunk in reader:
+                process(chunk)
+                if done:
+                    reader.stop()
+    """
+
+    def __init__(self, ipbus_link, reg_name_base=DATA_FIFO_BASE, fifo_name=DATA_FIFO_NAME,
+                 chunk_words=FIFO_CHUNK_WORDS, n_buffers=2, idle_sleep=1e-3, max_words=None, pipelined=True):
+        """
+        :param ipbus_link: IPbusLink.
+        :param reg_name_base: Register name base of the FIFO.
+        :param fifo_name: FIFO node name.
+        :param chunk_words: Largest chunk read in one go, at most the FIFO depth.
+        :param n_buffers: Chunks read ahead of the consumer. 2: double buffering.
+        :param idle_sleep: Pause before polling again when the FIFO is empty, unit: s.
+        :param max_words: Stop after this many words. None: run until stop().
+        :param pipelined: Read each chunk together with the next FIFO length in one dispatch.
+                          False: poll RFIFO_LEN and read the data in two dispatches.
+        """
+        if chunk_words not in range(1, FIFO_DEPTH + 1):
+            raise ValueError('Unexpected chunk size: {0}, should be 1-{1}'.format(chunk_words, FIFO_DEPTH))
+        self._ipbus_link = ipbus_link
+        self.reg_name_base = reg_name_base
+        self.fifo_name = fifo_name
+        self.chunk_words = chunk_words
+        self.idle_sleep = idle_sleep
+        self.max_words = max_words
+        self.pipelined = pipelined
+
+        self._chunks = queue.Queue(maxsize=n_buffers)
+        # Queued chunks + the one being filled + the one held by the consumer
+        self._buffers = [np.empty(chunk_words, dtype=np.uint32) for _ in range(n_buffers + 2)]
+        self._buffer_idx = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.words = 0
+        self.chunks = 0
+        self.empty_polls = 0
+        self._t_start = None
+        self._t_stop = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._t_start = time.perf_counter()
+        self._t_stop = None
+        self._thread = threading.Thread(target=self._run, name="fifo-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Ask the reader thread to finish. Chunks already read are still handed out.
+
+        :return: None
+        """
+        self._stop_event.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        log.info("FIFO {}{} read {} words in {} chunks, {:.2f} MB/s".format(
+            self.reg_name_base, self.fifo_name, self.words, self.chunks, self.rate_mbps()))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        # Unblock the thread if it waits for room in the queue
+        while self._thread is not None and self._thread.is_alive():
+            try:
+                self._chunks.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        self.join()
+
+    def _read_chunk(self):
+        out = self._buffers[self._buffer_idx]
+        if self.pipelined:
+            chunk = self._ipbus_link.read_ipb_data_fifo_pipelined(self.reg_name_base, self.fifo_name,
+                                                                  self._next_len(), out=out)
+        else:
+            chunk = self._ipbus_link.read_ipb_data_fifo_chunk(self.reg_name_base, self.fifo_name,
+                                                              self._next_len(), out=out)
+        if len(chunk):
+            self._buffer_idx = (self._buffer_idx + 1) % len(self._buffers)
+        return chunk
+
+    def _next_len(self):
+        if self.max_words is None:
+            return self.chunk_words
+        return min(self.chunk_words, self.max_words - self.words)
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set() and self._next_len() > 0:
+                chunk = self._read_chunk()
+                if len(chunk) == 0:
+                    if self.pipelined and self._ipbus_link.fifo_words_known(self.reg_name_base, self.fifo_name):
+                        # The length read along with this one found words, take them right away
+                        continue
+                    self.empty_polls += 1
+                    self._stop_event.wait(self.idle_sleep)
+                    continue
+                self.words += len(chunk)
+                self.chunks += 1
+                self._put(chunk)
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._t_stop = time.perf_counter()
+            self._put(_END)
+
+    def _put(self, item):
+        self._chunks.put(item)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            item = self._chunks.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def elapsed(self):
+        if self._t_start is None:
+            return 0.0
+        t_stop = self._t_stop if self._t_stop is not None else time.perf_counter()
+        return t_stop - self._t_start
+
+    def rate_mbps(self):
+        """
+        Sustained readout rate since start.
+
+        :return: Unit: MB/s.
+        """
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.words * FIFO_WORD_BYTES / elapsed / 1e6
+
+    def stats(self):
+        return {"words": self.words, "chunks": self.chunks, "empty_polls": self.empty_polls,
+                "elapsed": self.elapsed(), "rate_mbps": self.rate_mbps()}
@@ -15,6 +15,7 @@ class GlobalDevice:
     def __init__(self, ipbus_link):
         self._ipbus_link = ipbus_link
         self.reg_name_base = "global_dev."
+        self._nodes = ipbus_link.nodes(self.reg_name_base)
 
     def set_bit(self, reg_name):
         """
@@ -23,7 +24,7 @@ class GlobalDevice:
         :param reg_name:
         :return:
         """
-        self._ipbus_link.w_reg(self.reg_name_base, reg_name, 0, is_pulse=True, go_dispatch=True)
+        self._ipbus_link.w_node(self._nodes[reg_name], 0, is_pulse=True, go_dispatch=True)
 
     def set_nuke(self):
         """
@@ -31,7 +32,8 @@ class GlobalDevice:
 
         :return:
         """
-        return self.set_bit("nuke")
+        self.set_bit("nuke")
+        self._ipbus_link.invalidate_shadow()
 
     def set_soft_rst(self):
         """
@@ -39,8 +41,9 @@ class GlobalDevice:
 
         :return:
         """
-        return self.set_bit("soft_rst")
+        self.set_bit("soft_rst")
+        self._ipbus_link.invalidate_shadow()
 
     def set_dac_nr(self, nr):
         reg_name = "dac_nr"
-        self._ipbus_link.w_reg(self.reg_name_base, reg_name, nr, is_pulse=False, go_dispatch=True)
\ No newline at end of file
+        self._ipbus_link.w_node(self._nodes[reg_name], nr, is_pulse=False, go_dispatch=True)
\ No newline at end of file
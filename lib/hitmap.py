@@ -0,0 +1,199 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from lib.cee_data import decode_hits
+from lib.cee_defs import *
+from lib.cee_spi_config import CeeSpiConfig
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class HitMap:
+    """
+    Live hit map of a run, filled chunk by chunk from raw data FIFO words.
+
+    All arrays are CEE_PIXEL_NUM long and allocated once, so memory does not grow with
+    the run length. Hits and payload sums per pixel are accumulated in place; the rate
+    is taken over the window since the previous snapshot.
+
+    Example::
+
+        hitmap = HitMap(snapshot_path="data/hitmap.npz", snapshot_interval=10.0)
+        for chunk in reader:
+            hitmap.add(chunk)
+        hitmap.mask_noisy(cee_spi_config)
+    """
+
+    def __init__(self, snapshot_path=None, snapshot_interval=10.0):
+        """
+        :param snapshot_path: npz file written every `snapshot_interval`, overwritten each time.
+                              May contain "{index}" to keep every snapshot. None: no snapshots.
+        :param snapshot_interval: Unit: s.
+        """
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+        self.counts = np.zeros(CEE_PIXEL_NUM, dtype=np.uint64)
+        self.payload_sum = np.zeros(CEE_PIXEL_NUM, dtype=np.float64)
+        # Counts at the start of the current rate window
+        self._window_counts = np.zeros(CEE_PIXEL_NUM, dtype=np.uint64)
+        self._rate = np.zeros(CEE_PIXEL_NUM, dtype=np.float64)
+
+        self.words = 0
+        self.hits = 0
+        self.chunks = 0
+        self.snapshots = 0
+        self.t_start = time.time()
+        self._t_window = time.perf_counter()
+        self._t_last = self._t_window
+
+    def reset(self):
+        """Start a new run, keeping the arrays."""
+        self.counts[:] = 0
+        self.payload_sum[:] = 0
+        self._window_counts[:] = 0
+        self._rate[:] = 0
+        self.words = self.hits = self.chunks = self.snapshots = 0
+        self.t_start = time.time()
+        self._t_window = time.perf_counter()
+        self._t_last = self._t_window
+
+    def add(self, words):
+        """
+        Add a chunk of raw words, e.g. from read_ipb_data_fifo or a FifoStreamReader.
+
+        :param words: numpy.uint32 array.
+        :return: Number of hits in the chunk.
+        """
+        pixels, payload = decode_hits(words)
+        self.counts += np.bincount(pixels, minlength=CEE_PIXEL_NUM).astype(np.uint64, copy=False)
+        self.payload_sum += np.bincount(pixels, weights=payload, minlength=CEE_PIXEL_NUM)
+        self.words += len(words)
+        self.hits += len(pixels)
+        self.chunks += 1
+        self._t_last = time.perf_counter()
+        if self.snapshot_path is not None and self._t_last - self._t_window >= self.snapshot_interval:
+            self.snapshot()
+        return len(pixels)
+
+    def occupancy(self):
+        """
+        :return: Fraction of all hits seen per pixel.
+        """
+        return self.counts / self.hits if self.hits else np.zeros(CEE_PIXEL_NUM)
+
+    def rate(self):
+        """
+        Hits per second per pixel over the current window, or the last complete one if it just started.
+
+        :return: numpy.float64 array, unit: Hz.
+        """
+        elapsed = self._t_last - self._t_window
+        if elapsed <= 0:
+            return self._rate.copy()
+        return (self.counts - self._window_counts) / elapsed
+
+    def mean_payload(self):
+        """
+        :return: Mean hit payload per pixel, NaN where there was no hit.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.payload_sum / self.counts
+
+    def snapshot(self, path=None):
+        """
+        Write the hit map to an npz file and start a new rate window.
+
+        The file is replaced atomically, so a reader never sees half a snapshot.
+
+        :param path: Default: snapshot_path.
+        :return: Path written.
+        """
+        path = (path or self.snapshot_path).format(index=self.snapshots)
+        self._rate = self.rate()
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, counts=self.counts, payload_sum=self.payload_sum, rate=self._rate, hits=self.hits,
+                 words=self.words, t_start=self.t_start, t_snapshot=time.time())
+        os.replace(tmp, path)
+        self._window_counts[:] = self.counts
+        self._t_window = self._t_last = time.perf_counter()
+        self.snapshots += 1
+        log.debug("Hit map snapshot {}: {} hits".format(path, self.hits))
+        return path
+
+    def noisy_pixels(self, n_sigma=5.0, max_rate=None):
+        """
+        Pixels firing far above the rest, from the hit counts of the whole run.
+
+        The spread is estimated from the median absolute deviation, so a few noisy pixels
+        do not hide each other.
+
+        :param n_sigma: Pixels above median + n_sigma * spread are noisy.
+        :param max_rate: Also flag pixels above this mean rate, unit: Hz.
+        :return: numpy array of pixel addresses.
+        """
+        counts = self.counts.astype(np.float64)
+        median = np.median(counts)
+        spread = 1.4826 * np.median(np.abs(counts - median))
+        # Poisson spread when most pixels see the same few hits
+        spread = max(spread, np.sqrt(median), 1.0)
+        noisy = counts > median + n_sigma * spread
+        if max_rate is not None:
+            elapsed = time.time() - self.t_start
+            noisy |= counts / max(elapsed, 1e-9) > max_rate
+        return np.flatnonzero(noisy)
+
+    def mask_map(self, pixels=None, mask=None):
+        """
+        Pixel mask array for CeeSpiConfig.apply_matrix with the noisy pixels switched off.
+
+        :param pixels: Pixels to mask. Default: noisy_pixels().
+        :param mask: Mask to start from, e.g. the current one. Default: nothing masked.
+        :return: numpy.uint16 array of CEE_PIXEL_NUM mask values.
+        """
+        if pixels is None:
+            pixels = self.noisy_pixels()
+        out = np.zeros(CEE_PIXEL_NUM, dtype=np.uint16) if mask is None else np.array(mask, dtype=np.uint16)
+        out[np.asarray(pixels, dtype=np.intp)] = CEE_MASK_OFF
+        return out
+
+    def mask_noisy(self, cee_spi_config, pixels=None):
+        """
+        Mask the noisy pixels on the chip, keeping the rest of the stored pixel configuration.
+
+        :param cee_spi_config: CeeSpiConfig holding the current pixel state.
+        :param pixels: Pixels to mask. Default: noisy_pixels().
+        :return: Pixels masked.
+        """
+        if pixels is None:
+            pixels = self.noisy_pixels()
+        conf = CeeSpiConfig.decode_pixel_conf(cee_spi_config.pixel_words)
+        cee_spi_config.apply_matrix(conf["trim"], we=1, pulse_en=conf["pulse_en"],
+                                    mask=self.mask_map(pixels, conf["mask"]))
+        log.info("Masked {} noisy pixels: {}".format(len(pixels), list(pixels)))
+        return pixels
+
+
+def fill_hitmap(reader, snapshot_path, snapshot_interval=10.0):
+    """
+    Acquisition consumer keeping a hit map of the run, see Acquisition.add_consumer.
+
+    :param reader: ShmRingReader.
+    :param snapshot_path: See HitMap, also written once the run ends. None: no snapshots.
+    :param snapshot_interval: Unit: s.
+    :return: None
+    """
+    hitmap = HitMap(snapshot_path, snapshot_interval)
+    for chunk in reader:
+        hitmap.add(chunk)
+    if hitmap.snapshot_path is not None:
+        hitmap.snapshot()
@@ -0,0 +1,169 @@
+import functools
+import json
+import logging
+import math
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+HIST_BUCKETS = 32  # bucket i holds latencies in [2^(i-1), 2^i) us, bucket 0 below 1 us
+
+# Bus counters kept by IPbusLink while stats are on
+COUNTERS = ("dispatches", "words_read", "words_written", "rmw", "fifo_words_read", "fifo_words_written")
+
+
+class LatencyHistogram:
+    """Latency histogram with power of two buckets in microseconds."""
+
+    __slots__ = ("buckets", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = [0] * HIST_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        i = min(int(us).bit_length(), HIST_BUCKETS - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        :param q: 0-1.
+        :return: Upper edge of the bucket holding the quantile, unit: s.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) * 1e-6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count if self.count else 0.0,
+                "min": self.min if self.count else 0.0, "max": self.max,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets_us": {str(1 << i): n for i, n in enumerate(self.buckets) if n}}
+
+
+class LinkStats:
+    """
+    Counters and latency histograms of one IPbusLink, see :meth:`IPbusLink.enable_stats`.
+
+    `counters` holds the COUNTERS bus counters, `nodes` a histogram per register for the
+    accesses that went out on their own, `ops` a histogram per high level operation.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.dispatch = LatencyHistogram()
+        self.nodes = {}
+        self.ops = {}
+        self.t_start = time.time()
+
+    def node(self, name, seconds):
+        hist = self.nodes.get(name)
+        if hist is None:
+            hist = self.nodes[name] = LatencyHistogram()
+        hist.add(seconds)
+
+    def op(self, name, seconds):
+        hist = self.ops.get(name)
+        if hist is None:
+            hist = self.ops[name] = LatencyHistogram()
+        hist.add(seconds)
+
+    def to_dict(self):
+        return {"since": self.t_start, "counters": dict(self.counters),
+                "fifo_bytes_read": self.counters["fifo_words_read"] * 4,
+                "fifo_bytes_written": self.counters["fifo_words_written"] * 4,
+                "dispatch": self.dispatch.to_dict(),
+                "nodes": {name: hist.to_dict() for name, hist in sorted(self.nodes.items())},
+                "ops": {name: hist.to_dict() for name, hist in sorted(self.ops.items())}}
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def to_text(self, prefix="ipbus", labels=None):
+        """
+        Prometheus text exposition of the counters and histograms.
+
+        :param prefix: Metric name prefix.
+        :param labels: Extra labels for every sample, e.g. {"board": "CEE.udp.0"}.
+        :return: str
+        """
+        base = dict(labels or {})
+        lines = []
+
+        def fmt(extra):
+            items = dict(base, **extra)
+            if not items:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, v) for k, v in items.items()) + "}"
+
+        for name, value in self.counters.items():
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total{} {}".format(prefix, name, fmt({}), value))
+
+        def hist(metric, histogram, extra):
+            seen = 0
+            for i, n in enumerate(histogram.buckets):
+                seen += n
+                if n:
+                    lines.append("{}_bucket{} {}".format(metric, fmt(dict(extra, le=(1 << i) * 1e-6)), seen))
+            lines.append("{}_bucket{} {}".format(metric, fmt(dict(extra, le="+Inf")), histogram.count))
+            lines.append("{}_sum{} {}".format(metric, fmt(extra), histogram.total))
+            lines.append("{}_count{} {}".format(metric, fmt(extra), histogram.count))
+
+        for metric, histograms in (("dispatch", {None: self.dispatch}), ("node", self.nodes), ("op", self.ops)):
+            full = "{}_{}_seconds".format(prefix, metric)
+            lines.append("# TYPE {} histogram".format(full))
+            for name, histogram in sorted(histograms.items(), key=lambda item: str(item[0])):
+                hist(full, histogram, {} if name is None else {metric: name})
+        return "\n".join(lines) + "\n"
+
+    def write_text(self, path, prefix="ipbus", labels=None):
+        with open(path, "w") as f:
+            f.write(self.to_text(prefix, labels))
+
+
+def instrumented(op_name):
+    """
+    Decorator timing a method of a device class (or of IPbusLink) as a high level operation.
+
+    The link is taken from the `_ipbus_link` attribute of the instance. When its stats are
+    off the only cost is one attribute check.
+
+    :param op_name: Name in LinkStats.ops, e.g. "conf_pixel".
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            stats = getattr(self, "_ipbus_link", self).stats
+            if stats is None:
+                return func(self, *args, **kwargs)
+            t_start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                stats.op(op_name, time.perf_counter() - t_start)
+        return wrapper
+    return decorator
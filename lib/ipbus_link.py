@@ -1,9 +1,19 @@
+import functools
+import threading
 import time
+from contextlib import contextmanager
 
+import numpy as np
 import uhal
 import coloredlogs
 import logging
 
+from lib.address_table import AddressTable
+from lib.completion import CompletionWaiter
+from lib.fifo_defs import *
+from lib.instrumentation import LinkStats, instrumented
+from lib.txn_log import TXN_READ, TXN_READ_BLOCK, TXN_WRITE, TxnRecorder
+
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
@@ -15,30 +25,441 @@ __author__ = "Sheng Dong"
 __email__ = "s.dong@mails.ccnu.edu.cn"
 
 
+def block_to_array(block, out=None):
+    """
+    Copy a uhal block read into a contiguous numpy.uint32 array.
+
+    :param block: uhal ValVector (or any sequence of words).
+    :param out: Preallocated uint32 buffer to fill, reused across reads. None: allocate.
+    :return: Array of len(block) words, a view into `out` if given.
+    """
+    n = len(block)
+    if out is None:
+        out = np.empty(n, dtype=np.uint32)
+    elif out.dtype != np.uint32 or len(out) < n:
+        raise ValueError('Unexpected buffer: {} words of {}, need {} words of uint32'.format(len(out), out.dtype, n))
+    view = out[:n]
+    if n:
+        try:
+            view[:] = np.frombuffer(block, dtype=np.uint32, count=n)
+        except (TypeError, ValueError):
+            # uhal bindings without the buffer protocol
+            view[:] = block.value() if hasattr(block, "value") else block
+    return view
+
+
+def words_to_list(data):
+    """
+    Word list for uhal writeBlock from a list or a numpy array.
+
+    :param data: Sequence of 32-bit words.
+    :return: list of int
+    """
+    if isinstance(data, np.ndarray):
+        if data.dtype != np.uint32:
+            if data.size and (data.min() < 0 or data.max() > 0xffffffff):
+                raise ValueError('Unexpected data, words should be 0-0xffffffff')
+            data = data.astype(np.uint32)
+        return data.ravel().tolist()
+    return list(data)
+
+
+def locked(func):
+    """
+    Decorator holding the link lock for one access of an IPbusLink method, so threads
+    sharing the link never interleave their transactions. The lock is reentrant: an access
+    inside a batch or inside another access keeps it.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class DeferredRead:
+    """
+    Result of a register read queued inside a batch.
+
+    The value becomes valid once the batch is dispatched. Asking for it earlier
+    forces a dispatch of everything queued so far.
+    """
+
+    def __init__(self, ipbus_link, val_word):
+        self._ipbus_link = ipbus_link
+        self._val_word = val_word
+
+    def valid(self):
+        return self._val_word.valid()
+
+    def value(self):
+        if not self._val_word.valid():
+            self._ipbus_link.dispatch()
+        return self._val_word.value()
+
+    def __int__(self):
+        return int(self.value())
+
+    def __index__(self):
+        return int(self.value())
+
+    def __eq__(self, other):
+        return self.value() == other
+
+    def __ne__(self, other):
+        return self.value() != other
+
+    def __hash__(self):
+        return hash(self.value())
+
+    def __bool__(self):
+        return bool(self.value())
+
+    def __format__(self, format_spec):
+        return format(self.value(), format_spec)
+
+    def __repr__(self):
+        if self._val_word.valid():
+            return "DeferredRead({:#010x})".format(self._val_word.value())
+        return "DeferredRead(<pending>)"
+
+
 class IPbusLink:
-    def __init__(self):
+    def __init__(self, device_uri=None, shadow=True, device_id="JadePix3.udp.0", address_table="etc/address.xml",
+                 stats=False):
+        """
+        :param device_uri: uhal URI of the board, e.g. "ipbusudp-2.0://127.0.0.1:50001" for the local
+                           simulator (./sim.py). Default: the board at 192.168.3.18.
+        :param shadow: Keep a shadow copy of written registers, see :meth:`invalidate_shadow`.
+        :param device_id: uhal device id, e.g. a connection id of etc/connections.xml.
+        :param address_table: Top level address table file, or an AddressTable already loaded.
+        :param stats: Keep bus counters and latency histograms from the start, see :meth:`enable_stats`.
+        """
         self.device_ip = "192.168.3.18"
         # self.device_uri = "chtcp-2.0://localhost:10203?target=192.168.3.18:5000>1"
         # < connection id = "JadePix3.udp.0" uri = "chtcp-2.0://localhost:10203?target=127.0.0.1:50001" address_table = "file://address.xml" / >
-        self.device_uri = "ipbusudp-2.0://" + self.device_ip + ":50001"
-        self.address_table_name = "etc/address.xml"
+        if device_uri is None:
+            device_uri = "ipbusudp-2.0://" + self.device_ip + ":50001"
+        self.device_uri = device_uri
+        self.device_id = device_id
+        if isinstance(address_table, AddressTable):
+            self.address_table = address_table
+        else:
+            self.address_table = AddressTable.load(address_table)
+        self.address_table_name = self.address_table.path
         self.address_table_uri = "file://" + self.address_table_name
         self._hw = self.get_hw()
         # self._hw.setTimeoutPeriod(1000)
         log.info("IPbus timeout period: {:}".format(self._hw.getTimeoutPeriod()))
 
         self._quit_reading = False
+        # uhal devices are not thread safe: every access and every batch holds the lock
+        self.lock = threading.RLock()
+        # Batch nesting per thread: a batch of one thread says nothing about the others
+        self._thread_state = threading.local()
+        self._queued = False
+
+        # Shadow copy of written registers: address -> [known bits mask, value]
+        self.shadow_enabled = shadow
+        self._shadow = {}
+        # Masked writes not yet queued to uhal: address -> [mask, value]
+        self._pending = {}
+
+        self._nodes = {}
+        self._fifos = {}
+        # Words known to be in a data FIFO, from the RFIFO_LEN read of the last pipelined read
+        self._fifo_len = {}
+        self._waiters = {}
+        # LinkStats while instrumentation is on
+        self.stats = LinkStats() if stats else None
+        # TxnRecorder while recording, see start_recording
+        self.recorder = None
+        # The firmware executes lib/cmd_stream.py command words from the slow control FIFO.
+        # The current firmware does not, only the simulator (./sim.py --cmd-stream) does.
+        self.cmd_stream = False
 
     def get_hw(self):
         """
 
         :return: IPbus Device
         """
-        uhal.setLogLevelTo(uhal.LogLevel.DEBUG)
+        # Per transaction uhal logging costs more than the transactions, see enable_stats for timing
+        uhal.setLogLevelTo(uhal.LogLevel.WARNING)
         # uhal.disableLogging()
-        hw = uhal.getDevice("JadePix3.udp.0", self.device_uri, self.address_table_uri)
+        hw = uhal.getDevice(self.device_id, self.device_uri, self.address_table.flat_uri)
         return hw
 
+    def node(self, reg_name_base, reg_name):
+        """
+        Resolved register with its uhal node handle.
+
+        Handles are cached, so repeated lookups are a single dict access.
+
+        :param reg_name_base: Register name base, usually device name.
+        :param reg_name: Register name.
+        :return: RegisterNode
+        """
+        key = (reg_name_base, reg_name)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._bind(reg_name_base + reg_name)
+            self._nodes[key] = node
+        return node
+
+    def nodes(self, reg_name_base):
+        """
+        Prebuilt handles for every register below a device.
+
+        :param reg_name_base: Register name base, e.g. "spi_dev.".
+        :return: dict, register name -> RegisterNode
+        """
+        nodes = {}
+        for reg_name in self.address_table.below(reg_name_base):
+            nodes[reg_name] = self.node(reg_name_base, reg_name)
+        return nodes
+
+    def _bind(self, node_name):
+        return self.address_table[node_name].bind(self._hw.getNode(node_name))
+
+    def _fifo_nodes(self, reg_name_base, fifo_name):
+        key = (reg_name_base, fifo_name)
+        nodes = self._fifos.get(key)
+        if nodes is None:
+            nodes = self.nodes(reg_name_base + fifo_name + ".")
+            if not nodes:
+                raise ValueError('Unexpected FIFO: no node "{}" in {}'.format(reg_name_base + fifo_name,
+                                                                             self.address_table_name))
+            self._fifos[key] = nodes
+        return nodes
+
+    @locked
+    def dispatch(self):
+        """
+        Send all queued transactions to the device.
+
+        Pending shadowed writes are merged into one transaction per word first. Nothing
+        is sent if every write was found redundant.
+
+        :return: None
+        """
+        self._flush_pending()
+        if self._queued:
+            self._queued = False
+            if self.stats is None and self.recorder is None:
+                self._hw.dispatch()
+            else:
+                t_start = time.perf_counter()
+                self._hw.dispatch()
+                t_stop = time.perf_counter()
+                if self.stats is not None:
+                    self.stats.dispatch.add(t_stop - t_start)
+                    self.stats.counters["dispatches"] += 1
+                if self.recorder is not None:
+                    self.recorder.dispatch(t_start, t_stop)
+
+    def enable_stats(self):
+        """
+        Start counting bus traffic and timing dispatches, register accesses and the
+        operations marked with @instrumented. Resets any earlier stats.
+
+        :return: LinkStats
+        """
+        self.stats = LinkStats()
+        return self.stats
+
+    def disable_stats(self):
+        """
+        :return: The LinkStats collected so far, or None.
+        """
+        stats, self.stats = self.stats, None
+        return stats
+
+    def write_stats(self, path, labels=None):
+        """
+        Export the stats: JSON for a ".json" path, Prometheus text exposition otherwise.
+
+        :param path: Output file.
+        :param labels: Extra labels for the text exposition.
+        :return: None
+        """
+        if self.stats is None:
+            raise ValueError('Unexpected call, stats are not enabled')
+        if path.endswith(".json"):
+            self.stats.write_json(path)
+        else:
+            self.stats.write_text(path, labels=labels)
+
+    def _count(self, counter, n):
+        if self.stats is not None:
+            self.stats.counters[counter] += n
+
+    def start_recording(self, path):
+        """
+        Log every transaction queued from now on, with the dispatch boundaries and their
+        timing, to a binary file for :func:`lib.txn_log.replay`.
+
+        :param path: Output file, e.g. "data/startup.txn".
+        :return: TxnRecorder
+        """
+        self.stop_recording()
+        self.recorder = TxnRecorder(path)
+        return self.recorder
+
+    def stop_recording(self):
+        """
+        :return: The TxnRecorder closed, or None.
+        """
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
+    def _record_write(self, node, reg_val):
+        if self.recorder is not None:
+            self.recorder.add(TXN_WRITE, node.address, node.mask, (reg_val << node.shift) & node.mask)
+
+    def _record_read(self, node):
+        if self.recorder is not None:
+            self.recorder.add(TXN_READ, node.address, node.mask)
+
+    def _record_read_block(self, address, n):
+        if self.recorder is not None:
+            self.recorder.add(TXN_READ_BLOCK, address, value=n, non_incremental=True)
+
+    def _record_write_block(self, address, words):
+        if self.recorder is not None:
+            self.recorder.add_block(address, words, non_incremental=True)
+
+    def raw_client(self):
+        """
+        uhal client for queuing transactions by address, e.g. to replay a transaction log.
+        They go out with the next :meth:`dispatch`, after the pending merged writes.
+
+        :return: uhal ClientInterface
+        """
+        self._start_transaction()
+        return self._hw.getClient()
+
+    def raw_pending(self):
+        """
+        :return: Whether anything is queued and not dispatched yet.
+        """
+        return self._queued or bool(self._pending)
+
+    def _flush_pending(self):
+        """
+        Queue the merged writes collected by :meth:`w_reg` to uhal, one per word.
+
+        :return: None
+        """
+        if not self._pending:
+            return
+        client = self._hw.getClient()
+        recorder = self.recorder
+        n_rmw = 0
+        for addr, (mask, bits) in self._pending.items():
+            known_mask, value = self._shadow.get(addr, (0, 0))
+            if (known_mask | mask) == 0xffffffff:
+                client.write(addr, (value & ~mask) | bits)
+                if recorder is not None:
+                    recorder.add(TXN_WRITE, addr, 0xffffffff, (value & ~mask) | bits)
+            else:
+                client.rmw_bits(addr, ~mask & 0xffffffff, bits)
+                n_rmw += 1
+                if recorder is not None:
+                    recorder.add(TXN_WRITE, addr, mask, bits)
+        if self.stats is not None:
+            self.stats.counters["words_written"] += len(self._pending) - n_rmw
+            self.stats.counters["rmw"] += n_rmw
+        self._pending.clear()
+        self._queued = True
+
+    def _start_transaction(self):
+        """
+        Must be called before queuing any transaction to uhal directly: keeps the pending
+        merged writes ahead of it and marks that there is something to dispatch.
+        """
+        self._flush_pending()
+        self._queued = True
+
+    def _update_shadow(self, addr, mask, bits):
+        entry = self._shadow.get(addr)
+        if entry is None:
+            self._shadow[addr] = [mask, bits]
+        else:
+            entry[0] |= mask
+            entry[1] = (entry[1] & ~mask) | bits
+
+    @locked
+    def invalidate_shadow(self, reg_name_base=None):
+        """
+        Forget cached register values, so the next write always reaches the device.
+
+        Call after anything that changes registers behind the link's back, e.g. a firmware reset.
+
+        :param reg_name_base: Only forget registers below this base, e.g. "dac8568_dev0.". Default: all.
+        :return: None
+        """
+        self._flush_pending()
+        if reg_name_base is None:
+            self._shadow.clear()
+            return
+        for node in self.address_table.below(reg_name_base).values():
+            self._shadow.pop(node.address, None)
+
+    def shadow_snapshot(self):
+        """
+        Copy of the shadow registers.
+
+        :return: dict, address -> (known bits mask, value)
+        """
+        return {addr: tuple(entry) for addr, entry in self._shadow.items()}
+
+    @property
+    def _batch_depth(self):
+        return getattr(self._thread_state, "batch_depth", 0)
+
+    @_batch_depth.setter
+    def _batch_depth(self, depth):
+        self._thread_state.batch_depth = depth
+
+    def in_batch(self):
+        """
+        Whether the calling thread is inside a batch opened by :meth:`batch`.
+
+        :return: bool
+        """
+        return self._batch_depth > 0
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue every register access made inside the block and dispatch them together.
+
+        Writes ignore their `go_dispatch` flag and reads return a :class:`DeferredRead`
+        which resolves once the batch is flushed. Batches may be nested, only the
+        outermost one dispatches. uhal packs the queue into as few IPbus packets as
+        the MTU allows. The link lock is held until the batch is dispatched, so other
+        threads cannot slip their accesses into it.
+
+        Example::
+
+            with ipbus_link.batch():
+                dac8568_dev0.select_ch(0xff)
+                dac8568_dev0.set_volt(ch=0, volt=1.0)
+                dac8568_dev0.start_conv()
+
+        :return: This link.
+        """
+        with self.lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.dispatch()
+
     def w_reg(self, reg_name_base, reg_name, reg_val, is_pulse, go_dispatch=True):
         """
 
@@ -49,83 +470,359 @@ class IPbusLink:
         :param go_dispatch: Whether send this command. Defalut = True
         :return: None
         """
-        node_name = reg_name_base + reg_name
-        node = self._hw.getNode(node_name)
-        if is_pulse:
-            node.write(0)
-            node.write(1)
-            node.write(0)
+        self.w_node(self.node(reg_name_base, reg_name), reg_val, is_pulse, go_dispatch)
+
+    @locked
+    def w_node(self, node, reg_val, is_pulse, go_dispatch=True):
+        """
+        Write a register through its prebuilt handle, see :meth:`nodes`.
+
+        :param node: RegisterNode.
+        :param reg_val: Value be to send.
+        :param is_pulse: Whether generate pulse.
+        :param go_dispatch: Whether send this command. Defalut = True
+        :return: None
+        """
+        stats = self.stats
+        if stats is not None:
+            t_start = time.perf_counter()
+        mask = node.mask
+        if is_pulse or not self.shadow_enabled or node.volatile:
+            self._start_transaction()
+            if is_pulse:
+                node.handle.write(0)
+                node.handle.write(1)
+                node.handle.write(0)
+                if self.recorder is not None:
+                    for val in (0, 1, 0):
+                        self._record_write(node, val)
+                reg_val = 0
+            else:
+                node.handle.write(reg_val)
+                self._record_write(node, reg_val)
+            if stats is not None:
+                # uhal turns a masked write into a read-modify-write
+                stats.counters["rmw" if mask != 0xffffffff else "words_written"] += 3 if is_pulse else 1
+            if self.shadow_enabled and not node.volatile:
+                self._update_shadow(node.address, mask, (reg_val << node.shift) & mask)
         else:
-            node.write(reg_val)
-        if go_dispatch:
-            self._hw.dispatch()
+            bits = reg_val << node.shift
+            if bits & ~mask:
+                raise ValueError('Unexpected value {:#x} for register {}, mask is {:#010x}'.format(
+                    reg_val, node.name, mask))
+            entry = self._shadow.get(node.address)
+            if entry is not None and entry[0] & mask == mask and entry[1] & mask == bits:
+                log.debug("Skip redundant write {} = {:#x}".format(node.name, reg_val))
+            else:
+                pending = self._pending.setdefault(node.address, [0, 0])
+                pending[0] |= mask
+                pending[1] = (pending[1] & ~mask) | bits
+                self._update_shadow(node.address, mask, bits)
+        if go_dispatch and not self._batch_depth:
+            self.dispatch()
+            if stats is not None:
+                stats.node(node.name, time.perf_counter() - t_start)
 
     def r_reg(self, reg_name_base, reg_name):
         """
 
         :param reg_name_base:
         :param reg_name:
-        :return:
+        :return: Register value, or a DeferredRead when called inside a batch.
+        """
+        return self.r_node(self.node(reg_name_base, reg_name))
+
+    @locked
+    def r_node(self, node):
+        """
+        Read a register through its prebuilt handle, see :meth:`nodes`.
+
+        :param node: RegisterNode.
+        :return: Register value, or a DeferredRead when called inside a batch.
         """
-        node_name = reg_name_base + reg_name
-        node = self._hw.getNode(node_name)
-        ret = node.read()
-        self._hw.dispatch()
+        stats = self.stats
+        if stats is not None:
+            t_start = time.perf_counter()
+            stats.counters["words_read"] += 1
+        self._start_transaction()
+        ret = node.handle.read()
+        self._record_read(node)
+        if self._batch_depth:
+            return DeferredRead(self, ret)
+        self.dispatch()
         ret_val = ret.value()
+        if stats is not None:
+            stats.node(node.name, time.perf_counter() - t_start)
         return ret_val
 
-    def send_slow_ctrl_cmd(self, reg_name_base, fifo_name, cmd):
+    @locked
+    def r_node_repeat(self, node, n):
+        """
+        Read the same register `n` times back to back in one non-incremental block read.
+
+        Inside a batch this doubles as an in-band delay of at least `n` IPbus clock cycles
+        between the transactions before and after it, and the last word tells the register
+        state at the end of the delay.
+
+        :param node: RegisterNode.
+        :param n: Number of reads.
+        :return: uhal block, valid once dispatched.
+        """
+        self._count("words_read", n)
+        self._start_transaction()
+        ret = self._hw.getClient().readBlock(node.address, n, uhal.BlockReadWriteMode.NON_INCREMENTAL)
+        self._record_read_block(node.address, n)
+        if not self._batch_depth:
+            self.dispatch()
+        return ret
+
+    def waiter(self, name):
+        """
+        Completion waiter shared by everything waiting on the same busy flag, see :class:`CompletionWaiter`.
+
+        :param name: e.g. "spi_dev", "dac8568_dev0".
+        :return: CompletionWaiter
+        """
+        waiter = self._waiters.get(name)
+        if waiter is None:
+            waiter = CompletionWaiter(name)
+            self._waiters[name] = waiter
+        return waiter
+
+    def wait_metrics(self):
+        """
+        Poll counts and wait times of all completion waiters.
+
+        :return: dict, waiter name -> metrics
+        """
+        return {name: waiter.metrics() for name, waiter in self._waiters.items()}
+
+    @instrumented("slow_ctrl_cmd")
+    @locked
+    def send_slow_ctrl_cmd(self, reg_name_base, fifo_name, cmd, cmd_gap=0.0, timeout=1.0):
         """
 
         :param reg_name_base:
         :param fifo_name:
         :param cmd:
+        :param cmd_gap: Extra pause after each command has been taken, unit: s.
+        :param timeout: Longest wait for a command to be taken, unit: s.
         :return:
         """
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        waiter = self.waiter(reg_name_base + fifo_name)
+
+        def pending():
+            self._start_transaction()
+            valid_len = fifo["WVALID_LEN"].handle.read()
+            self._record_read(fifo["WVALID_LEN"])
+            self._count("words_read", 1)
+            self.dispatch()
+            return (valid_len.value() & FIFO_LEN_MASK) != 1
+
         for i in range(len(cmd)):
-            self._hw.getNode(reg_name_base + fifo_name + ".WFIFO_DATA").write(cmd[i])
-            self._hw.dispatch()
-            valid_len = 0
-            while valid_len != 1:
-                valid_len = self._hw.getNode(reg_name_base + fifo_name + ".WVALID_LEN").read()
-                self._hw.dispatch()
-                valid_len = valid_len & 0x7fffffff
-            print("Slow ctrl cmd {:#08x} has been sent".format(cmd[i]))
-            time.sleep(0.2)
+            self._start_transaction()
+            fifo["WFIFO_DATA"].handle.write(cmd[i])
+            self._record_write(fifo["WFIFO_DATA"], cmd[i])
+            self._count("fifo_words_written", 1)
+            self.dispatch()
+            waiter.wait(pending, timeout=timeout)
+            log.debug("Slow ctrl cmd {:#010x} has been sent".format(cmd[i]))
+            if cmd_gap:
+                time.sleep(cmd_gap)
 
+    @locked
     def write_ipb_slow_ctrl_fifo(self, reg_name_base, fifo_name, data_list):
         """
 
         :param reg_name_base:
         :param fifo_name:
-        :param data_list:
+        :param data_list: list or numpy array of words.
         :return:
         """
-        self._hw.getNode(reg_name_base + fifo_name + ".WFIFO_DATA").writeBlock(data_list)
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        self._start_transaction()
+        data_list = words_to_list(data_list)
+        fifo["WFIFO_DATA"].handle.writeBlock(data_list)
+        self._record_write_block(fifo["WFIFO_DATA"].address, data_list)
+        self._count("fifo_words_written", len(data_list))
+
+    @instrumented("slow_ctrl_upload")
+    @locked
+    def upload_slow_ctrl_stream(self, reg_name_base, fifo_name, words, wait_drained=True, timeout=10.0):
+        """
+        Upload a compiled command stream (see CommandStream) to the slow control FIFO.
+
+        Needs firmware executing that command format, enabled with the `cmd_stream` attribute.
+
+        The stream goes out in blocks as large as the free FIFO space. Every block write is
+        dispatched together with a read of WFIFO_LEN, which gives the room for the next
+        block without an extra round trip.
+
+        :param reg_name_base:
+        :param fifo_name:
+        :param words: numpy.uint32 array or list of command words.
+        :param wait_drained: Return only once the firmware has taken every word.
+        :param timeout: Unit: s.
+        :return: Number of dispatches used.
+        """
+        if not self.cmd_stream:
+            raise RuntimeError('Command streams need firmware support, set cmd_stream on the link to upload one')
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        words = np.asarray(words, dtype=np.uint32)
+        t_stop = time.monotonic() + timeout
+        self._start_transaction()
+        fill = fifo["WFIFO_LEN"].handle.read()
+        self._record_read(fifo["WFIFO_LEN"])
+        self._count("words_read", 1)
+        self.dispatch()
+        n_dispatch = 1
+        pos = 0
+        poll = 1e-4
+        while True:
+            fill = int(fill.value()) & FIFO_LEN_MASK
+            if pos == len(words) and (not wait_drained or fill == 0):
+                break
+            room = FIFO_DEPTH - fill
+            if pos == len(words) or room == 0:
+                if time.monotonic() > t_stop:
+                    raise RuntimeError('Slow control FIFO {}{} not drained: {} words left'.format(
+                        reg_name_base, fifo_name, fill + len(words) - pos))
+                time.sleep(poll)
+                poll = min(poll * 2, 0.05)
+            else:
+                block = words[pos:pos + room]
+                self._start_transaction()
+                fifo["WFIFO_DATA"].handle.writeBlock(words_to_list(block))
+                self._record_write_block(fifo["WFIFO_DATA"].address, block)
+                self._count("fifo_words_written", len(block))
+                pos += len(block)
+                poll = 1e-4
+            self._start_transaction()
+            fill = fifo["WFIFO_LEN"].handle.read()
+            self._record_read(fifo["WFIFO_LEN"])
+            self._count("words_read", 1)
+            self.dispatch()
+            n_dispatch += 1
+        log.debug("Uploaded {} slow control words in {} dispatches".format(len(words), n_dispatch))
+        return n_dispatch
 
-    def read_ipb_data_fifo(self, reg_name_base, fifo_name, num, safe_mode):
+    @instrumented("fifo_read")
+    @locked
+    def read_ipb_data_fifo(self, reg_name_base, fifo_name, num, safe_mode, out=None):
         """
 
         :param reg_name_base:
         :param fifo_name:
         :param num:
         :param safe_mode: True: safe read data from FIFO. False: Just read, error may happen, but the speed is fast!
-        :param try_time: how many times to try to read
-        :return:
+                          "pipelined": safe and one dispatch per read, see read_ipb_data_fifo_pipelined.
+        :param out: Preallocated numpy.uint32 buffer reused across reads, see :func:`block_to_array`.
+        :return: numpy.uint32 array of the words read.
         """
+        if safe_mode == "pipelined":
+            return self.read_ipb_data_fifo_pipelined(reg_name_base, fifo_name, num, out)
         mem = []
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        self._fifo_len.pop((reg_name_base, fifo_name), None)
+        self._start_transaction()
         if safe_mode:
-            read_len = self._hw.getNode(reg_name_base + fifo_name + ".RFIFO_LEN").read()
-            self._hw.dispatch()
-            mem = self._hw.getNode(reg_name_base + fifo_name + ".RFIFO_DATA").readBlock(read_len)
-            self._hw.dispatch()
-            return mem
+            read_len = fifo["RFIFO_LEN"].handle.read()
+            self._record_read(fifo["RFIFO_LEN"])
+            self._count("words_read", 1)
+            self.dispatch()
+            read_len = int(read_len.value()) & FIFO_LEN_MASK
+            if out is not None:
+                read_len = min(read_len, len(out))
+            if read_len == 0:
+                return block_to_array([], out)
+            self._start_transaction()
+            mem = fifo["RFIFO_DATA"].handle.readBlock(read_len)
+            self._record_read_block(fifo["RFIFO_DATA"].address, read_len)
+            self._count("fifo_words_read", read_len)
+            self.dispatch()
+            return block_to_array(mem, out)
         else:
             try:
-                mem = self._hw.getNode(reg_name_base + fifo_name + ".RFIFO_DATA").readBlock(num)
-                self._hw.dispatch()
-                return mem
+                mem = fifo["RFIFO_DATA"].handle.readBlock(num)
+                self._record_read_block(fifo["RFIFO_DATA"].address, num)
+                self._count("fifo_words_read", num)
+                self.dispatch()
+                return block_to_array(mem, out)
             except KeyboardInterrupt:
                 raise
 
+    @instrumented("fifo_read_chunk")
+    @locked
+    def read_ipb_data_fifo_chunk(self, reg_name_base, fifo_name, max_len, out=None):
+        """
+        Safe read of whatever the FIFO holds, at most `max_len` words.
+
+        :param reg_name_base:
+        :param fifo_name:
+        :param max_len: Upper limit of words to read.
+        :param out: Preallocated numpy.uint32 buffer reused across reads, see :func:`block_to_array`.
+        :return: numpy.uint32 array, empty if the FIFO is empty.
+        """
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        self._fifo_len.pop((reg_name_base, fifo_name), None)
+        self._start_transaction()
+        read_len = fifo["RFIFO_LEN"].handle.read()
+        self._record_read(fifo["RFIFO_LEN"])
+        self._count("words_read", 1)
+        self.dispatch()
+        read_len = min(int(read_len.value()) & FIFO_LEN_MASK, max_len)
+        if read_len == 0:
+            return block_to_array([], out)
+        self._start_transaction()
+        mem = fifo["RFIFO_DATA"].handle.readBlock(read_len)
+        self._record_read_block(fifo["RFIFO_DATA"].address, read_len)
+        self._count("fifo_words_read", read_len)
+        self.dispatch()
+        return block_to_array(mem, out)
 
+    def fifo_words_known(self, reg_name_base, fifo_name):
+        """
+        :return: Words the next read_ipb_data_fifo_pipelined call may take, from the last RFIFO_LEN read.
+        """
+        return self._fifo_len.get((reg_name_base, fifo_name), 0)
+
+    @instrumented("fifo_read_pipelined")
+    @locked
+    def read_ipb_data_fifo_pipelined(self, reg_name_base, fifo_name, max_len, out=None):
+        """
+        Safe FIFO read in a single dispatch.
+
+        The data block read is sized from the RFIFO_LEN value of the previous call, and
+        the RFIFO_LEN read for the next call goes out behind it in the same dispatch. The
+        FIFO only loses words to these reads, so the previous length is a lower bound of
+        what it holds and no word is read from an empty FIFO. The first call, and every
+        call after another read of the same FIFO, only learns the length.
+
+        :param reg_name_base:
+        :param fifo_name:
+        :param max_len: Upper limit of words to read, at most FIFO_DEPTH.
+        :param out: Preallocated numpy.uint32 buffer reused across reads, see :func:`block_to_array`.
+        :return: numpy.uint32 array, empty if nothing was known to be in the FIFO.
+        """
+        fifo = self._fifo_nodes(reg_name_base, fifo_name)
+        key = (reg_name_base, fifo_name)
+        read_len = min(self._fifo_len.get(key, 0), max_len, FIFO_DEPTH)
+        if out is not None:
+            read_len = min(read_len, len(out))
+        self._start_transaction()
+        mem = []
+        if read_len:
+            mem = fifo["RFIFO_DATA"].handle.readBlock(read_len)
+            self._record_read_block(fifo["RFIFO_DATA"].address, read_len)
+            self._count("fifo_words_read", read_len)
+        next_len = fifo["RFIFO_LEN"].handle.read()
+        self._record_read(fifo["RFIFO_LEN"])
+        self._count("words_read", 1)
+        try:
+            self.dispatch()
+        except Exception:
+            self._fifo_len.pop(key, None)
+            raise
+        self._fifo_len[key] = int(next_len.value()) & FIFO_LEN_MASK
+        return block_to_array(mem, out)
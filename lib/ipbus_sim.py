@@ -0,0 +1,606 @@
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+
+from lib.cee_defs import *
+from lib.cmd_stream import CMD_CEE_FRAME, CMD_CH_SHIFT, CMD_DAC_DATA, CMD_DAC_START, CMD_DEV_SHIFT, CMD_SHIFT
+from lib.fifo_defs import *
+from lib.spi_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+IPBUS_VERSION = 2
+IPBUS_BYTE_ORDER = 0xf
+
+PKT_CONTROL = 0x0
+PKT_STATUS = 0x1
+PKT_RESEND = 0x2
+
+TRANS_READ = 0x0
+TRANS_WRITE = 0x1
+TRANS_NI_READ = 0x2
+TRANS_NI_WRITE = 0x3
+TRANS_RMW_BITS = 0x4
+TRANS_RMW_SUM = 0x5
+TRANS_CONF_READ = 0x6
+TRANS_CONF_WRITE = 0x7
+
+INFO_SUCCESS = 0x0
+INFO_BAD_HEADER = 0x1
+INFO_READ_ERROR = 0x4
+INFO_WRITE_ERROR = 0x5
+INFO_REQUEST = 0xf
+
+DAC_BUSY_TIME = 25.6e-6  # unit: s, 8 x 32 bit frames at 10 MHz
+
+
+class _Register:
+    """Plain memory word, writes limited to the writable bits from the address table."""
+
+    def __init__(self, writable_mask):
+        self.writable_mask = writable_mask
+        self.value = 0
+
+    def read(self, addr):
+        return self.value
+
+    def write(self, addr, value):
+        self.value = (self.value & ~self.writable_mask) | (value & self.writable_mask)
+
+
+class CeeChipModel:
+    """
+    Behavioural model of the CEE slow control, one 16-bit frame at a time.
+
+    Register writes are stored. A pixel configuration is latched into the pixel memory
+    when CEE_REG_PIXEL_CONF is written with `we` set, for the pixel selected by
+    CEE_REG_PIXEL_ADDR. Reading CEE_REG_PIXEL_DAC_L8/CEE_REG_PIXEL_CONF returns the
+    configuration of the selected pixel, other registers read back their last write.
+    The read value is returned in the data byte of the same frame.
+    """
+
+    def __init__(self, pixel_num=256):
+        self.regs = [0] * 128
+        self.pixels = [0] * pixel_num  # (conf << 8) | dac_l8
+
+    def frame(self, tx):
+        rw = (tx >> CEE_FRAME_RW_SHIFT) & 0x1
+        addr = (tx >> CEE_FRAME_ADDR_SHIFT) & 0x7f
+        data = tx & 0xff
+        pixel = self.regs[CEE_REG_PIXEL_ADDR] % len(self.pixels)
+        if rw == 0:
+            self.regs[addr] = data
+            if addr == CEE_REG_PIXEL_CONF and data & 0x80:
+                self.pixels[pixel] = (data << 8) | self.regs[CEE_REG_PIXEL_DAC_L8]
+            return tx & 0xff00
+        if addr == CEE_REG_PIXEL_DAC_L8:
+            data = self.pixels[pixel] & 0xff
+        elif addr == CEE_REG_PIXEL_CONF:
+            data = self.pixels[pixel] >> 8
+        else:
+            data = self.regs[addr]
+        return (tx & 0xff00) | data
+
+
+class _SpiModel:
+    """
+    OpenCores SPI master: d0..d3, ctrl, divider, ss.
+
+    Setting go_bsy starts a transfer of char_len bits, MSB first, that keeps go_bsy set
+    for char_len * 2 * (divider + 1) clock cycles. Writes to ctrl and data registers are
+    ignored while busy. The received bits replace the low char_len bits of d0..d3. With a
+    divider below `min_div` each frame gets a random bit flipped, to model a clock too
+    fast for the chip.
+    """
+
+    def __init__(self, base_addr, chip, min_div=0, rng=None):
+        self.base_addr = base_addr
+        self.chip = chip
+        self.min_div = min_div
+        self.rng = rng if rng is not None else random.Random()
+        self.data = [0, 0, 0, 0]
+        self.ctrl = 0
+        self.divider = 0xffff
+        self.ss = 0
+        self._done_at = None
+        self.transfers = 0
+
+    def _char_len(self):
+        char_len = self.ctrl & 0x7f
+        return char_len if char_len else SPI_MAX_CHAR_LEN
+
+    def _update(self):
+        if self._done_at is not None and time.monotonic() >= self._done_at:
+            self._done_at = None
+            self.ctrl &= ~SPI_CTRL_GO_BSY
+            self._shift()
+
+    def _shift(self):
+        nbits = self._char_len()
+        tx = sum(d << (32 * i) for i, d in enumerate(self.data)) & ((1 << nbits) - 1)
+        rx = 0
+        corrupt = self.divider < self.min_div
+        for k in range(nbits // CEE_FRAME_BITS):
+            shift = nbits - CEE_FRAME_BITS * (k + 1)
+            frame = (tx >> shift) & 0xffff
+            if corrupt:
+                frame ^= 1 << self.rng.randrange(CEE_FRAME_BITS)
+            reply = self.chip.frame(frame)
+            if corrupt:
+                reply ^= 1 << self.rng.randrange(8)
+            rx |= reply << shift
+        keep = ~((1 << nbits) - 1)
+        word = (sum(d << (32 * i) for i, d in enumerate(self.data)) & keep) | rx
+        self.data = [(word >> (32 * i)) & 0xffffffff for i in range(4)]
+        self.transfers += 1
+
+    def busy(self):
+        self._update()
+        return self._done_at is not None
+
+    def read(self, addr):
+        self._update()
+        offset = addr - self.base_addr
+        if offset < 4:
+            return self.data[offset]
+        return {4: self.ctrl, 5: self.divider, 6: self.ss}.get(offset, 0)
+
+    def write(self, addr, value):
+        busy = self.busy()
+        offset = addr - self.base_addr
+        if offset < 4:
+            if not busy:
+                self.data[offset] = value
+        elif offset == 4:
+            if not busy:
+                self.ctrl = value & 0x3fff
+                if value & SPI_CTRL_GO_BSY:
+                    duration = self._char_len() * 2 * (self.divider + 1) / SPI_CLK_FREQ
+                    self._done_at = time.monotonic() + duration
+        elif offset == 5:
+            self.divider = value & 0xffff
+        elif offset == 6:
+            self.ss = value & 0xff
+
+
+class _DacModel:
+    """DAC8568 controller: a rising edge on `start` keeps `busy` set for `busy_time`."""
+
+    def __init__(self, busy_addr, busy_mask, start_addr, start_mask, ctrl_reg, busy_time=DAC_BUSY_TIME):
+        self.busy_addr = busy_addr
+        self.busy_mask = busy_mask
+        self.start_addr = start_addr
+        self.start_mask = start_mask
+        self.ctrl_reg = ctrl_reg
+        self.busy_time = busy_time
+        self._done_at = 0.0
+        self.conversions = 0
+
+    def read(self, addr):
+        if addr == self.busy_addr:
+            return self.busy_mask if time.monotonic() < self._done_at else 0
+        return self.ctrl_reg.read(addr)
+
+    def write(self, addr, value):
+        if addr == self.busy_addr:
+            return
+        rising = value & ~self.ctrl_reg.value & self.start_mask
+        self.ctrl_reg.write(addr, value)
+        if rising:
+            self._done_at = time.monotonic() + self.busy_time
+            self.conversions += 1
+
+
+class _ReadFifoModel:
+    """
+    Data FIFO filled at `rate` words/s by `source`, drained through RFIFO_DATA.
+
+    RFIFO_LEN and RVALID_LEN report the number of words available. Reading an empty FIFO
+    returns 0 and counts an underflow; words arriving while full are lost.
+    """
+
+    def __init__(self, data_addr, len_addrs, rate=0.0, source=None, depth=FIFO_DEPTH):
+        self.data_addr = data_addr
+        self.len_addrs = len_addrs
+        self.rate = rate
+        self.source = source if source is not None else self._counter
+        self.depth = depth
+        self.words = deque()
+        self.underflows = 0
+        self.overflows = 0
+        self._count = 0
+        self._last = time.monotonic()
+        self._carry = 0.0
+
+    def _counter(self, n):
+        words = range(self._count, self._count + n)
+        self._count = (self._count + n) & 0xffffffff
+        return [w & 0xffffffff for w in words]
+
+    def _fill(self):
+        now = time.monotonic()
+        self._carry += (now - self._last) * self.rate
+        self._last = now
+        n = int(self._carry)
+        if n <= 0:
+            return
+        self._carry -= n
+        room = self.depth - len(self.words)
+        if n > room:
+            self.overflows += n - room
+            n = room
+        self.words.extend(self.source(n))
+
+    def push(self, words):
+        self.words.extend(words)
+
+    def read(self, addr):
+        self._fill()
+        if addr == self.data_addr:
+            if self.words:
+                return self.words.popleft()
+            self.underflows += 1
+            return 0
+        return len(self.words)
+
+    def write(self, addr, value):
+        pass
+
+
+class _WriteFifoModel:
+    """
+    Slow control FIFO written through WFIFO_DATA and drained by the firmware at `rate`
+    words/s (0: immediately). Drained words are handed to `sink`.
+
+    WFIFO_LEN reports the words still queued, WVALID_LEN the words the firmware has taken
+    since WFIFO_DATA was last written.
+    """
+
+    def __init__(self, data_addr, len_addr, valid_addr, rate=0.0, sink=None, depth=FIFO_DEPTH):
+        self.data_addr = data_addr
+        self.len_addr = len_addr
+        self.valid_addr = valid_addr
+        self.rate = rate
+        self.sink = sink
+        self.depth = depth
+        self.words = deque()
+        self.taken = 0
+        self.overflows = 0
+        self._last = time.monotonic()
+        self._carry = 0.0
+
+    def _drain(self):
+        now = time.monotonic()
+        if self.rate:
+            self._carry += (now - self._last) * self.rate
+            n = min(int(self._carry), len(self.words))
+            self._carry = min(self._carry - n, 1.0)
+        else:
+            n = len(self.words)
+        self._last = now
+        for _ in range(n):
+            word = self.words.popleft()
+            self.taken += 1
+            if self.sink is not None:
+                self.sink(word)
+
+    def read(self, addr):
+        self._drain()
+        if addr == self.len_addr:
+            return len(self.words)
+        if addr == self.valid_addr:
+            return self.taken
+        return 0
+
+    def write(self, addr, value):
+        if addr != self.data_addr:
+            return
+        self._drain()
+        self.taken = 0
+        if len(self.words) >= self.depth:
+            self.overflows += 1
+            return
+        self.words.append(value)
+
+
+class IPbusSimulator:
+    """
+    IPbus 2.0 UDP endpoint serving the register map of a compiled address table.
+
+    Every leaf register is plain memory restricted to its writable bits, with behavioural
+    models for the opencores SPI core (plus a CEE chip behind it), the DAC8568 controllers
+    and the RFIFO/WFIFO slaves. `latency` delays every reply and `loss` drops requests or
+    replies at random, so uhal's retry path gets exercised too. With `cmd_stream` the words
+    drained from a WFIFO are executed as lib/cmd_stream.py commands, a format the firmware
+    does not implement yet; otherwise they are only taken.
+
+    Example::
+
+        sim = IPbusSimulator(AddressTable.load("etc/sim_address.xml"), port=50001)
+        sim.start()
+        ipbus_link = IPbusLink(device_uri=sim.uri, address_table="etc/sim_address.xml")
+    """
+
+    def __init__(self, address_table, host="127.0.0.1", port=50001, latency=0.0, loss=0.0,
+                 mtu=1500, n_buffers=16, spi_min_div=0, rfifo_rate=0.0, wfifo_rate=0.0, seed=None,
+                 cmd_stream=False):
+        self.address_table = address_table
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.mtu = mtu
+        self.n_buffers = n_buffers
+        self._rng = random.Random(seed)
+
+        self.chip = CeeChipModel()
+        self.spi = []
+        self.dacs = []
+        self.rfifos = {}
+        self.wfifos = {}
+        self._handlers = {}
+        self._build(spi_min_div, rfifo_rate, wfifo_rate, cmd_stream)
+
+        self._next_id = 1
+        self._replies = OrderedDict()
+        self._sock = None
+        self._thread = None
+        self._running = False
+        self.stats = {"packets": 0, "transactions": 0, "dropped_requests": 0,
+                      "dropped_replies": 0, "resends": 0, "status": 0}
+
+    @property
+    def uri(self):
+        return "ipbusudp-2.0://{}:{}".format(self.host, self.port)
+
+    def _build(self, spi_min_div, rfifo_rate, wfifo_rate, cmd_stream):
+        writable = {}
+        for node in self.address_table:
+            # A non-incremental block is a port: `size` is the longest block, not an address range
+            size = 1 if node.mode in ("non-incremental", "port") else node.size
+            for addr in range(node.address, node.address + size):
+                mask = node.mask if "w" in node.permission else 0
+                writable[addr] = writable.get(addr, 0) | mask
+        for addr, mask in writable.items():
+            self._handlers[addr] = _Register(mask)
+
+        groups = {}
+        for node in self.address_table:
+            parent, _, reg = node.name.rpartition(".")
+            groups.setdefault(parent, {})[reg] = node
+
+        for parent, regs in groups.items():
+            if {"d0", "d1", "d2", "d3", "ctrl", "divider", "ss"} <= set(regs):
+                spi = _SpiModel(regs["d0"].address, self.chip, spi_min_div, self._rng)
+                for reg in ("d0", "d1", "d2", "d3", "ctrl", "divider", "ss"):
+                    self._handlers[regs[reg].address] = spi
+                self.spi.append(spi)
+            elif {"busy", "start"} <= set(regs):
+                start = regs["start"]
+                dac = _DacModel(regs["busy"].address, regs["busy"].mask, start.address, start.mask,
+                                self._handlers[start.address])
+                dac.regs = regs
+                self._handlers[dac.busy_addr] = dac
+                self._handlers[dac.start_addr] = dac
+                self.dacs.append(dac)
+            elif {"RFIFO_DATA", "RFIFO_LEN"} <= set(regs):
+                len_addrs = [regs[reg].address for reg in ("RFIFO_LEN", "RVALID_LEN") if reg in regs]
+                fifo = _ReadFifoModel(regs["RFIFO_DATA"].address, len_addrs, rfifo_rate)
+                for addr in [fifo.data_addr] + len_addrs:
+                    self._handlers[addr] = fifo
+                self.rfifos[parent] = fifo
+            elif {"WFIFO_DATA", "WFIFO_LEN", "WVALID_LEN"} <= set(regs):
+                fifo = _WriteFifoModel(regs["WFIFO_DATA"].address, regs["WFIFO_LEN"].address,
+                                       regs["WVALID_LEN"].address, wfifo_rate,
+                                       sink=self.slow_ctrl_cmd if cmd_stream else None)
+                for addr in (fifo.data_addr, fifo.len_addr, fifo.valid_addr):
+                    self._handlers[addr] = fifo
+                self.wfifos[parent] = fifo
+
+    def slow_ctrl_cmd(self, word):
+        """Execute one command word drained from a slow control FIFO, see lib/cmd_stream.py."""
+        cmd = word >> CMD_SHIFT
+        dev_nr = (word >> CMD_DEV_SHIFT) & 0xf
+        if cmd == CMD_CEE_FRAME:
+            self.chip.frame(word & 0xffff)
+        elif cmd in (CMD_DAC_DATA, CMD_DAC_START) and dev_nr < len(self.dacs):
+            regs = self.dacs[dev_nr].regs
+            if cmd == CMD_DAC_DATA:
+                node = regs["data_ch" + str((word >> CMD_CH_SHIFT) & 0x7)]
+                value = (word & 0xffff) << node.shift
+            else:
+                node = regs["sel_ch"]
+                value = ((word & 0xff) << node.shift) | regs["start"].mask
+            old = self.read_word(node.address)
+            self.write_word(node.address, (old & ~node.mask) | value)
+            if cmd == CMD_DAC_START:
+                self.write_word(node.address, self.read_word(node.address) & ~regs["start"].mask)
+
+    def read_word(self, addr):
+        handler = self._handlers.get(addr)
+        return None if handler is None else handler.read(addr) & 0xffffffff
+
+    def write_word(self, addr, value):
+        handler = self._handlers.get(addr)
+        if handler is None:
+            return False
+        handler.write(addr, value & 0xffffffff)
+        return True
+
+    def start(self):
+        """
+        Serve in a background thread.
+
+        :return: None
+        """
+        self._open()
+        self._thread = threading.Thread(target=self._serve, name="ipbus-sim", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        self._open()
+        self._serve()
+
+    def _open(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.settimeout(0.1)
+        self._running = True
+        log.info("IPbus simulator listening on {}".format(self.uri))
+
+    def _serve(self):
+        try:
+            while self._running:
+                try:
+                    data, peer = self._sock.recvfrom(65536)
+                except socket.timeout:
+                    continue
+                reply = self.handle_packet(data)
+                if reply is None:
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                self._sock.sendto(reply, peer)
+        finally:
+            self._sock.close()
+
+    def handle_packet(self, data):
+        """
+        Process one IPbus packet.
+
+        :param data: Request datagram.
+        :return: Reply datagram, or None when nothing should be sent back.
+        """
+        if len(data) < 4 or len(data) % 4:
+            return None
+        fmt = ">"
+        header = struct.unpack(">I", data[:4])[0]
+        if (header >> 28) != IPBUS_VERSION or ((header >> 4) & 0xf) != IPBUS_BYTE_ORDER:
+            fmt = "<"
+            header = struct.unpack("<I", data[:4])[0]
+            if (header >> 28) != IPBUS_VERSION or ((header >> 4) & 0xf) != IPBUS_BYTE_ORDER:
+                return None
+        words = list(struct.unpack(fmt + "{}I".format(len(data) // 4), data))
+        packet_id = (header >> 8) & 0xffff
+        packet_type = header & 0xf
+        self.stats["packets"] += 1
+
+        if packet_type == PKT_STATUS:
+            self.stats["status"] += 1
+            return self._pack(fmt, self._status_reply())
+        if packet_type == PKT_RESEND:
+            self.stats["resends"] += 1
+            return self._replies.get(packet_id)
+        if packet_type != PKT_CONTROL:
+            return None
+
+        if packet_id != 0 and packet_id in self._replies:
+            return self._replies[packet_id]
+        if packet_id != 0 and packet_id != self._next_id:
+            return None
+        if self.loss and self._rng.random() < self.loss:
+            self.stats["dropped_requests"] += 1
+            return None
+
+        reply = self._pack(fmt, [header] + self._transactions(words[1:]))
+        if packet_id != 0:
+            self._next_id = packet_id % 0xffff + 1
+            self._replies[packet_id] = reply
+            while len(self._replies) > self.n_buffers:
+                self._replies.popitem(last=False)
+        if self.loss and self._rng.random() < self.loss:
+            self.stats["dropped_replies"] += 1
+            return None
+        return reply
+
+    @staticmethod
+    def _pack(fmt, words):
+        return struct.pack(fmt + "{}I".format(len(words)), *words)
+
+    def _status_reply(self):
+        next_header = (IPBUS_VERSION << 28) | (self._next_id << 8) | (IPBUS_BYTE_ORDER << 4) | PKT_CONTROL
+        words = [(IPBUS_VERSION << 28) | (IPBUS_BYTE_ORDER << 4) | PKT_STATUS,
+                 self.mtu, self.n_buffers, next_header]
+        return words + [0] * 12
+
+    def _transactions(self, words):
+        out = []
+        i = 0
+        while i < len(words):
+            header = words[i]
+            tid = (header >> 16) & 0xfff
+            n = (header >> 8) & 0xff
+            ttype = (header >> 4) & 0xf
+            info = header & 0xf
+            if (header >> 28) != IPBUS_VERSION or info != INFO_REQUEST or i + 1 >= len(words):
+                out.append((header & 0xfffffff0) | INFO_BAD_HEADER)
+                break
+            addr = words[i + 1]
+            self.stats["transactions"] += 1
+
+            def reply_header(code, n_words=n):
+                return (IPBUS_VERSION << 28) | (tid << 16) | (n_words << 8) | (ttype << 4) | code
+
+            if ttype in (TRANS_READ, TRANS_NI_READ):
+                addrs = [addr + k for k in range(n)] if ttype == TRANS_READ else [addr] * n
+                values = [self.read_word(a) for a in addrs]
+                if None in values:
+                    out.append(reply_header(INFO_READ_ERROR, 0))
+                else:
+                    out.append(reply_header(INFO_SUCCESS))
+                    out.extend(values)
+                i += 2
+            elif ttype in (TRANS_WRITE, TRANS_NI_WRITE):
+                data = words[i + 2:i + 2 + n]
+                ok = True
+                for k, value in enumerate(data):
+                    ok &= self.write_word(addr + k if ttype == TRANS_WRITE else addr, value)
+                out.append(reply_header(INFO_SUCCESS if ok else INFO_WRITE_ERROR))
+                i += 2 + n
+            elif ttype == TRANS_RMW_BITS:
+                and_term, or_term = words[i + 2], words[i + 3]
+                old = self.read_word(addr)
+                if old is None:
+                    out.append(reply_header(INFO_READ_ERROR, 0))
+                else:
+                    self.write_word(addr, (old & and_term) | or_term)
+                    out.extend([reply_header(INFO_SUCCESS, 1), old])
+                i += 4
+            elif ttype == TRANS_RMW_SUM:
+                addend = words[i + 2]
+                old = self.read_word(addr)
+                if old is None:
+                    out.append(reply_header(INFO_READ_ERROR, 0))
+                else:
+                    self.write_word(addr, old + addend)
+                    out.extend([reply_header(INFO_SUCCESS, 1), old])
+                i += 3
+            elif ttype == TRANS_CONF_READ:
+                out.append(reply_header(INFO_SUCCESS))
+                out.extend([0] * n)
+                i += 2
+            elif ttype == TRANS_CONF_WRITE:
+                out.append(reply_header(INFO_SUCCESS))
+                i += 2 + n
+            else:
+                out.append(reply_header(INFO_BAD_HEADER, 0))
+                break
+        return out
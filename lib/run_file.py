@@ -0,0 +1,256 @@
+import logging
+import mmap
+import struct
+import time
+import zlib
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+# Layout, all little endian:
+#   file header | chunk 0 | chunk 1 | ... | index | footer
+#   chunk = chunk header | register snapshot (addr, known mask, value) x n | payload
+#   index = one INDEX_DTYPE entry per chunk
+RUN_FILE_MAGIC = b"CEERUN01"
+RUN_FILE_VERSION = 1
+CHUNK_MAGIC = b"CHNK"
+INDEX_MAGIC = b"CIDX"
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+FILE_HEADER = struct.Struct("<8sIIB3xdI")  # magic, version, chunk_words, compression, created, reserved
+CHUNK_HEADER = struct.Struct("<4sdIIII4x")  # magic, timestamp, n_words, payload bytes, snapshot entries, crc32
+FOOTER = struct.Struct("<QI4s")  # index offset, n_chunks, magic
+
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("timestamp", "<f8"), ("n_words", "<u4"),
+                        ("snapshot_len", "<u4"), ("payload_bytes", "<u4"), ("crc32", "<u4"),
+                        ("first_word", "<u8")])
+
+RUN_FILE_CHUNK_WORDS = 1 << 18  # 1 MB of raw words per chunk
+
+
+class RunFileWriter:
+    """
+    Writer for raw FIFO words.
+
+    Words are collected into fixed-size chunks of `chunk_words`. Each chunk is written with
+    the time its first word arrived, its word count and a snapshot of the registers, then
+    compressed. An index of all chunks is appended on close, so memory use does not depend
+    on the run length.
+
+    Example::
+
+        with RunFileWriter("run0001.ceerun", snapshot=ipbus_link.shadow_snapshot) as writer:
+            for chunk in reader:
+                writer.write(chunk)
+    """
+
+    def __init__(self, path, chunk_words=RUN_FILE_CHUNK_WORDS, compression=COMPRESSION_ZLIB,
+                 level=1, snapshot=None):
+        """
+        :param path: Output file, overwritten.
+        :param chunk_words: Words per chunk.
+        :param compression: COMPRESSION_ZLIB or COMPRESSION_NONE. Uncompressed files are read back zero-copy.
+        :param level: zlib level, 1 keeps up with the readout.
+        :param snapshot: Callable returning {address: (known mask, value)}, e.g. IPbusLink.shadow_snapshot.
+        """
+        if compression not in (COMPRESSION_NONE, COMPRESSION_ZLIB):
+            raise ValueError('Unexpected compression: {}'.format(compression))
+        self.path = path
+        self.chunk_words = chunk_words
+        self.compression = compression
+        self.level = level
+        self.snapshot = snapshot
+
+        self._f = open(path, "wb")
+        self._f.write(FILE_HEADER.pack(RUN_FILE_MAGIC, RUN_FILE_VERSION, chunk_words, compression, time.time(), 0))
+        self._buf = np.empty(chunk_words, dtype="<u4")
+        self._fill = 0
+        self._t_first = None
+        self._index = []
+        self.words = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, words):
+        """
+        Append words to the run.
+
+        :param words: numpy.uint32 array or list of words.
+        :return: None
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        pos = 0
+        while pos < len(words):
+            if self._fill == 0:
+                self._t_first = time.time()
+            n = min(self.chunk_words - self._fill, len(words) - pos)
+            self._buf[self._fill:self._fill + n] = words[pos:pos + n]
+            self._fill += n
+            pos += n
+            if self._fill == self.chunk_words:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        raw = self._buf[:self._fill].tobytes()
+        payload = zlib.compress(raw, self.level) if self.compression == COMPRESSION_ZLIB else raw
+        snapshot = self.snapshot() if self.snapshot is not None else {}
+        snap = np.array([(addr, mask, value) for addr, (mask, value) in sorted(snapshot.items())],
+                        dtype="<u4").reshape(-1, 3)
+        crc = zlib.crc32(raw)
+        offset = self._f.tell()
+        self._f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._t_first, self._fill, len(payload), len(snap), crc))
+        self._f.write(snap.tobytes())
+        self._f.write(payload)
+        self._index.append((offset, self._t_first, self._fill, len(snap), len(payload), crc, self.words))
+        self.words += self._fill
+        self._fill = 0
+
+    def flush(self):
+        """
+        Write the current partial chunk now, e.g. before a long pause.
+
+        :return: None
+        """
+        if self._fill:
+            self._write_chunk()
+        self._f.flush()
+
+    def close(self):
+        if self._f is None:
+            return
+        self.flush()
+        index_offset = self._f.tell()
+        self._f.write(np.array(self._index, dtype=INDEX_DTYPE).tobytes())
+        self._f.write(FOOTER.pack(index_offset, len(self._index), INDEX_MAGIC))
+        self._f.close()
+        self._f = None
+        log.info("Run file {} closed: {} words in {} chunks".format(self.path, self.words, len(self._index)))
+
+
+class RunFileReader:
+    """
+    Memory mapped reader for files written by :class:`RunFileWriter`.
+
+    Chunks are located through the trailing index. If the file was not closed properly
+    the index is rebuilt by walking the chunk headers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk_words, self.compression, self.created, _ = FILE_HEADER.unpack_from(self._mm, 0)
+        if magic != RUN_FILE_MAGIC or version != RUN_FILE_VERSION:
+            raise ValueError('Unexpected file format: {}'.format(path))
+        self.index = self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.index = None
+        try:
+            self._mm.close()
+        except BufferError:
+            # Chunk views handed out still reference the mapping, it is released with them
+            pass
+        self._f.close()
+
+    def _load_index(self):
+        size = len(self._mm)
+        if size >= FILE_HEADER.size + FOOTER.size:
+            index_offset, n_chunks, magic = FOOTER.unpack_from(self._mm, size - FOOTER.size)
+            if magic == INDEX_MAGIC and index_offset + n_chunks * INDEX_DTYPE.itemsize == size - FOOTER.size:
+                return np.frombuffer(self._mm, dtype=INDEX_DTYPE, count=n_chunks, offset=index_offset)
+        log.warning("Run file {} has no index, scanning chunks".format(self.path))
+        return self._scan()
+
+    def _scan(self):
+        entries = []
+        offset = FILE_HEADER.size
+        first_word = 0
+        while offset + CHUNK_HEADER.size <= len(self._mm):
+            magic, t, n_words, payload_bytes, snapshot_len, crc = CHUNK_HEADER.unpack_from(self._mm, offset)
+            end = offset + CHUNK_HEADER.size + snapshot_len * 12 + payload_bytes
+            if magic != CHUNK_MAGIC or end > len(self._mm):
+                break
+            entries.append((offset, t, n_words, snapshot_len, payload_bytes, crc, first_word))
+            first_word += n_words
+            offset = end
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def words(self):
+        if len(self.index) == 0:
+            return 0
+        return int(self.index["first_word"][-1] + self.index["n_words"][-1])
+
+    def chunk(self, i, verify=False):
+        """
+        Words of chunk `i`.
+
+        :param i: Chunk number.
+        :param verify: Check the CRC of the decoded words.
+        :return: numpy.uint32 array; a read-only view of the mapped file when uncompressed.
+        """
+        entry = self.index[i]
+        start = int(entry["offset"]) + CHUNK_HEADER.size + int(entry["snapshot_len"]) * 12
+        n_words = int(entry["n_words"])
+        if self.compression == COMPRESSION_NONE:
+            words = np.frombuffer(self._mm, dtype="<u4", count=n_words, offset=start)
+        else:
+            raw = zlib.decompress(self._mm[start:start + int(entry["payload_bytes"])])
+            words = np.frombuffer(raw, dtype="<u4", count=n_words)
+        if verify and zlib.crc32(words.tobytes()) != int(entry["crc32"]):
+            raise ValueError('CRC mismatch in chunk {} of {}'.format(i, self.path))
+        return words
+
+    def snapshot(self, i):
+        """
+        Register snapshot stored with chunk `i`.
+
+        :return: dict, address -> (known mask, value)
+        """
+        entry = self.index[i]
+        snap = np.frombuffer(self._mm, dtype="<u4", count=int(entry["snapshot_len"]) * 3,
+                             offset=int(entry["offset"]) + CHUNK_HEADER.size).reshape(-1, 3)
+        return {int(addr): (int(mask), int(value)) for addr, mask, value in snap}
+
+    def timestamp(self, i):
+        return float(self.index[i]["timestamp"])
+
+    def chunks_between(self, t_start, t_stop):
+        """
+        Chunk numbers overlapping the time window [t_start, t_stop), found by bisection.
+
+        :param t_start: Unix time.
+        :param t_stop: Unix time.
+        :return: range of chunk numbers.
+        """
+        timestamps = self.index["timestamp"]
+        first = max(int(np.searchsorted(timestamps, t_start, side="right")) - 1, 0)
+        last = int(np.searchsorted(timestamps, t_stop, side="left"))
+        return range(first, last)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.chunk(i)
@@ -0,0 +1,266 @@
+import json
+import logging
+import math
+import time
+
+import numpy as np
+
+from lib.cee_defs import *
+from lib.cee_spi_config import CeeSpiConfig
+from lib.dac8568_bank import Dac8568Bank
+from lib.dac8568_defs import *
+from lib.dac8568_device import Dac8568Device
+from lib.global_device import GlobalDevice
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+RESET_NAMES = ("nuke", "soft_rst")
+SPI_KEYS = ("data_len", "ie", "ass", "lsb", "rx_neg", "tx_neg", "div", "ss")
+TRANS_PER_DISPATCH = 64
+
+
+def _int(value):
+    """Plan numbers may be given as strings, e.g. "0x1f"."""
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+class RunPlan:
+    """
+    Board bring-up described as data instead of code.
+
+    A plan is a JSON object, every section is optional and runs in this order::
+
+        {
+          "reset": ["soft_rst"],
+          "dac": {"0": {"reset": true, "volts": {"0": 1.0}},
+                  "1": {"reset": true, "volts": {"1": 1.0}}},
+          "spi": {"div": 4},
+          "pixels": [{"pixels": [1], "trim": 15, "we": 1, "pulse_en": 1, "mask": 0}],
+          "cee_registers": {"0x01": 0}
+        }
+
+    `dac` gives the voltages per device and channel, `spi` the arguments of
+    CeeSpiConfig.set_spi, `pixels` pixel configurations ("pixels": "all" for the whole
+    matrix, later entries win) and `cee_registers` CEE register values written after the
+    pixels.
+
+    :meth:`compile` turns the plan into a schedule with as few round trips as possible:
+    all resets in one dispatch, the DAC devices reset together and set by one
+    Dac8568Bank.update ordered to avoid dac_nr switches, and every CEE frame packed into
+    one stream of SPI transfers.
+    """
+
+    def __init__(self, plan, name="plan"):
+        """
+        :param plan: dict as described above.
+        :param name: Shown in the reports, e.g. the file name.
+        """
+        unknown = set(plan) - {"reset", "dac", "spi", "pixels", "cee_registers", "description"}
+        if unknown:
+            raise ValueError('Unexpected run plan sections: {}'.format(sorted(unknown)))
+        self.plan = plan
+        self.name = name
+        self.resets = list(plan.get("reset", []))
+        for reset in self.resets:
+            if reset not in RESET_NAMES:
+                raise ValueError('Unexpected reset: {}, should be one of {}'.format(reset, RESET_NAMES))
+        self.dac = self._parse_dac(plan.get("dac", {}))
+        self.spi = dict(plan.get("spi", {}))
+        unknown = set(self.spi) - set(SPI_KEYS)
+        if unknown:
+            raise ValueError('Unexpected SPI settings: {}'.format(sorted(unknown)))
+        self.pixel_words, self.pixels = self._parse_pixels(plan.get("pixels", []))
+        self.cee_registers = [(_int(addr), _int(data)) for addr, data in plan.get("cee_registers", {}).items()]
+        for addr, data in self.cee_registers:
+            if addr not in range(0, 1 << 7) or data not in range(0, 1 << 8):
+                raise ValueError('Unexpected CEE register write: {:#x} = {:#x}'.format(addr, data))
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: JSON run plan, e.g. "etc/plans/default.json".
+        :return: RunPlan
+        """
+        with open(path) as f:
+            return cls(json.load(f), name=path)
+
+    @staticmethod
+    def _parse_dac(dac):
+        devices = []
+        for dev_nr, conf in sorted(dac.items(), key=lambda item: _int(item[0])):
+            volts = conf.get("volts", {})
+            if isinstance(volts, list):
+                volts = dict(enumerate(volts))
+            chs = np.array([_int(ch) for ch in volts], dtype=np.int64)
+            if chs.size and (chs.min() < 0 or chs.max() >= DAC8568_CH_NUM):
+                raise ValueError('Unexpected DAC{} channel: {}'.format(dev_nr, chs))
+            # Checks the range before anything is sent
+            codes = Dac8568Device.volts_2_codes(list(volts.values()))
+            devices.append((_int(dev_nr), bool(conf.get("reset", False)), chs, codes))
+        return devices
+
+    @staticmethod
+    def _parse_pixels(entries):
+        words = np.zeros(CEE_PIXEL_NUM, dtype=np.uint16)
+        named = np.zeros(CEE_PIXEL_NUM, dtype=bool)
+        for entry in entries:
+            pixels = entry.get("pixels", "all")
+            pixels = np.arange(CEE_PIXEL_NUM) if pixels == "all" else np.asarray(
+                [_int(pixel) for pixel in pixels], dtype=np.intp)
+            words[pixels] = CeeSpiConfig.encode_pixel_conf(_int(entry.get("trim", 0)), entry.get("we", 1),
+                                                           entry.get("pulse_en", 0), entry.get("mask", 0))[pixels]
+            named[pixels] = True
+        return words, np.flatnonzero(named)
+
+    def _dac_order(self, dac_nr):
+        """Devices to set, starting with the one selected by dac_nr."""
+        devices = [dev for dev in self.dac if dev[2].size]
+        devices.sort(key=lambda dev: dev[0] != dac_nr)
+        return devices
+
+    def compile(self, cee_spi_config=None, dac_nr=None):
+        """
+        Schedule of the plan.
+
+        :param cee_spi_config: Pixels it already holds are not sent again, its frames_per_trans is used.
+                               Default: none known.
+        :param dac_nr: dac_nr selected on the board. Default: unknown.
+        :return: List of steps, dict with kind, text and round_trips.
+        """
+        steps = []
+        if self.resets:
+            steps.append({"kind": "reset", "names": self.resets, "round_trips": 1,
+                          "text": "global_dev: " + ", ".join(self.resets)})
+
+        reset_nrs = [dev_nr for dev_nr, reset, _, _ in self.dac if reset]
+        if reset_nrs:
+            steps.append({"kind": "dac_reset", "dev_nrs": reset_nrs, "round_trips": 1,
+                          "text": "DAC8568 reset, dac_nr " + ", ".join(str(nr) for nr in reset_nrs)})
+            dac_nr = reset_nrs[-1]
+        devices = self._dac_order(dac_nr)
+        if devices:
+            text = "; ".join("DAC{} ".format(dev_nr) + " ".join("ch{}={:#06x}".format(ch, code)
+                                                              for ch, code in zip(chs, codes))
+                             for dev_nr, _, chs, codes in devices)
+            # One dispatch for the data and the first start, a busy poll and a start for every further device
+            steps.append({"kind": "dac", "changes": [(dev_nr, chs, codes) for dev_nr, _, chs, codes in devices],
+                          "round_trips": 2 * len(devices) - 1, "text": text})
+
+        if self.spi:
+            steps.append({"kind": "spi", "settings": self.spi, "round_trips": 2,
+                          "text": " ".join("{}={}".format(key, value) for key, value in self.spi.items())})
+
+        pixels = self.pixels
+        if cee_spi_config is not None and len(pixels):
+            pixels = np.intersect1d(pixels, cee_spi_config.changed_pixels(self.pixel_words))
+        frames = np.concatenate([CeeSpiConfig.pixel_frames(pixels, self.pixel_words[pixels]),
+                                 np.array([(addr << CEE_FRAME_ADDR_SHIFT) | data
+                                           for addr, data in self.cee_registers], dtype=np.uint32)])
+        if len(frames):
+            frames_per_trans = (cee_spi_config.frames_per_trans if cee_spi_config is not None
+                                else CEE_SPI_FRAMES_PER_TRANS)
+            n_full, n_rest = divmod(len(frames), frames_per_trans)
+            round_trips = math.ceil(n_full / TRANS_PER_DISPATCH) + (1 if n_rest else 0)
+            steps.append({"kind": "cee", "frames": frames, "pixels": pixels, "words": self.pixel_words[pixels],
+                          "round_trips": round_trips,
+                          "text": "{} pixels, {} registers: {} frames in {} SPI transfers".format(
+                              len(pixels), len(self.cee_registers), len(frames), n_full + (1 if n_rest else 0))})
+        return steps
+
+    def format_schedule(self, steps=None):
+        """
+        :param steps: From compile. Default: compile().
+        :return: str, one line per step and the total of round trips.
+        """
+        if steps is None:
+            steps = self.compile()
+        lines = ["Run plan {}:".format(self.name)]
+        for i, step in enumerate(steps):
+            lines.append("{:3d} {:10s} {:3d} RT  {}".format(i + 1, step["kind"], step["round_trips"], step["text"]))
+        lines.append("    planned round trips: {}".format(sum(step["round_trips"] for step in steps)))
+        return "\n".join(lines)
+
+
+class RunPlanExecutor:
+    """
+    Runs a RunPlan on a board and counts the round trips every step really took.
+
+    Example::
+
+        executor = RunPlanExecutor(ipbus_link)
+        report = executor.execute(RunPlan.load("etc/plans/default.json"))
+    """
+
+    def __init__(self, ipbus_link, global_dev=None, bank=None, cee_spi_config=None):
+        """
+        :param ipbus_link: IPbusLink.
+        :param global_dev: GlobalDevice. Default: a new one.
+        :param bank: Dac8568Bank. Default: a new one on every DAC device.
+        :param cee_spi_config: CeeSpiConfig. Default: a new one.
+        """
+        self._ipbus_link = ipbus_link
+        self.global_dev = global_dev if global_dev is not None else GlobalDevice(ipbus_link)
+        self.bank = bank if bank is not None else Dac8568Bank(ipbus_link, self.global_dev)
+        self.cee = cee_spi_config if cee_spi_config is not None else CeeSpiConfig(ipbus_link)
+        self.dac_nr = None
+
+    def execute(self, plan):
+        """
+        :param plan: RunPlan.
+        :return: dict with planned and actual round trips, seconds, and the same per step.
+        """
+        steps = plan.compile(self.cee, self.dac_nr)
+        own_stats = self._ipbus_link.stats is None
+        stats = self._ipbus_link.enable_stats() if own_stats else self._ipbus_link.stats
+        report = {"plan": plan.name, "steps": []}
+        t_start = time.perf_counter()
+        try:
+            for step in steps:
+                n_dispatch = stats.counters["dispatches"]
+                t_step = time.perf_counter()
+                getattr(self, "_run_" + step["kind"])(step)
+                report["steps"].append({"kind": step["kind"], "planned": step["round_trips"],
+                                        "actual": stats.counters["dispatches"] - n_dispatch,
+                                        "seconds": time.perf_counter() - t_step})
+        finally:
+            if own_stats:
+                self._ipbus_link.disable_stats()
+        report["seconds"] = time.perf_counter() - t_start
+        report["planned"] = sum(step["planned"] for step in report["steps"])
+        report["actual"] = sum(step["actual"] for step in report["steps"])
+        log.info("Run plan {}: {} round trips planned, {} actual, {:.3f} s".format(
+            plan.name, report["planned"], report["actual"], report["seconds"]))
+        return report
+
+    def _run_reset(self, step):
+        with self._ipbus_link.batch():
+            for name in step["names"]:
+                self.global_dev.set_bit(name)
+        # Firmware registers are back to their defaults
+        self._ipbus_link.invalidate_shadow()
+        self.dac_nr = None
+
+    def _run_dac_reset(self, step):
+        with self._ipbus_link.batch():
+            for dev_nr in step["dev_nrs"]:
+                self.global_dev.set_dac_nr(dev_nr)
+                self.bank.devices[self.bank.dev_nrs.index(dev_nr)].reset_dev()
+        self.dac_nr = step["dev_nrs"][-1]
+
+    def _run_dac(self, step):
+        self.bank.update(step["changes"])
+        self.dac_nr = step["changes"][-1][0]
+
+    def _run_spi(self, step):
+        self.cee.set_spi(**step["settings"])
+
+    def _run_cee(self, step):
+        self.cee.write_frames(step["frames"], trans_per_dispatch=TRANS_PER_DISPATCH)
+        self.cee.pixel_words[step["pixels"]] = step["words"]
+        self.cee.pixel_known[step["pixels"]] = True
@@ -0,0 +1,200 @@
+import logging
+
+import numpy as np
+
+from lib.cee_data import hit_counts
+from lib.cee_defs import *
+from lib.dac8568_defs import *
+from lib.dac_scan import DacScan
+from lib.fifo_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class SCurveFit:
+    """
+    Incremental S-curve fit of all pixels at once.
+
+    The occupancy of every pixel is an error function of the scanned value, so its step to
+    step difference is a Gaussian. Its mean is the threshold and its width the noise.
+    Both come from the running moments of that difference, updated in O(pixels) as each
+    step arrives, so the maps are ready when the last step is read.
+    """
+
+    def __init__(self, n_pixels=CEE_PIXEL_NUM, rising=True):
+        """
+        :param n_pixels: Pixels per step.
+        :param rising: Occupancy rises with the scanned value, e.g. injection scans.
+                       False for threshold scans.
+        """
+        self.sign = 1.0 if rising else -1.0
+        self._prev_value = None
+        self._prev_occ = None
+        self._s0 = np.zeros(n_pixels)
+        self._s1 = np.zeros(n_pixels)
+        self._s2 = np.zeros(n_pixels)
+
+    def add(self, value, occupancy):
+        """
+        Add the next step of the scan, values must be monotonic.
+
+        :param value: Scanned value of this step.
+        :param occupancy: Per-pixel hit probability at this step.
+        :return: None
+        """
+        occupancy = np.asarray(occupancy, dtype=np.float64)
+        if self._prev_occ is not None:
+            weight = (occupancy - self._prev_occ) * self.sign
+            mid = (value + self._prev_value) / 2
+            self._s0 += weight
+            self._s1 += weight * mid
+            self._s2 += weight * mid * mid
+        self._prev_value = value
+        self._prev_occ = occupancy
+
+    def threshold(self):
+        """
+        :return: Per-pixel threshold, nan where the S-curve was not seen.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self._s0 > 0, self._s1 / self._s0, np.nan)
+
+    def noise(self):
+        """
+        :return: Per-pixel S-curve width, nan where the S-curve was not seen.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self._s1 / self._s0
+            var = self._s2 / self._s0 - mean * mean
+            return np.where(self._s0 > 0, np.sqrt(np.maximum(var, 0.0)), np.nan)
+
+
+class SCurveScan:
+    """
+    S-curve scan of the pixel matrix.
+
+    The test pulse is enabled on the scanned pixels through apply_matrix, then one DAC
+    channel, the injection amplitude or the threshold, is stepped with :class:`DacScan`.
+    At every step `inject(value)` fires the test pulses, and the data FIFO is drained
+    while the next step settles. Hits are counted per pixel and fed to :class:`SCurveFit`.
+
+    Example::
+
+        scan = SCurveScan(ipbus_link, cee_spi_dev, Dac8568Bank(ipbus_link), dac=(0, 3),
+                          values=np.linspace(0.2, 1.2, 101), inject=pulser.fire, n_inject=100)
+        scan.run()
+        scan.save("scurve.npz")
+    """
+
+    def __init__(self, ipbus_link, cee_spi_config, bank, dac, values, inject, n_inject, pixels=None,
+                 rising=True, reg_name_base=DATA_FIFO_BASE, fifo_name=DATA_FIFO_NAME,
+                 settle_time=DAC8568_SETTLE_TIME):
+        """
+        :param ipbus_link: IPbusLink.
+        :param cee_spi_config: CeeSpiConfig of the chip.
+        :param bank: Dac8568Bank.
+        :param dac: (dev_nr, ch) of the scanned DAC channel.
+        :param values: Voltages to step through, monotonic.
+        :param inject: Called as inject(value) at every step, should fire `n_inject` test pulses.
+        :param n_inject: Test pulses per step.
+        :param pixels: Pixels with the test pulse enabled. Default: the whole matrix.
+        :param rising: See SCurveFit.
+        :param reg_name_base: Register name base of the data FIFO.
+        :param fifo_name: Data FIFO node name.
+        :param settle_time: Settling after each DAC step, unit: s.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        steps = np.diff(values)
+        if not ((steps > 0).all() or (steps < 0).all()):
+            raise ValueError('Unexpected scan values, should be strictly monotonic')
+        self._ipbus_link = ipbus_link
+        self.cee_spi_config = cee_spi_config
+        self.bank = bank
+        self.dac = dac
+        self.values = values
+        self.inject = inject
+        self.n_inject = n_inject
+        self.pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels)
+        self.rising = rising
+        self.reg_name_base = reg_name_base
+        self.fifo_name = fifo_name
+        self.settle_time = settle_time
+
+        self.counts = np.zeros((len(values), CEE_PIXEL_NUM), dtype=np.uint32)
+        self.fit = SCurveFit(CEE_PIXEL_NUM, rising)
+        self._step = 0
+        self._buf = np.empty(FIFO_CHUNK_WORDS, dtype=np.uint32)
+
+    def _set_pulse(self, pulse_en):
+        conf = self.cee_spi_config.decode_pixel_conf(self.cee_spi_config.pixel_words)
+        self.cee_spi_config.apply_matrix(conf["trim"], we=1, pulse_en=pulse_en, mask=conf["mask"])
+
+    def _inject(self, point):
+        self.inject(point[0][2])
+
+    def _readout(self, point):
+        """Drain the data FIFO into the counts of the current step and update the fit."""
+        counts = self.counts[self._step]
+        while True:
+            words = self._ipbus_link.read_ipb_data_fifo_chunk(self.reg_name_base, self.fifo_name,
+                                                              len(self._buf), out=self._buf)
+            if len(words) == 0:
+                break
+            hit_counts(words, out=counts)
+        self.fit.add(self.values[self._step], counts / self.n_inject)
+        self._step += 1
+        return int(counts.sum())
+
+    def run(self):
+        """
+        :return: Per-pixel counts, array of shape (steps, CEE_PIXEL_NUM).
+        """
+        self.counts[:] = 0
+        self.fit = SCurveFit(CEE_PIXEL_NUM, self.rising)
+        self._step = 0
+        pulse_en = np.zeros(CEE_PIXEL_NUM, dtype=np.int64)
+        pulse_en[self.pixels] = 1
+        pulse_prev = self.cee_spi_config.decode_pixel_conf(self.cee_spi_config.pixel_words)["pulse_en"]
+        self._set_pulse(pulse_en)
+        try:
+            dev_nr, ch = self.dac
+            points = [(dev_nr, ch, value) for value in self.values]
+            DacScan(self.bank, points, callback=self._inject, readout=self._readout, reorder=False,
+                    settle_time=self.settle_time).run()
+        finally:
+            self._set_pulse(pulse_prev)
+        log.info("S-curve scan done: {} steps, {} pixels, median threshold {:.4f}, median noise {:.4f}".format(
+            len(self.values), len(self.pixels), np.nanmedian(self.threshold()[self.pixels]),
+            np.nanmedian(self.noise()[self.pixels])))
+        return self.counts
+
+    def measure(self):
+        """
+        Run the scan and return the thresholds, e.g. as the measurement of TrimTuning.
+
+        :return: Per-pixel threshold.
+        """
+        self.run()
+        return self.threshold()
+
+    def threshold(self):
+        return self.fit.threshold()
+
+    def noise(self):
+        return self.fit.noise()
+
+    def save(self, path):
+        """
+        Save the threshold and noise maps with the raw counts.
+
+        :param path: .npz file.
+        :return: None
+        """
+        np.savez(path, threshold=self.threshold(), noise=self.noise(), counts=self.counts,
+                 values=self.values, n_inject=self.n_inject, pixels=self.pixels, dac=np.asarray(self.dac))
@@ -0,0 +1,332 @@
+import logging
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+# Layout of the shared memory block: int64 header | int64 consumer slots | uint32 words
+# Positions (head, tails) count words since the start and never wrap, the index in the
+# ring is position & (capacity - 1). Every field has a single writer and is updated with
+# one aligned 64-bit store: the producer owns the header, each consumer its slot.
+SHM_RING_MAGIC = 0x474e495245454321  # "!CEERING"
+HDR_MAGIC = 0
+HDR_CAPACITY = 1
+HDR_SLOTS = 2
+HDR_HEAD = 3  # words published
+HDR_RESERVED = 4  # end of the region the producer may be writing
+HDR_CLOSED = 5  # set by the producer after the last word
+HDR_STOP = 6  # stop request to the producer
+HDR_DROPPED = 7  # words the producer discarded, ring full with the "drop" policy
+HDR_STALLS = 8  # times the producer waited for room with the "block" policy
+HDR_STALL_NS = 9  # time spent waiting for room
+HDR_FIELDS = 16
+
+SLOT_STATE = 0
+SLOT_LOSSY = 1  # 0: the producer never overwrites words not released, 1: it does not wait, e.g. for a monitor
+SLOT_TAIL = 2  # words released by the consumer
+SLOT_DROPPED = 3  # words a lossy consumer lost, overwritten before it got to them
+SLOT_PID = 4
+SLOT_FIELDS = 5
+
+SLOT_FREE = 0
+SLOT_ACTIVE = 1
+SLOT_DONE = 2  # detached, kept for the stats
+
+SHM_RING_SLOTS = 8
+SHM_RING_WORDS = 1 << 24  # 64 MB
+
+
+class ShmRing:
+    """
+    Single producer, many consumer ring of uint32 words in shared memory.
+
+    The producer writes straight into the ring (:meth:`reserve` / :meth:`commit`) and
+    consumers get numpy views of it (:meth:`read` / :meth:`release`), so words are never
+    copied between processes. There are no locks: the producer only moves the head and
+    every consumer only moves its own tail.
+
+    Blocking consumers (disk writer) hold the producer back when they fall a whole ring
+    behind; lossy consumers (histogrammer, monitor) skip what was overwritten and count it.
+
+    Example::
+
+        ring = ShmRing.create(1 << 24)             # acquisition process
+        reader = ShmRing.attach(ring.name).reader(0)  # consumer process
+        for chunk in reader:
+            process(chunk)
+    """
+
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        self.name = shm.name
+        self.header = np.ndarray(HDR_FIELDS, dtype=np.int64, buffer=shm.buf)
+        if self.header[HDR_MAGIC] != SHM_RING_MAGIC:
+            raise ValueError('Unexpected shared memory block {}: not a ring'.format(shm.name))
+        self.capacity = int(self.header[HDR_CAPACITY])
+        self.n_slots = int(self.header[HDR_SLOTS])
+        self.slots = np.ndarray((self.n_slots, SLOT_FIELDS), dtype=np.int64, buffer=shm.buf,
+                                offset=HDR_FIELDS * 8)
+        self.words = np.ndarray(self.capacity, dtype=np.uint32, buffer=shm.buf,
+                                offset=self._data_offset(self.n_slots))
+        self._mask = self.capacity - 1
+
+    @staticmethod
+    def _data_offset(n_slots):
+        # Words start on a cache line
+        return ((HDR_FIELDS + n_slots * SLOT_FIELDS) * 8 + 63) // 64 * 64
+
+    @classmethod
+    def create(cls, capacity=SHM_RING_WORDS, n_slots=SHM_RING_SLOTS, name=None):
+        """
+        :param capacity: Ring size, a power of two, unit: word.
+        :param n_slots: Most consumers attached at once.
+        :param name: Shared memory name. Default: chosen by the system.
+        :return: ShmRing owning the block, which is removed on close.
+        """
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError('Unexpected ring capacity: {}, should be a power of two'.format(capacity))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls._data_offset(n_slots) + capacity * 4)
+        header = np.ndarray(HDR_FIELDS, dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        np.ndarray((n_slots, SLOT_FIELDS), dtype=np.int64, buffer=shm.buf, offset=HDR_FIELDS * 8)[:] = 0
+        header[HDR_CAPACITY] = capacity
+        header[HDR_SLOTS] = n_slots
+        header[HDR_MAGIC] = SHM_RING_MAGIC
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        :param name: `name` of the ring created by the acquisition process.
+        :return: ShmRing
+        """
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    def close(self):
+        """Detach; the creator also removes the block."""
+        if self._shm is None:
+            return
+        self.header = self.slots = self.words = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Consumer slots
+
+    def open_slot(self, slot, lossy=False, pid=0):
+        """
+        Claim a consumer slot, reading from the current head on. Slots are handed out by
+        the process creating the consumers, see Acquisition.add_consumer.
+
+        :param slot: 0 to n_slots - 1.
+        :param lossy: Do not hold the producer back.
+        :param pid: Shown in the stats.
+        :return: None
+        """
+        if self.slots[slot, SLOT_STATE] not in (SLOT_FREE, SLOT_DONE):
+            raise ValueError('Unexpected ring slot {}: already in use'.format(slot))
+        self.slots[slot, SLOT_TAIL] = self.header[HDR_HEAD]
+        self.slots[slot, SLOT_DROPPED] = 0
+        self.slots[slot, SLOT_PID] = pid
+        self.slots[slot, SLOT_LOSSY] = int(lossy)
+        self.slots[slot, SLOT_STATE] = SLOT_ACTIVE
+
+    def close_slot(self, slot):
+        self.slots[slot, SLOT_STATE] = SLOT_DONE
+
+    def reader(self, slot, lossy=False, idle_sleep=1e-3):
+        """
+        :return: ShmRingReader on a slot claimed now.
+        """
+        return ShmRingReader(self, slot, lossy, idle_sleep)
+
+    # Producer
+
+    def free_words(self):
+        """
+        Room left before the slowest blocking consumer, the whole ring if there is none.
+
+        :return: Unit: word.
+        """
+        head = int(self.header[HDR_HEAD])
+        blocking = (self.slots[:, SLOT_STATE] == SLOT_ACTIVE) & (self.slots[:, SLOT_LOSSY] == 0)
+        if not blocking.any():
+            return self.capacity
+        return self.capacity - (head - int(self.slots[blocking, SLOT_TAIL].min()))
+
+    def reserve(self, max_words):
+        """
+        Contiguous free part of the ring to write into, for :meth:`commit`.
+
+        :param max_words: Largest region wanted.
+        :return: numpy.uint32 view, empty when the ring is full.
+        """
+        head = int(self.header[HDR_HEAD])
+        n = min(max_words, self.free_words(), self.capacity - (head & self._mask))
+        self.header[HDR_RESERVED] = head + n
+        return self.words[head & self._mask:(head & self._mask) + n]
+
+    def commit(self, n_words):
+        """Publish the first `n_words` of the region from :meth:`reserve`."""
+        self.header[HDR_HEAD] += n_words
+
+    def write(self, words):
+        """
+        Copy words in, waiting for room while a blocking consumer lags.
+
+        :param words: numpy.uint32 array.
+        :return: None
+        """
+        pos = 0
+        while pos < len(words):
+            view = self.reserve(len(words) - pos)
+            if not len(view):
+                self.wait_for_room()
+                continue
+            view[:] = words[pos:pos + len(view)]
+            self.commit(len(view))
+            pos += len(view)
+
+    def wait_for_room(self, sleep=1e-4):
+        """Backpressure: one pause of the producer, counted in the stats."""
+        t_start = time.perf_counter_ns()
+        time.sleep(sleep)
+        self.header[HDR_STALLS] += 1
+        self.header[HDR_STALL_NS] += time.perf_counter_ns() - t_start
+
+    def drop(self, n_words):
+        """Count words the producer discarded because the ring was full."""
+        self.header[HDR_DROPPED] += n_words
+
+    def close_writer(self):
+        """No more words: consumers stop once they have read everything."""
+        self.header[HDR_CLOSED] = 1
+
+    def request_stop(self):
+        """Ask the producer to finish, from any process."""
+        self.header[HDR_STOP] = 1
+
+    def stop_requested(self):
+        return bool(self.header[HDR_STOP])
+
+    def closed(self):
+        return bool(self.header[HDR_CLOSED])
+
+    def stats(self):
+        """
+        :return: dict: words produced and dropped, producer stalls, and per consumer slot its lag and drops.
+        """
+        head = int(self.header[HDR_HEAD])
+        consumers = []
+        for slot in range(self.n_slots):
+            state, lossy, tail, dropped, pid = (int(val) for val in self.slots[slot])
+            if state != SLOT_FREE:
+                consumers.append({"slot": slot, "pid": pid, "lossy": bool(lossy), "done": state == SLOT_DONE,
+                                  "consumed": tail, "lag": max(head - tail, 0), "dropped": dropped})
+        return {"capacity": self.capacity, "produced": head, "dropped": int(self.header[HDR_DROPPED]),
+                "stalls": int(self.header[HDR_STALLS]), "stall_seconds": int(self.header[HDR_STALL_NS]) * 1e-9,
+                "free": self.free_words(), "consumers": consumers}
+
+
+class ShmRingReader:
+    """
+    Consumer side of a ShmRing slot.
+
+    Iterating yields numpy.uint32 views into the ring, each valid until the next one is
+    asked for, and ends once the producer closed the ring and everything was read.
+    """
+
+    def __init__(self, ring, slot, lossy=False, idle_sleep=1e-3):
+        self.ring = ring
+        self.slot = slot
+        self.lossy = lossy
+        self.idle_sleep = idle_sleep
+        ring.open_slot(slot, lossy, os.getpid())
+        self._slot = ring.slots[slot]
+        self._pending = 0
+        self.words = 0
+        self.chunks = 0
+
+    def read(self, max_words=None):
+        """
+        Next contiguous words not read yet, as a view into the ring. The previous view is released.
+
+        :param max_words: Largest view. Default: whatever is there.
+        :return: numpy.uint32 view, empty if nothing new was written.
+        """
+        self.release()
+        ring = self.ring
+        head = int(ring.header[HDR_HEAD])
+        tail = int(self._slot[SLOT_TAIL])
+        if self.lossy:
+            # Words that may be overwritten while the view is held are skipped
+            lost = int(ring.header[HDR_RESERVED]) - ring.capacity - tail
+            if lost > 0:
+                self._slot[SLOT_DROPPED] += lost
+                tail += lost
+                self._slot[SLOT_TAIL] = tail
+        start = tail & (ring.capacity - 1)
+        n = min(head - tail, ring.capacity - start)
+        if max_words is not None:
+            n = min(n, max_words)
+        self._pending = n
+        return ring.words[start:start + n]
+
+    def release(self):
+        """
+        Give the words of the last view back to the producer.
+
+        :return: False if a lossy consumer's view was overwritten while it was held.
+        """
+        n, self._pending = self._pending, 0
+        if not n:
+            return True
+        tail = int(self._slot[SLOT_TAIL])
+        intact = not self.lossy or int(self.ring.header[HDR_RESERVED]) - self.ring.capacity <= tail
+        if not intact:
+            self._slot[SLOT_DROPPED] += n
+        self._slot[SLOT_TAIL] = tail + n
+        self.words += n
+        self.chunks += 1
+        return intact
+
+    def __iter__(self):
+        while True:
+            closed = self.ring.closed()
+            chunk = self.read()
+            if len(chunk):
+                yield chunk
+            elif closed:
+                self.release()
+                return
+            else:
+                time.sleep(self.idle_sleep)
+
+    def close(self):
+        if self._slot is None:
+            return
+        self.release()
+        self.ring.close_slot(self.slot)
+        # The ring can only be detached once no view into it is left
+        self._slot = None
+
+    def dropped(self):
+        return int(self.ring.slots[self.slot, SLOT_DROPPED])
@@ -0,0 +1,17 @@
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+## Defines for OpenCores SPI master
+
+SPI_CLK_FREQ = 31.25e6  # unit: Hz, the core runs on the IPbus clock
+SPI_MAX_CHAR_LEN = 128  # unit: bit, d0..d3
+SPI_DIV_MAX = 0xffff  # sclk = SPI_CLK_FREQ / (2 * (divider + 1))
+
+SPI_CTRL_GO_BSY = 1 << 8
+
+# Largest in-band busy wait per transfer, unit: ctrl read. Transfers taking longer are
+# sent one dispatch each and waited for from the host, see CeeSpiConfig.write_frames.
+SPI_WAIT_READS_MAX = 256
+
+# Largest divider SpiDividerTuning tries, sclk 61 kHz. A chip failing there has another problem.
+SPI_TUNE_DIV_MAX = 255
@@ -1,6 +1,12 @@
+import math
+import time
+
 import coloredlogs
 import logging
 
+from lib.instrumentation import instrumented
+from lib.spi_defs import *
+
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -15,6 +21,7 @@ class SpiDevice:
     def __init__(self, ipbus_link):
         self._ipbus_link = ipbus_link
         self.reg_name_base = "spi_dev."
+        self._nodes = ipbus_link.nodes(self.reg_name_base)
 
         self.data_len = 0
         self.go_busy = 0
@@ -23,9 +30,15 @@ class SpiDevice:
         self.lsb = 0
         self.ie = 0
         self.ass = 1
+        self.divider = None
 
         self.ctrl = 0x00000000
 
+        self.waiter = ipbus_link.waiter("spi_dev")
+        # perf_counter time the last transfer is over, None: started inside a batch, not known.
+        # Read and written under the link lock, threads may share this device.
+        self._busy_until = 0.0
+
     def w_reg(self, reg_name, reg_val, is_pulse, go_dispatch):
         """
         The register write function for SPI device.
@@ -36,7 +49,7 @@ class SpiDevice:
         :param go_dispatch:
         :return:
         """
-        self._ipbus_link.w_reg(self.reg_name_base, reg_name, reg_val, is_pulse, go_dispatch)
+        self._ipbus_link.w_node(self._nodes[reg_name], reg_val, is_pulse, go_dispatch)
 
     def r_reg(self, reg_name):
         """
@@ -45,7 +58,7 @@ class SpiDevice:
         :param reg_name:
         :return: 
         """
-        return self._ipbus_link.r_reg(self.reg_name_base, reg_name)
+        return self._ipbus_link.r_node(self._nodes[reg_name])
 
     def set_data_len(self, data_len):
         """
@@ -201,6 +214,7 @@ class SpiDevice:
         """Write to divider reg"""
         reg_name = "divider"
         self.w_reg(reg_name, reg_val=divider, is_pulse=False, go_dispatch=go_dispatch)
+        self.divider = divider
 
     def r_div(self):
         """Read divider reg"""
@@ -225,10 +239,103 @@ class SpiDevice:
         """ Start SPI transfer"""
         self.set_go_busy()
         self.w_ctrl(go_dispatch=True)
+        self.mark_started()
+
+    def mark_started(self):
+        """Note that a transfer was started, for :meth:`wait_ready`."""
+        with self._ipbus_link.lock:
+            if self._ipbus_link.in_batch() or self.divider is None:
+                self._busy_until = None
+            else:
+                self._busy_until = time.perf_counter() + self.transfer_time()
+
+    def mark_idle(self):
+        """Note that the last transfer is known to be over, e.g. from an in-band ctrl read."""
+        with self._ipbus_link.lock:
+            self._busy_until = 0.0
+
+    def is_busy(self):
+        """
+        :return: True while a transfer is running, go_bsy in ctrl.
+        """
+        return bool(int(self.r_reg("ctrl")) & SPI_CTRL_GO_BSY)
+
+    @instrumented("spi_wait_idle")
+    def wait_idle(self, timeout=None):
+        """
+        Wait for the running transfer to finish: sleep its expected duration, then poll go_bsy.
+
+        :param timeout: Unit: s. Default: ten times the transfer time plus 0.1 s.
+        :return: Time waited, unit: s.
+        """
+        with self._ipbus_link.lock:
+            busy_until = self._busy_until
+        if busy_until is None:
+            expected = self.transfer_time() if self.divider is not None else 0.0
+        else:
+            expected = max(busy_until - time.perf_counter(), 0.0)
+        if timeout is None:
+            timeout = 10 * expected + 0.1
+        waited = self.waiter.wait(self.is_busy, expected, timeout)
+        with self._ipbus_link.lock:
+            # Unless another thread started a transfer meanwhile
+            if self._busy_until == busy_until:
+                self._busy_until = 0.0
+        return waited
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait before starting the next transfer, only as long as the last one may still run.
+
+        The expected end time is taken from SPI_CLK_FREQ, and writes to a busy core are
+        dropped, so go_bsy is still polled inside that window, see :meth:`wait_idle`.
+
+        :param timeout: See :meth:`wait_idle`.
+        :return: Time waited, unit: s.
+        """
+        with self._ipbus_link.lock:
+            busy_until = self._busy_until
+        if busy_until is not None and time.perf_counter() >= busy_until:
+            return 0.0
+        return self.wait_idle(timeout)
+
+    def char_len(self):
+        """Bits sent in one transfer with the current data_len, 0 means 128."""
+        char_len = self.data_len & 0x7f
+        return char_len if char_len else SPI_MAX_CHAR_LEN
+
+    def transfer_time(self, data_len=None, divider=None):
+        """
+        Expected duration of one transfer: every bit takes 2 * (divider + 1) clock cycles.
+
+        :param data_len: Bits per transfer. Default: current setting.
+        :param divider: Clock divider. Default: last value written.
+        :return: Unit: s.
+        """
+        if data_len is None:
+            data_len = self.char_len()
+        if divider is None:
+            divider = self.divider
+        if divider is None:
+            raise ValueError('SPI clock divider unknown, write it with w_div first')
+        return data_len * 2 * (divider + 1) / SPI_CLK_FREQ
+
+    def transfer_cycles(self, data_len=None, divider=None):
+        """Expected duration of one transfer in IPbus clock cycles."""
+        return int(math.ceil(self.transfer_time(data_len, divider) * SPI_CLK_FREQ))
+
+    def queue_busy_wait(self, n_reads):
+        """
+        Queue `n_reads` back to back reads of ctrl as an in-band delay for a running transfer.
+
+        :param n_reads: Number of reads, each lasts at least one IPbus clock cycle.
+        :return: uhal block of ctrl values; the transfer was over when go_bsy is clear in the last one.
+        """
+        return self._ipbus_link.r_node_repeat(self._nodes["ctrl"], n_reads)
 
-    def w_data_regs(self, spi_data, go_dispatch=True):
+    def w_data_regs(self, spi_data, go_dispatch=True, n_regs=4):
         """Writing SPI configuration data to SPI data registers..."""
-        for i in range(0, 4):
+        for i in range(0, n_regs):
             reg_name = "d" + str(i)
             data = spi_data[i]
             self.w_reg(reg_name, reg_val=data, is_pulse=False, go_dispatch=go_dispatch)
@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from lib.cee_defs import *
+from lib.spi_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class SpiDividerTuning:
+    """
+    Find the fastest SPI clock the CEE chip still follows without errors.
+
+    A divider passes when the divider register reads back what was written and every one
+    of `n_patterns` random pixel configurations, written with write_frames, reads back
+    unchanged through read_matrix. The smallest passing divider is found by bisection,
+    confirmed with twice the patterns, and raised by `margin`. Dividers above `max_divider`
+    are not tried.
+
+    Afterwards every pattern pixel gets its configuration back; pixels not known before get
+    the conf_matrix defaults (trim 0, no test pulse, not masked) instead of a random pattern.
+    A failing divider can garble frames into writes anywhere in the chip, so after a failing
+    check all pixel state is dropped. At the end, the other pixels known before and the
+    `registers` are read back at the tuned divider, and rewritten if they differ.
+
+    Tuning with several frames per transfer also checks that the chip latches every frame
+    of a packed transfer; the saved value is then applied by run.py, see load_frames_per_trans.
+
+    Example::
+
+        tuning = SpiDividerTuning(cee_spi_dev, frames_per_trans=CEE_SPI_FRAMES_PER_TRANS_MAX)
+        div = tuning.run()
+        tuning.save("etc/spi_divider.json")
+    """
+
+    def __init__(self, cee_spi_config, n_patterns=16, pixels=None, margin=1, seed=None, frames_per_trans=None,
+                 max_divider=SPI_TUNE_DIV_MAX, registers=None):
+        """
+        :param cee_spi_config: CeeSpiConfig of the chip.
+        :param n_patterns: Random patterns a divider must pass.
+        :param pixels: Pixels written with the patterns. Default: the whole matrix.
+        :param margin: Added to the smallest passing divider.
+        :param seed: Seed of the random patterns.
+        :param frames_per_trans: Frames per SPI transfer of the patterns. Default: the CeeSpiConfig setting.
+        :param max_divider: Largest divider tried, at most SPI_DIV_MAX.
+        :param registers: dict, CEE register address -> value the chip should hold, repaired after tuning.
+        """
+        self.cee_spi_config = cee_spi_config
+        self.spi_dev = cee_spi_config.spi_dev
+        self.n_patterns = n_patterns
+        self.pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels, dtype=np.intp)
+        self.margin = margin
+        self.frames_per_trans = (cee_spi_config.frames_per_trans if frames_per_trans is None
+                                 else frames_per_trans)
+        if not 0 <= max_divider <= SPI_DIV_MAX:
+            raise ValueError('Unexpected max_divider: {}'.format(max_divider))
+        self.max_divider = max_divider
+        self.registers = {} if registers is None else dict(registers)
+        self._rng = np.random.default_rng(seed)
+        self._disturbed = False
+
+        self.divider = None
+        self.history = []
+
+    def check(self, divider, n_patterns=None):
+        """
+        Write and read back random patterns at one divider.
+
+        :param divider: 0 to SPI_DIV_MAX.
+        :param n_patterns: Default: n_patterns.
+        :return: True if every pattern read back unchanged.
+        """
+        if n_patterns is None:
+            n_patterns = self.n_patterns
+        cee = self.cee_spi_config
+        self.spi_dev.w_div(divider)
+        ok = int(self.spi_dev.r_div()) == divider
+        errors = 0 if ok else 1
+        t_start = time.perf_counter()
+        for _ in range(n_patterns if ok else 0):
+            # we set, the rest random, so every pattern is stored and read back
+            words = np.zeros(CEE_PIXEL_NUM, dtype=np.uint16)
+            words[self.pixels] = 0x8000 | self._rng.integers(0, 0x8000, len(self.pixels), dtype=np.uint16)
+            try:
+                cee.write_frames(cee.pixel_frames(self.pixels, words[self.pixels]), self.frames_per_trans)
+                got = cee.read_matrix(self.pixels, self.frames_per_trans)
+            except RuntimeError as e:
+                log.debug("SPI divider {}: {}".format(divider, e))
+                errors += 1
+                break
+            errors += int(np.count_nonzero(got != words[self.pixels]))
+            if errors:
+                break
+        # What the chip holds now is not known, anywhere if frames were garbled
+        if errors:
+            cee.forget_pixel_state()
+            self._disturbed = True
+        else:
+            cee.pixel_known[self.pixels] = False
+        self.history.append({"divider": divider, "patterns": n_patterns, "errors": errors,
+                             "seconds": time.perf_counter() - t_start})
+        log.info("SPI divider {}: {}".format(divider, "pass" if not errors else "{} errors".format(errors)))
+        return errors == 0
+
+    def run(self, start=4):
+        """
+        :param start: First divider tried as the upper bound, doubled until it passes.
+        :return: Tuned divider, left set on the SPI master.
+        """
+        words = self.cee_spi_config.pixel_words.copy()
+        known = self.cee_spi_config.pixel_known.copy()
+        old_divider = self.spi_dev.divider
+        self._disturbed = False
+        try:
+            hi = min(start, self.max_divider)
+            while not self.check(hi):
+                if hi >= self.max_divider:
+                    raise RuntimeError('SPI readback fails at every divider up to {}'.format(self.max_divider))
+                hi = min(hi * 2 + 1, self.max_divider)
+            lo = -1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.check(mid):
+                    hi = mid
+                else:
+                    lo = mid
+            divider = min(hi + self.margin, self.max_divider)
+            # Confirm with more patterns, the bisection assumes every larger divider works
+            while not self.check(divider, 2 * self.n_patterns):
+                if divider >= self.max_divider:
+                    raise RuntimeError('SPI readback fails at every divider up to {}'.format(self.max_divider))
+                divider = min(divider * 2 + 1, self.max_divider)
+        except Exception:
+            if old_divider is not None:
+                self.spi_dev.w_div(old_divider)
+            raise
+        finally:
+            self._restore(words, known)
+        self.divider = divider
+        log.info("SPI divider tuned to {}, sclk {:.3f} MHz, {} checks".format(
+            divider, SPI_CLK_FREQ / (2 * (divider + 1)) / 1e6, len(self.history)))
+        return divider
+
+    def _restore(self, words, known):
+        cee = self.cee_spi_config
+        pattern_words = np.where(known, words, cee.encode_pixel_conf(0))
+        self._send(pattern_words, self.pixels)
+        if not self._disturbed:
+            return
+        others = np.flatnonzero(known)
+        others = others[~np.isin(others, self.pixels)]
+        if len(others):
+            # Pixels with we clear cannot be checked and stay unknown
+            report = cee.verify_matrix(others, words)
+            if len(report["pixels"]):
+                self._send(words, report["pixels"])
+            checked = others[(words[others] & 0x8000) != 0]
+            cee.pixel_words[checked] = words[checked]
+            cee.pixel_known[checked] = True
+        if self.registers:
+            report = cee.verify_registers(self.registers)
+            if len(report["addrs"]):
+                frames = (report["addrs"] << CEE_FRAME_ADDR_SHIFT) | report["expected"].astype(np.uint32)
+                cee.write_frames(frames.astype(np.uint32), self.frames_per_trans)
+        log.info("Restored after failing dividers: {} pixels and {} CEE registers checked".format(
+            len(others), len(self.registers)))
+
+    def _send(self, words, pixels):
+        conf = self.cee_spi_config.decode_pixel_conf(words)
+        self.cee_spi_config.conf_matrix(conf["trim"], conf["we"], conf["pulse_en"], conf["mask"], pixels=pixels)
+
+    def save(self, path, board_id=None):
+        """
+        Store the divider of this board in a JSON file shared by all boards.
+
+        :param path: JSON file, entries of other boards are kept.
+        :param board_id: Default: the uhal device id of the link.
+        :return: None
+        """
+        if self.divider is None:
+            raise ValueError('Unexpected call, run() has not found a divider yet')
+        if board_id is None:
+            board_id = self.cee_spi_config._ipbus_link.device_id
+        boards = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                boards = json.load(f)
+        boards[board_id] = {"divider": self.divider, "sclk_hz": SPI_CLK_FREQ / (2 * (self.divider + 1)),
+                            "frames_per_trans": self.frames_per_trans, "margin": self.margin,
+                            "patterns": self.n_patterns, "time": time.time()}
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(boards, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+
+def load_divider(path, board_id, default=None):
+    """
+    :param path: JSON file written by SpiDividerTuning.save.
+    :param board_id: uhal device id of the board.
+    :param default: Returned if the board was never tuned.
+    :return: Divider.
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        entry = json.load(f).get(board_id)
+    return default if entry is None else entry["divider"]
+
+
+def load_frames_per_trans(path, board_id, default=CEE_SPI_FRAMES_PER_TRANS):
+    """
+    :param path: JSON file written by SpiDividerTuning.save.
+    :param board_id: uhal device id of the board.
+    :param default: Returned if the board was never tuned.
+    :return: Frames per SPI transfer the tuning passed with.
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        entry = json.load(f).get(board_id)
+    return default if entry is None else entry.get("frames_per_trans", default)
@@ -0,0 +1,112 @@
+import logging
+
+import numpy as np
+
+from lib.cee_defs import *
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+class TrimTuning:
+    """
+    Threshold equalization with the 12-bit pixel trim DAC.
+
+    Every pixel runs its own binary search on the trim, all pixels in parallel: each
+    iteration applies the trims with apply_matrix, which only sends pixels whose trim
+    changed, measures the thresholds of the whole matrix once and halves every search
+    interval. CEE_TRIM_BITS iterations cover the full trim range.
+
+    Example::
+
+        scan = SCurveScan(ipbus_link, cee_spi_dev, bank, dac=(0, 3), values=values, inject=pulser.fire,
+                          n_inject=100)
+        tuning = TrimTuning(cee_spi_dev, measure=scan.measure, target=0.7)
+        trim = tuning.run()
+    """
+
+    def __init__(self, cee_spi_config, measure, target=None, pixels=None, trim_raises_threshold=True):
+        """
+        :param cee_spi_config: CeeSpiConfig of the chip.
+        :param measure: Callable measuring the thresholds, returns CEE_PIXEL_NUM values, nan where unknown.
+        :param target: Threshold to equalize to. Default: median threshold at mid trim.
+        :param pixels: Pixels to tune. Default: the whole matrix.
+        :param trim_raises_threshold: A larger trim gives a higher threshold.
+        """
+        self.cee_spi_config = cee_spi_config
+        self.measure = measure
+        self.target = target
+        self.pixels = np.arange(CEE_PIXEL_NUM) if pixels is None else np.asarray(pixels)
+        self.trim_raises_threshold = trim_raises_threshold
+
+        self.trim = None
+        self.history = []
+
+    def _apply(self, trim):
+        conf = self.cee_spi_config.decode_pixel_conf(self.cee_spi_config.pixel_words)
+        stats = self.cee_spi_config.apply_matrix(trim, we=1, pulse_en=conf["pulse_en"], mask=conf["mask"])
+        return stats["pixels"]
+
+    def run(self, iterations=CEE_TRIM_BITS):
+        """
+        :param iterations: Search steps, CEE_TRIM_BITS resolves the last trim bit.
+        :return: numpy array of the tuned trims, applied to the chip.
+        """
+        trim = self.cee_spi_config.decode_pixel_conf(self.cee_spi_config.pixel_words)["trim"].astype(np.int64)
+        # Search interval [lo, hi] of every tuned pixel
+        lo = np.zeros(CEE_PIXEL_NUM, dtype=np.int64)
+        hi = np.full(CEE_PIXEL_NUM, (1 << CEE_TRIM_BITS) - 1, dtype=np.int64)
+        best_trim = trim.copy()
+        best_err = np.full(CEE_PIXEL_NUM, np.inf)
+        tuned = np.zeros(CEE_PIXEL_NUM, dtype=bool)
+        tuned[self.pixels] = True
+
+        for i in range(iterations):
+            trim[tuned] = (lo[tuned] + hi[tuned] + 1) // 2
+            sent = self._apply(trim)
+            threshold = np.asarray(self.measure(), dtype=np.float64)
+            if self.target is None:
+                self.target = float(np.nanmedian(threshold[tuned]))
+                log.info("Trim tuning target threshold: {:.4f}".format(self.target))
+
+            err = threshold - self.target
+            seen = tuned & ~np.isnan(err)
+            better = seen & (np.abs(err) < best_err)
+            best_err[better] = np.abs(err[better])
+            best_trim[better] = trim[better]
+
+            too_high = err > 0 if self.trim_raises_threshold else err < 0
+            down = seen & too_high
+            up = seen & ~too_high
+            hi[down] = trim[down] - 1
+            lo[up] = trim[up]
+            # An interval closed on its last trim stays there
+            np.maximum(hi, lo, out=hi)
+
+            self.history.append({"iteration": i, "sent": sent, "seen": int(seen.sum()),
+                                 "rms": float(np.sqrt(np.nanmean(err[tuned] ** 2))) if seen.any() else np.nan})
+            log.info("Trim tuning iteration {}: {} pixels sent, {} measured, threshold rms {:.4f}".format(
+                i, sent, self.history[-1]["seen"], self.history[-1]["rms"]))
+
+        failed = tuned & np.isinf(best_err)
+        if failed.any():
+            log.warning("Trim tuning: no threshold measured for pixels {}".format(np.flatnonzero(failed)))
+        trim[tuned] = best_trim[tuned]
+        self._apply(trim)
+        self.trim = trim
+        return trim
+
+    def save(self, path):
+        """
+        Save the tuned trims and the per-iteration history.
+
+        :param path: .npz file.
+        :return: None
+        """
+        np.savez(path, trim=self.trim, target=self.target, pixels=self.pixels,
+                 rms=np.array([h["rms"] for h in self.history]), sent=np.array([h["sent"] for h in self.history]))
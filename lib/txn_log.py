@@ -0,0 +1,164 @@
+import logging
+import struct
+import time
+
+import numpy as np
+import uhal
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+# Layout, little endian: file header | record | record | ...
+#   record = RECORD, followed by `value` data words for TXN_WRITE_BLOCK
+TXN_LOG_MAGIC = b"IPBTXN01"
+FILE_HEADER = struct.Struct("<8sd")  # magic, unix time of the start
+RECORD = struct.Struct("<BBxxIIId")  # op, flags, address, mask, value or word count, time since start
+
+TXN_WRITE = 1  # value under mask; a partial mask is a read-modify-write
+TXN_READ = 2
+TXN_READ_BLOCK = 3  # value: word count
+TXN_WRITE_BLOCK = 4  # value: word count, the words follow
+TXN_DISPATCH = 5  # value: dispatch duration, unit: us
+
+TXN_FLAG_NON_INCREMENTAL = 0x1
+
+TXN_NAMES = {TXN_WRITE: "write", TXN_READ: "read", TXN_READ_BLOCK: "read_block",
+             TXN_WRITE_BLOCK: "write_block", TXN_DISPATCH: "dispatch"}
+
+
+class TxnRecorder:
+    """
+    Binary log of every transaction an IPbusLink queues, with the dispatch boundaries.
+
+    Attached with :meth:`IPbusLink.start_recording`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "wb")
+        self.t_start = time.perf_counter()
+        self._f.write(FILE_HEADER.pack(TXN_LOG_MAGIC, time.time()))
+        self.records = 0
+        self.dispatches = 0
+
+    def add(self, op, address, mask=0xffffffff, value=0, non_incremental=False):
+        self._f.write(RECORD.pack(op, TXN_FLAG_NON_INCREMENTAL if non_incremental else 0, address, mask,
+                                  value, time.perf_counter() - self.t_start))
+        self.records += 1
+
+    def add_block(self, address, words, non_incremental):
+        words = np.asarray(words, dtype="<u4")
+        self.add(TXN_WRITE_BLOCK, address, value=len(words), non_incremental=non_incremental)
+        self._f.write(words.tobytes())
+
+    def dispatch(self, t_start, t_stop):
+        """
+        :param t_start: perf_counter time the dispatch began.
+        :param t_stop: perf_counter time it returned.
+        """
+        self._f.write(RECORD.pack(TXN_DISPATCH, 0, 0, 0, min(int((t_stop - t_start) * 1e6), 0xffffffff),
+                                  t_start - self.t_start))
+        self.records += 1
+        self.dispatches += 1
+
+    def close(self):
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        log.info("Transaction log {}: {} records, {} dispatches".format(self.path, self.records, self.dispatches))
+
+
+def read_txn_log(path):
+    """
+    :param path: File written by TxnRecorder.
+    :return: (start unix time, list of (op, flags, address, mask, value, time, block words or None))
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, created = FILE_HEADER.unpack_from(data, 0)
+    if magic != TXN_LOG_MAGIC:
+        raise ValueError('Unexpected file format: {}'.format(path))
+    records = []
+    pos = FILE_HEADER.size
+    while pos + RECORD.size <= len(data):
+        op, flags, address, mask, value, t = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        words = None
+        if op == TXN_WRITE_BLOCK:
+            words = np.frombuffer(data, dtype="<u4", count=value, offset=pos)
+            pos += value * 4
+        records.append((op, flags, address, mask, value, t, words))
+    return created, records
+
+
+def summarize(records):
+    """
+    :param records: From read_txn_log.
+    :return: dict: transactions per op, dispatches, recorded time and time spent in dispatches.
+    """
+    counts = {name: 0 for name in TXN_NAMES.values()}
+    dispatch_us = 0
+    for op, _, _, _, value, _, _ in records:
+        counts[TXN_NAMES[op]] += 1
+        if op == TXN_DISPATCH:
+            dispatch_us += value
+    span = records[-1][5] - records[0][5] if records else 0.0
+    return {"transactions": counts, "dispatches": counts["dispatch"], "seconds": span,
+            "dispatch_seconds": dispatch_us * 1e-6}
+
+
+def replay(ipbus_link, path, merge=1):
+    """
+    Issue a recorded transaction stream again, as fast as possible.
+
+    Registers are written behind the link's shadow copy, which is therefore invalidated.
+
+    :param ipbus_link: IPbusLink of the board or the simulator.
+    :param path: File written by TxnRecorder.
+    :param merge: Recorded dispatches merged into one. 1: keep the recorded batching, 0: a single dispatch.
+    :return: dict: recorded and replayed dispatches and times.
+    """
+    _, records = read_txn_log(path)
+    recorded = summarize(records)
+    n_dispatch = 0
+    boundaries = 0
+    t_start = time.perf_counter()
+    with ipbus_link.lock:
+        for op, flags, address, mask, value, _, words in records:
+            mode = (uhal.BlockReadWriteMode.NON_INCREMENTAL if flags & TXN_FLAG_NON_INCREMENTAL
+                    else uhal.BlockReadWriteMode.INCREMENTAL)
+            if op == TXN_DISPATCH:
+                boundaries += 1
+                if merge and boundaries % merge == 0:
+                    ipbus_link.dispatch()
+                    n_dispatch += 1
+                continue
+            client = ipbus_link.raw_client()
+            if op == TXN_WRITE:
+                if mask == 0xffffffff:
+                    client.write(address, value)
+                else:
+                    client.rmw_bits(address, ~mask & 0xffffffff, value & mask)
+            elif op == TXN_READ:
+                client.read(address, mask)
+            elif op == TXN_READ_BLOCK:
+                client.readBlock(address, value, mode)
+            elif op == TXN_WRITE_BLOCK:
+                client.writeBlock(address, words.tolist(), mode)
+            else:
+                raise ValueError('Unexpected transaction type {} in {}'.format(op, path))
+        if ipbus_link.raw_pending():
+            ipbus_link.dispatch()
+            n_dispatch += 1
+        ipbus_link.invalidate_shadow()
+    elapsed = time.perf_counter() - t_start
+    log.info("Replayed {}: {} dispatches recorded in {:.3f} s, {} replayed in {:.3f} s".format(
+        path, recorded["dispatches"], recorded["seconds"], n_dispatch, elapsed))
+    return {"recorded_dispatches": recorded["dispatches"], "recorded_seconds": recorded["seconds"],
+            "dispatches": n_dispatch, "seconds": elapsed}
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 
 import coloredlogs
 
 from lib.global_device import GlobalDevice
-from lib.dac8568_device import Dac8568Device
+from lib.dac8568_bank import Dac8568Bank
 from lib.ipbus_link import IPbusLink
 from lib.cee_spi_config import CeeSpiConfig
+from lib.run_plan import RunPlan, RunPlanExecutor
+from lib.spi_tuning import load_divider, load_frames_per_trans
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -19,33 +22,42 @@ __email__ = "s.dong@mails.ccnu.edu.cn"
 
 
 def main():
-    ipbus_link = IPbusLink()
+    parser = argparse.ArgumentParser(description="TopMetal-CEE board bring-up from a run plan.")
+    parser.add_argument("--plan", default="etc/plans/default.json", help="JSON run plan")
+    parser.add_argument("--dry-run", action="store_true", help="print the schedule, do not touch the board")
+    parser.add_argument("--uri", default=None, help="uhal URI of the board, e.g. ipbusudp-2.0://127.0.0.1:50001")
+    parser.add_argument("--spi-divider", default="etc/spi_divider.json",
+                        help="SPI dividers tuned per board (lib/spi_tuning.py), used instead of the plan's div")
+    args = parser.parse_args()
+
+    plan = RunPlan.load(args.plan)
+    if args.dry_run:
+        print(plan.format_schedule())
+        return
+
+    ipbus_link = IPbusLink(device_uri=args.uri)
+    div = load_divider(args.spi_divider, ipbus_link.device_id)
+    if div is not None:
+        log.info("SPI divider {} tuned for {}".format(div, ipbus_link.device_id))
+        plan.spi["div"] = div
 
     global_dev = GlobalDevice(ipbus_link)
-    dac8568_dev0 = Dac8568Device(ipbus_link, dev_nr=0)
-    dac8568_dev1 = Dac8568Device(ipbus_link, dev_nr=1)
+    dac_bank = Dac8568Bank(ipbus_link, global_dev)
     cee_spi_dev = CeeSpiConfig(ipbus_link)
+    # Packed SPI transfers only where the tuning readback passed with them
+    cee_spi_dev.frames_per_trans = load_frames_per_trans(args.spi_divider, ipbus_link.device_id)
+
+    executor = RunPlanExecutor(ipbus_link, global_dev, dac_bank, cee_spi_dev)
+    log.info(plan.format_schedule(plan.compile(cee_spi_dev)))
+    report = executor.execute(plan)
+    for step in report["steps"]:
+        log.info("{:10s} planned {:3d} round trips, actual {:3d}, {:.4f} s".format(
+            step["kind"], step["planned"], step["actual"], step["seconds"]))
 
-    ''' Soft global reset '''
-    global_dev.set_soft_rst()
-
-    """ DAC8568 dev 0 Settings"""
-    global_dev.set_dac_nr(0)
-    dac8568_dev0.reset_dev()
-    dac8568_dev0.select_ch(0xff)
-    dac8568_dev0.set_volt(ch=0, volt=1.0)
-    dac8568_dev0.start_conv()
-
-    """ DAC8568 dev 1 Settings"""
-    global_dev.set_dac_nr(1)
-    dac8568_dev1.reset_dev()
-    dac8568_dev1.select_ch(0xff)
-    dac8568_dev1.set_volt(ch=1, volt=1.0)
-    dac8568_dev1.start_conv()
-
-    """ Config CEE """
-    cee_spi_dev.conf_pixel(pixel_addr=1, dac_h4=0x0, dac_l8=0x0f, we=1, pulse_en=1, mask=0)
-    cee_spi_dev.cee_spi_trans(rw=0, addr=0x01, data=0x00)
+    # Let the last conversion finish before returning the board
+    if executor.dac_nr is not None:
+        dac_bank.devices[dac_bank.dev_nrs.index(executor.dac_nr)].wait_idle()
+    log.info("Completion waits: {}".format(ipbus_link.wait_metrics()))
 
 
 if __name__ == '__main__':
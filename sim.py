@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+
+import coloredlogs
+
+from lib.address_table import AddressTable
+from lib.ipbus_sim import IPbusSimulator
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+coloredlogs.install(level='INFO', logger=log)
+
+__author__ = "Sheng Dong"
+__email__ = "s.dong@mails.ccnu.edu.cn"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local IPbus 2.0 UDP endpoint simulating the TopMetal-CEE board.")
+    parser.add_argument("--address-table", default="etc/sim_address.xml", help="top level address table")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50001)
+    parser.add_argument("--latency", type=float, default=0.0, help="reply delay in ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability to drop a request or a reply")
+    parser.add_argument("--spi-min-div", type=int, default=0, help="SPI dividers below this corrupt frames")
+    parser.add_argument("--rfifo-rate", type=float, default=0.0, help="data FIFO fill rate in words/s")
+    parser.add_argument("--wfifo-rate", type=float, default=0.0, help="slow control FIFO drain rate in words/s, 0: immediate")
+    parser.add_argument("--cmd-stream", action="store_true",
+                        help="execute lib/cmd_stream.py words from the slow control FIFO, not in the firmware yet")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sim = IPbusSimulator(AddressTable.load(args.address_table), host=args.host, port=args.port,
+                         latency=args.latency * 1e-3, loss=args.loss, spi_min_div=args.spi_min_div,
+                         rfifo_rate=args.rfifo_rate, wfifo_rate=args.wfifo_rate, seed=args.seed,
+                         cmd_stream=args.cmd_stream)
+    log.info("Connect with IPbusLink(device_uri=\"{}\")".format(sim.uri))
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopped, served {}".format(sim.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+SIM_ADDRESS_TABLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "etc",
+                                 "sim_address.xml")
+
+
+@pytest.fixture
+def sim():
+    """
+    Simulator on a free localhost port, stopped after the test.
+    """
+    from lib.address_table import AddressTable
+    from lib.ipbus_sim import IPbusSimulator
+
+    simulator = IPbusSimulator(AddressTable.load(SIM_ADDRESS_TABLE), port=0, seed=1)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def link(sim):
+    """
+    Link to the simulator, with stats on to count dispatches.
+    """
+    from lib.ipbus_link import IPbusLink
+
+    return IPbusLink(device_uri=sim.uri, address_table=SIM_ADDRESS_TABLE, stats=True)
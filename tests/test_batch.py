@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+pytest.importorskip("uhal")
+
+from lib.dac8568_device import Dac8568Device
+from lib.ipbus_link import DeferredRead
+
+
+def test_batch_is_one_dispatch(link):
+    dac = Dac8568Device(link, 0)
+    with link.batch():
+        for ch in range(8):
+            dac.set_data(ch, 0x100 * ch + 1)
+        dac.select_ch(0x0f)
+    assert link.stats.counters["dispatches"] == 1
+
+
+def test_deferred_read_resolves_after_flush(link, sim):
+    dac = Dac8568Device(link, 0)
+    node = link.node("dac8568_dev0.", "data_ch1")
+    with link.batch():
+        dac.set_data(1, 0x1234)
+        read = dac.r_reg("data_ch1")
+        assert isinstance(read, DeferredRead)
+        assert not read.valid()
+        assert link.stats.counters["dispatches"] == 0
+    assert read.valid()
+    assert read == 0x1234
+    assert int(read) == (sim.read_word(node.address) & node.mask) >> node.shift
+    assert link.stats.counters["dispatches"] == 1
+
+
+def test_deferred_read_value_forces_dispatch(link):
+    dac = Dac8568Device(link, 0)
+    with link.batch():
+        dac.set_data(2, 0x55aa)
+        read = dac.r_reg("data_ch2")
+        assert read.value() == 0x55aa
+        assert link.stats.counters["dispatches"] == 1
+        dac.set_data(3, 0x0001)
+    assert link.stats.counters["dispatches"] == 2
+
+
+def test_nested_batch_dispatches_once(link):
+    dac = Dac8568Device(link, 0)
+    with link.batch():
+        dac.set_data(0, 1)
+        with link.batch():
+            dac.set_data(1, 2)
+        assert link.stats.counters["dispatches"] == 0
+        read = dac.r_reg("data_ch1")
+    assert link.stats.counters["dispatches"] == 1
+    assert read == 2
+
+
+def test_in_batch_is_per_thread(link):
+    seen = []
+    with link.batch():
+        thread = threading.Thread(target=lambda: seen.append(link.in_batch()))
+        thread.start()
+        thread.join()
+        assert link.in_batch()
+    assert seen == [False]
+    assert not link.in_batch()
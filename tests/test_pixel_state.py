@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("uhal")
+
+from lib.cee_defs import CEE_PIXEL_NUM
+from lib.cee_spi_config import CeeSpiConfig
+
+
+@pytest.fixture
+def cee(link):
+    return CeeSpiConfig(link)
+
+
+def _chip_words(sim):
+    return np.array(sim.chip.pixels, dtype=np.uint16)
+
+
+def _spi_transfers(sim):
+    return sum(spi.transfers for spi in sim.spi)
+
+
+def test_apply_matrix_sends_only_changed_pixels(cee, sim):
+    rng = np.random.default_rng(3)
+    trim = rng.integers(0, 4096, CEE_PIXEL_NUM)
+    stats = cee.apply_matrix(trim)
+    assert stats["pixels"] == CEE_PIXEL_NUM
+    assert stats["skipped"] == 0
+
+    changed = np.array([0, 17, 100, 255])
+    trim[changed] ^= 0x5a5
+    transfers = _spi_transfers(sim)
+    stats = cee.apply_matrix(trim)
+    assert stats["pixels"] == len(changed)
+    assert stats["skipped"] == CEE_PIXEL_NUM - len(changed)
+    assert _spi_transfers(sim) - transfers == stats["transfers"]
+    np.testing.assert_array_equal(cee.changed_pixels(cee.encode_pixel_conf(trim)), [])
+
+    report = cee.verify_matrix()
+    assert report["checked"] == CEE_PIXEL_NUM
+    assert len(report["pixels"]) == 0
+    np.testing.assert_array_equal(_chip_words(sim), cee.encode_pixel_conf(trim))
+
+
+def test_apply_matrix_unchanged_sends_nothing(cee, link):
+    trim = np.arange(CEE_PIXEL_NUM)
+    cee.apply_matrix(trim, pulse_en=1)
+    dispatches = link.stats.counters["dispatches"]
+    stats = cee.apply_matrix(trim, pulse_en=1)
+    assert stats["pixels"] == 0
+    assert stats["skipped"] == CEE_PIXEL_NUM
+    assert link.stats.counters["dispatches"] == dispatches
+
+
+def test_forgotten_state_is_resent(cee):
+    trim = np.arange(CEE_PIXEL_NUM)
+    cee.apply_matrix(trim)
+    cee.forget_pixel_state()
+    assert cee.apply_matrix(trim)["pixels"] == CEE_PIXEL_NUM
+
+
+def test_saved_state_verified_on_load(cee, sim, tmp_path):
+    trim = np.arange(CEE_PIXEL_NUM)
+    cee.apply_matrix(trim)
+    path = str(tmp_path / "pixels.npz")
+    cee.save_pixel_state(path)
+    # The chip lost pixel 5 behind the software's back
+    sim.chip.pixels[5] = 0
+    cee.forget_pixel_state()
+    report = cee.load_pixel_state(path, verify=True)
+    np.testing.assert_array_equal(report["pixels"], [5])
+    np.testing.assert_array_equal(cee.changed_pixels(cee.encode_pixel_conf(trim)), [5])
+    assert cee.apply_matrix(trim)["pixels"] == 1
+    assert len(cee.verify_matrix()["pixels"]) == 0
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("uhal")
+
+from lib.dac8568_device import Dac8568Device
+from lib.global_device import GlobalDevice
+
+
+def _field(sim, node):
+    return (sim.read_word(node.address) & node.mask) >> node.shift
+
+
+def test_masked_writes_merge_into_one_word(link, sim):
+    dac = Dac8568Device(link, 0)
+    nodes = link.nodes("dac8568_dev0.")
+    assert nodes["rst_n"].address == nodes["start"].address == nodes["sel_ch"].address
+    with link.batch():
+        dac.w_reg("rst_n", 1, is_pulse=False, go_dispatch=True)
+        dac.w_reg("start", 0, is_pulse=False, go_dispatch=True)
+        dac.select_ch(0xab)
+    counters = link.stats.counters
+    # Bits 31:10 of the word are not known yet, so it takes one read-modify-write
+    assert counters["rmw"] == 1
+    assert counters["words_written"] == 0
+    assert counters["dispatches"] == 1
+    assert _field(sim, nodes["rst_n"]) == 1
+    assert _field(sim, nodes["start"]) == 0
+    assert _field(sim, nodes["sel_ch"]) == 0xab
+    assert link.shadow_snapshot()[nodes["sel_ch"].address] == (0x3ff, (0xab << 2) | 1)
+
+
+def test_redundant_write_is_skipped(link, sim):
+    dac = Dac8568Device(link, 0)
+    node = link.node("dac8568_dev0.", "sel_ch")
+    dac.select_ch(0x0f)
+    dispatches = link.stats.counters["dispatches"]
+    # Changed behind the link's back: the shadow still says 0x0f, so the write is dropped
+    sim.write_word(node.address, 0)
+    dac.select_ch(0x0f)
+    assert link.stats.counters["dispatches"] == dispatches
+    assert _field(sim, node) == 0
+    dac.select_ch(0x0e)
+    assert link.stats.counters["dispatches"] == dispatches + 1
+    assert _field(sim, node) == 0x0e
+
+
+def test_soft_rst_invalidates_shadow(link, sim):
+    dac = Dac8568Device(link, 0)
+    node = link.node("dac8568_dev0.", "sel_ch")
+    dac.select_ch(0x0f)
+    assert node.address in link.shadow_snapshot()
+    sim.write_word(node.address, 0)
+    GlobalDevice(link).set_soft_rst()
+    assert link.shadow_snapshot() == {}
+    dac.select_ch(0x0f)
+    assert _field(sim, node) == 0x0f
+
+
+def test_pulse_is_never_skipped(link, sim):
+    dac = Dac8568Device(link, 0)
+    dac.reset_dev()
+    dispatches = link.stats.counters["dispatches"]
+    dac.reset_dev()
+    assert link.stats.counters["dispatches"] == dispatches + 1